@@ -1,27 +1,107 @@
-document.addEventListener('DOMContentLoaded', cargarProductos);
+document.addEventListener('DOMContentLoaded', () => {
+    nuevaClave();
+    cargarProductos();
+});
 
 let productoEditandoId = null;
+let etagEditando = null;
+// Idempotency-Key del alta en curso: se crea al abrir el formulario y se
+// reusa al reintentar el mismo envio, asi un reintento tras un corte no
+// crea el producto dos veces
+let claveIdempotencia = null;
+let cuerpoEnviado = null;
+let siguientePagina = null;
+let fuenteCambios = null;
+
+const TAMANO_PAGINA = 100;
 
 function cargarProductos() {
-    fetch('/productos')
+    if (fuenteCambios) {
+        fuenteCambios.close();
+        fuenteCambios = null;
+    }
+    // El seq se toma antes del listado: los cambios posteriores llegan por
+    // el stream y aplicarlos de nuevo no hace daño
+    fetch('/productos/changes')
         .then(response => response.json())
         .then(data => {
-            const tbody = document.querySelector('#tabla-productos tbody');
-            tbody.innerHTML = '';
-            data.forEach(producto => {
-                tbody.innerHTML += `
-                    <tr>
-                        <td>${producto.id}</td>
-                        <td>${producto.nombre}</td>
-                        <td>${producto.precio}</td>
-                        <td>${producto.descripcion}</td>
-                        <td>
-                            <button onclick="editarProducto(${producto.id})">Editar</button>
-                            <button onclick="eliminarProducto(${producto.id})">Eliminar</button>
-                        </td>
-                    </tr>
-                `;
-            });
+            document.querySelector('#tabla-productos tbody').innerHTML = '';
+            cargarPagina(null, () => escucharCambios(data.next));
+        });
+}
+
+function escucharCambios(seq) {
+    if (!window.EventSource) {
+        return;
+    }
+    fuenteCambios = new EventSource(`/productos/changes/stream?since=${seq}`);
+    fuenteCambios.addEventListener('cambio', evento => aplicarCambio(JSON.parse(evento.data)));
+    fuenteCambios.addEventListener('reset', cargarProductos);
+    fuenteCambios.onerror = () => {
+        // Cerrado para siempre (p. ej. 503): se vuelve a recargar tras cada edicion
+        if (fuenteCambios && fuenteCambios.readyState === EventSource.CLOSED) {
+            fuenteCambios = null;
+        }
+    };
+}
+
+function aplicarCambio(cambio) {
+    const fila = document.getElementById(`producto-${cambio.id}`);
+    if (cambio.producto === null) {
+        if (fila) {
+            fila.remove();
+        }
+    } else if (fila || siguientePagina === null) {
+        // Un producto nuevo solo se agrega si ya se ve la ultima pagina;
+        // si no, aparecera al cargar mas
+        mostrarProducto(cambio.producto);
+    }
+}
+
+function filaProducto(producto) {
+    return `
+        <tr id="producto-${producto.id}">
+            <td>${producto.id}</td>
+            <td>${producto.nombre}</td>
+            <td>${producto.precio}</td>
+            <td>${producto.descripcion}</td>
+            <td>
+                <button onclick="editarProducto(${producto.id})">Editar</button>
+                <button onclick="eliminarProducto(${producto.id})">Eliminar</button>
+            </td>
+        </tr>
+    `;
+}
+
+function mostrarProducto(producto) {
+    const fila = document.getElementById(`producto-${producto.id}`);
+    if (fila) {
+        fila.outerHTML = filaProducto(producto);
+    } else {
+        document.querySelector('#tabla-productos tbody').insertAdjacentHTML('beforeend', filaProducto(producto));
+    }
+}
+
+function cargarMas() {
+    if (siguientePagina !== null) {
+        cargarPagina(siguientePagina);
+    }
+}
+
+function cargarPagina(after, alTerminar) {
+    let url = `/productos?limit=${TAMANO_PAGINA}`;
+    if (after !== null) {
+        url += `&after=${after}`;
+    }
+    fetch(url)
+        .then(response => response.json())
+        .then(data => {
+            data.productos.forEach(mostrarProducto);
+            siguientePagina = data.next;
+            document.getElementById('cargar-mas').style.display = siguientePagina === null ? 'none' : '';
+            if (alTerminar) {
+                alTerminar();
+            }
         });
 }
 
@@ -34,24 +114,57 @@ function guardarProducto() {
 
     const url = productoEditandoId ? `/productos/${productoEditandoId}` : '/productos';
     const method = productoEditandoId ? 'PUT' : 'POST';
+    const headers = { 'Content-Type': 'application/json' };
+    const cuerpo = JSON.stringify(producto);
+    if (productoEditandoId && etagEditando) {
+        // Si otro lo modifico desde que se abrio el formulario, el servidor
+        // responde 412 en lugar de pisar su cambio
+        headers['If-Match'] = etagEditando;
+    } else {
+        // Con otros datos ya no es un reintento sino otro alta
+        if (cuerpoEnviado !== null && cuerpo !== cuerpoEnviado) {
+            nuevaClave();
+        }
+        cuerpoEnviado = cuerpo;
+        if (claveIdempotencia) {
+            headers['Idempotency-Key'] = claveIdempotencia;
+        }
+    }
 
     fetch(url, {
         method: method,
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(producto)
+        headers: headers,
+        body: cuerpo
     })
-    .then(response => response.json())
-    .then(data => {
-        document.getElementById('message').textContent = data.mensaje;
-        cargarProductos();
+    .then(response => response.json().then(data => ({ ok: response.ok, data: data })))
+    .then(({ ok, data }) => {
+        document.getElementById('message').textContent = data.mensaje || data.error;
+        if (!ok) {
+            // El formulario y la clave quedan para reintentar
+            return;
+        }
+        // Con el stream abierto la tabla se actualiza sola
+        if (!fuenteCambios) {
+            cargarProductos();
+        }
         limpiarFormulario();
-        productoEditandoId = null;
+    })
+    .catch(() => {
+        document.getElementById('message').textContent = 'No se pudo guardar; vuelva a intentar';
     });
 }
 
+function nuevaClave() {
+    claveIdempotencia = window.crypto && crypto.randomUUID ? crypto.randomUUID() : null;
+    cuerpoEnviado = null;
+}
+
 function editarProducto(id) {
     fetch(`/productos/${id}`)
-        .then(response => response.json())
+        .then(response => {
+            etagEditando = response.headers.get('ETag');
+            return response.json();
+        })
         .then(producto => {
             productoEditandoId = id;
             document.getElementById('nombre').value = producto.nombre;
@@ -67,7 +180,9 @@ function eliminarProducto(id) {
             .then(response => response.json())
             .then(data => {
                 document.getElementById('message').textContent = data.mensaje;
-                cargarProductos();
+                if (!fuenteCambios) {
+                    cargarProductos();
+                }
             });
     }
 }
@@ -77,4 +192,6 @@ function limpiarFormulario() {
     document.getElementById('precio').value = '';
     document.getElementById('descripcion').value = '';
     productoEditandoId = null;
+    etagEditando = null;
+    nuevaClave();
 }
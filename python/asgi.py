@@ -0,0 +1,200 @@
+"""Modo de servicio asincrono (ASGI) para la misma aplicacion Flask.
+
+El servidor ASGI (uvicorn) mantiene las conexiones en un event loop, asi que
+miles de conexiones keep-alive inactivas no ocupan hilos. Solo las peticiones
+en curso se ejecutan, con sus llamadas a SQLite, en un pool de hilos acotado.
+
+Una vista puede ademas dejar en ``environ['crud.async_body']`` una funcion
+que devuelve un iterador asincrono con el resto del cuerpo (el stream SSE de
+cambios lo hace): tras el primer chunk el adaptador lo recorre en el event
+loop, asi un cliente que espera eventos no ocupa un hilo del pool.
+
+Uso: python asgi.py [--host 127.0.0.1] [--port 8000] [--threads 32]
+  o: uvicorn asgi:application
+"""
+import argparse
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import backend
+
+_FIN = object()
+
+
+class AsgiAdapter:
+    """Expone una aplicacion WSGI como ASGI ejecutandola en un pool de hilos."""
+
+    def __init__(self, wsgi_app, max_workers=32, on_startup=None):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='asgi')
+        self.on_startup = on_startup
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    if self.on_startup is not None:
+                        await asyncio.get_running_loop().run_in_executor(self.executor, self.on_startup)
+                except Exception as error:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                break
+
+        environ = self._environ(scope, bytes(body))
+        inicio = {}
+
+        def start_response(status, headers, exc_info=None):
+            inicio['status'] = int(status.split(' ', 1)[0])
+            inicio['headers'] = [(nombre.lower().encode('latin-1'), valor.encode('latin-1'))
+                                 for nombre, valor in headers]
+
+        def iniciar():
+            # La llamada a la app y el primer chunk van en el mismo salto al
+            # pool; si el primer chunk ya es todo el cuerpo se cierra aqui mismo
+            iterable = self.wsgi_app(environ, start_response)
+            iterator = iter(iterable)
+            chunk = next(iterator, _FIN)
+            longitud = dict(inicio['headers']).get(b'content-length')
+            completo = chunk is _FIN or (longitud is not None and len(chunk) == int(longitud))
+            if completo and hasattr(iterable, 'close'):
+                iterable.close()
+            return iterable, iterator, chunk, completo
+
+        loop = asyncio.get_running_loop()
+        iterable, iterator, chunk, completo = await loop.run_in_executor(self.executor, iniciar)
+        await send({'type': 'http.response.start', 'status': inicio['status'],
+                    'headers': inicio['headers']})
+        if completo:
+            await send({'type': 'http.response.body', 'body': b'' if chunk is _FIN else chunk})
+            return
+        cuerpo_async = environ.get('crud.async_body')
+        try:
+            if cuerpo_async is not None:
+                if chunk is not _FIN and chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                await self._cuerpo_async(cuerpo_async(self.executor), receive, send)
+                return
+            # Respuesta en streaming: cada chunk se produce en el pool de hilos
+            while chunk is not _FIN:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, iterator, _FIN)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self.executor, close)
+
+    @staticmethod
+    async def _cuerpo_async(iterador, receive, send):
+        # El cliente se puede ir mientras el cuerpo espera eventos: se vigila
+        # receive() en paralelo y se corta en cuanto llega la desconexion
+        async def desconectado():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        vigia = asyncio.ensure_future(desconectado())
+        try:
+            while True:
+                siguiente = asyncio.ensure_future(iterador.__anext__())
+                await asyncio.wait({siguiente, vigia}, return_when=asyncio.FIRST_COMPLETED)
+                if not siguiente.done():
+                    # Se espera la cancelacion para que el generador corra su
+                    # finally antes de aclose()
+                    siguiente.cancel()
+                    await asyncio.wait({siguiente})
+                    return
+                try:
+                    chunk = siguiente.result()
+                except StopAsyncIteration:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            vigia.cancel()
+            await iterador.aclose()
+
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'crud.async': True,
+        }
+        for nombre, valor in scope.get('headers', []):
+            nombre = nombre.decode('latin-1').upper().replace('-', '_')
+            valor = valor.decode('latin-1')
+            if nombre == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = valor
+                continue
+            if nombre == 'CONTENT_LENGTH':
+                continue
+            clave = f'HTTP_{nombre}'
+            environ[clave] = f'{environ[clave]},{valor}' if clave in environ else valor
+        return environ
+
+
+def arrancar():
+    backend.init_db()
+    backend.iniciar_mantenimiento()
+
+
+application = AsgiAdapter(backend.app, on_startup=arrancar)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor ASGI del inventario')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--threads', type=int, default=32)
+    args = parser.parse_args()
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('El modo ASGI necesita uvicorn: pip install uvicorn')
+    app = AsgiAdapter(backend.app, max_workers=args.threads, on_startup=arrancar)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
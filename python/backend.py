@@ -1,64 +1,1313 @@
-from flask import Flask, request, jsonify, render_template
+from flask import (Flask, Response, request, jsonify, render_template, g, has_app_context,
+                   has_request_context, current_app)
+from flask.json.provider import DefaultJSONProvider
+from datetime import datetime, timezone
+import functools
+import hmac
+import itertools
+import json
 import sqlite3
 import os
+import threading
+import time
 
-app = Flask(__name__)
+from cache import CachedResponse, LRUCache
+from changes import CambiosPerdidos, Difusor, StreamCambios, leer_cambios, ultimo_seq
+from compression import CompressionMiddleware
+from encoding import JSON_SQL, elegir_codificador
+import idempotency
+from maintenance import ColaLlena, Mantenimiento
+from metrics import Metricas, desde_stats
+from migrations import aplicar_migraciones
+from pool import ConnectionPool, PoolTimeout
+from profiling import ProfilingMiddleware
+import ratelimit
+from repository import (COLUMNAS, RepositorioMemoria, RepositorioSQLite, VersionDistinta, a_dicts,
+                        filtro_nombre, sql_listado, version_catalogo)
+from snapshot import Snapshot
+from stats import calcular
+from writer import WriteQueue, WriterClosed, WriteTimeout
 
-DATABASE = os.path.join(os.path.dirname(__file__), 'productos.db')
+CONFIGURACION = dict(
+    # Almacenamiento de los productos (ver repository.py): 'sqlite', 'memory'
+    # o una funcion que recibe la app y devuelve un Repositorio. Busqueda,
+    # estadisticas, feed de cambios, snapshot e Idempotency-Key usan SQLite
+    # directamente y con otro almacenamiento no estan disponibles
+    STORAGE='sqlite',
+    DB_POOL_SIZE=8,
+    DB_POOL_TIMEOUT=5.0,
+    DB_PRAGMAS={'foreign_keys': 'ON'},
+    DB_JOURNAL_MODE='WAL',
+    DB_SYNCHRONOUS='NORMAL',
+    DB_BUSY_TIMEOUT=5000,
+    DB_MMAP_SIZE=256 * 1024 * 1024,
+    DB_CACHE_SIZE=-16000,
+    DB_WRITE_QUEUE=True,
+    DB_WRITE_BATCH=64,
+    # Segundos que una peticion espera a que el escritor confirme su trabajo;
+    # pasado el plazo responde 503 en lugar de quedar colgada
+    DB_WRITE_TIMEOUT=10.0,
+    # Sentencias compiladas que guarda cada conexion. Los listados generan un
+    # texto SQL por combinacion de campos y filtros; con el valor por defecto
+    # de sqlite3 (128) las combinaciones poco usadas desplazan a las frecuentes
+    DB_CACHED_STATEMENTS=512,
+    PAGE_DEFAULT_LIMIT=100,
+    PAGE_MAX_LIMIT=1000,
+    STREAM_CHUNK_SIZE=1000,
+    BULK_MAX_ITEMS=100000,
+    SEARCH_DEFAULT_LIMIT=20,
+    SEARCH_MAX_LIMIT=100,
+    # Por defecto el bm25 ordena todas las coincidencias: el resultado es
+    # exacto, pero el costo crece con ellas (~0.8 us por coincidencia). Con
+    # 300k filas un termino poco comun responde en 0.4 ms, y uno que esta en
+    # todas las filas en 245 ms, lejos de los 10 ms buscados. Con N solo se
+    # ordenan las N coincidencias mas recientes (N=1000: 7.6 ms; 10000:
+    # 14 ms; unos 5 ms son el recuento del termino que hace bm25 igual), y
+    # una coincidencia mejor y mas vieja no aparece: la respuesta lo indica
+    # con "truncado". Conviene fijarlo si el catalogo tiene terminos que
+    # aparecen en casi todas las filas
+    SEARCH_RANK_WINDOW=None,
+    # El cache es por proceso: con varios workers una escritura solo
+    # invalida el cache del worker que la atendio (el resto espera al TTL)
+    CACHE_ENABLED=False,
+    CACHE_BACKEND=None,
+    CACHE_MAX_ENTRIES=1024,
+    CACHE_MAX_BYTES=64 * 1024 * 1024,
+    CACHE_TTL=30.0,
+    # Igual que el cache, las metricas son por proceso: con serve.py cada
+    # worker expone las suyas
+    METRICS_ENABLED=False,
+    # Umbral (ms) del log de consultas lentas; None lo desactiva
+    METRICS_SLOW_QUERY_MS=None,
+    # Perfilado por peticion (ver profiling.py). Solo lo pide quien manda
+    # X-Profile-Token igual a PROFILE_TOKEN; PROFILE_ALLOWED_IPS admite
+    # ademas esas direcciones sin token, con el mismo cuidado que
+    # MAINTENANCE_ALLOWED_IPS detras de un proxy
+    PROFILE_ENABLED=False,
+    PROFILE_MODE='cprofile',
+    PROFILE_INTERVAL=0.001,
+    PROFILE_SAMPLE_RATE=0.0,
+    PROFILE_DIR=None,
+    PROFILE_ALLOWED_IPS=(),
+    PROFILE_TOKEN=None,
+    # 'auto' usa orjson si esta instalado; 'json' fuerza la libreria estandar
+    JSON_ENCODER='auto',
+    # Los listados se arman como JSON dentro de SQLite (sin un dict por fila).
+    # Con 100k filas es ~1.8x mas rapido que json y casi igual que orjson,
+    # pero el precio sale con 17 digitos y el texto no coincide con el del
+    # detalle ni el del snapshot (ver encoding.py)
+    JSON_ROWS_SQL=False,
+    # Replica en memoria del catalogo por worker (ver snapshot.py). Con
+    # SNAPSHOT_REFRESH_INTERVAL=0 cada lectura verifica la version en SQLite;
+    # con N > 0 puede servir datos de hasta N segundos (salvo escrituras del
+    # mismo worker, que la marcan para sincronizar)
+    SNAPSHOT_ENABLED=False,
+    SNAPSHOT_MAX_BYTES=256 * 1024 * 1024,
+    SNAPSHOT_REFRESH_INTERVAL=0.0,
+    # Feed de cambios (ver changes.py). Cada stream SSE servido por WSGI
+    # ocupa un hilo mientras espera, por eso se limitan aparte; bajo asgi.py
+    # esperan en el event loop y cuentan contra CHANGES_MAX_SUBSCRIBERS.
+    # La tarea de mantenimiento podar_cambios deja en la bitacora a lo sumo
+    # CHANGES_MAX_ROWS filas de hasta CHANGES_RETENTION segundos (None: sin
+    # limite); un cliente que quede mas atras recibe 410 y recarga
+    CHANGES_MAX_LIMIT=1000,
+    CHANGES_POLL_INTERVAL=0.5,
+    CHANGES_BUFFER=1000,
+    CHANGES_HEARTBEAT=15.0,
+    CHANGES_STREAM_MAX_AGE=300.0,
+    CHANGES_MAX_STREAMS=4,
+    CHANGES_MAX_SUBSCRIBERS=10000,
+    CHANGES_RETENTION=7 * 86400,
+    CHANGES_MAX_ROWS=100000,
+    # Compresion de respuestas (ver compression.py). Solo se aplica si el
+    # cliente la pide en Accept-Encoding. gzip 1 deja una pagina de 1000
+    # filas 4.1x mas chica en ~0.75 ms; el nivel 6 gana 30% mas pero cuesta
+    # 3x de CPU (medido con bench_compression.py)
+    COMPRESSION_ENABLED=True,
+    COMPRESSION_ALGORITHMS=('zstd', 'br', 'gzip'),
+    COMPRESSION_LEVELS={'gzip': 1, 'br': 4, 'zstd': 3},
+    COMPRESSION_MIN_SIZE=1024,
+    COMPRESSION_MIMETYPES=('application/json', 'application/x-ndjson', 'text/html', 'text/css',
+                           'text/plain', 'text/javascript', 'application/javascript'),
+    COMPRESSION_CACHE_ENTRIES=256,
+    COMPRESSION_CACHE_MAX_BYTES=16 * 1024 * 1024,
+    COMPRESSION_CACHE_TTL=300.0,
+    # GET /productos/stats se cachea por version del catalogo: cualquier
+    # escritura (de cualquier worker) la invalida
+    STATS_PERCENTILES=(50, 90, 95, 99),
+    STATS_DEFAULT_BUCKETS=20,
+    STATS_MAX_BUCKETS=1000,
+    STATS_CACHE_ENTRIES=128,
+    # Escrituras con Idempotency-Key (ver idempotency.py). Las claves se
+    # guardan en SQLite, asi que un reintento puede caer en cualquier worker
+    IDEMPOTENCY_ENABLED=True,
+    IDEMPOTENCY_TTL=24 * 3600.0,
+    IDEMPOTENCY_MAX_KEYS=100000,
+    IDEMPOTENCY_LOCK_TIMEOUT=60.0,
+    IDEMPOTENCY_PRUNE_EVERY=100,
+    # Con True, PUT y DELETE de /productos/<id> sin If-Match responden 428
+    WRITE_REQUIRE_IF_MATCH=False,
+    # Mantenimiento en segundo plano (ver maintenance.py). MAINTENANCE_SCHEDULE
+    # ({tarea: segundos}, p. ej. {'analyze': 86400, 'backup': 86400}) programa
+    # tareas periodicas que corre un solo worker por periodo; vacio no
+    # programa nada (ni la poda de la bitacora de cambios). Las copias van
+    # a MAINTENANCE_BACKUP_DIR (None: 'respaldos' junto a la base) y de las
+    # automaticas quedan las ultimas MAINTENANCE_BACKUP_KEEP.
+    # /admin/jobs esta apagado salvo con MAINTENANCE_API_ENABLED y pide
+    # X-Maintenance-Token igual a MAINTENANCE_TOKEN. MAINTENANCE_ALLOWED_IPS
+    # admite ademas esas direcciones sin token: solo sin proxy adelante,
+    # porque detras de uno en el mismo host todos llegan como 127.0.0.1. A
+    # lo sumo MAINTENANCE_MAX_PENDING trabajos esperan en la cola (503)
+    MAINTENANCE_SCHEDULE={'podar_cambios': 3600},
+    MAINTENANCE_CHECK_INTERVAL=60.0,
+    MAINTENANCE_BACKUP_DIR=None,
+    MAINTENANCE_BACKUP_KEEP=7,
+    MAINTENANCE_BACKUP_PAGES=1024,
+    MAINTENANCE_VACUUM_PAGES=256,
+    MAINTENANCE_HISTORY=100,
+    MAINTENANCE_MAX_PENDING=10,
+    MAINTENANCE_API_ENABLED=False,
+    MAINTENANCE_ALLOWED_IPS=(),
+    MAINTENANCE_TOKEN=None,
+    # Limite de tasa y control de admision (ver ratelimit.py), por
+    # 'METODO endpoint' o por endpoint; los endpoints sin politica no se
+    # limitan. Una peticion en cola ocupa un hilo: con los 8 de serve.py los
+    # listados toman a lo sumo 2 corriendo + 2 esperando. Mas listados a la
+    # vez tampoco rinden mas, porque compiten por el GIL del worker; con 12
+    # clientes pidiendo paginas de 1000 filas, bajar de 4 a 2 en curso llevo
+    # la mediana de GET /productos/<id> de 10.7 a 5.9 ms. Solo detras de un
+    # proxy, RATELIMIT_CLIENT_HEADER='X-Forwarded-For' identifica al cliente:
+    # las entradas las escribe el cliente salvo las RATELIMIT_TRUSTED_PROXIES
+    # ultimas, que agregan los proxies propios
+    RATELIMIT_ENABLED=False,
+    RATELIMIT_CLIENT_HEADER=None,
+    RATELIMIT_TRUSTED_PROXIES=1,
+    RATELIMIT_MAX_CLIENTS=10000,
+    RATELIMIT_ENDPOINTS={
+        'GET productos': {'client_rate': 10, 'client_burst': 20, 'concurrency': 2, 'queue': 2,
+                          'wait': 1.0, 'latency': 2.0},
+        'productos_bulk': {'client_rate': 1, 'client_burst': 5, 'concurrency': 2, 'queue': 2, 'wait': 5.0},
+        'buscar_productos': {'client_rate': 20, 'client_burst': 40, 'concurrency': 2, 'queue': 2, 'wait': 1.0},
+        'GET producto_id': {'client_rate': 200, 'client_burst': 400},
+    },
+)
+
+class Recursos:
+    """Lo que cada app (ver create_app) arma a medida que lo necesita: pool,
+    escritor, caches, snapshot, difusor, mantenimiento y almacenamiento. Dos
+    apps del mismo proceso no comparten conexiones ni caches."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.writer = None
+        self.cache = None
+        self.cache_generation = 0
+        self.snapshot = None
+        self.difusor = None
+        self.mantenimiento = None
+        self.admision = None
+        self.stats_cache = None
+        self.stats_lock = threading.Lock()
+        self.reservas_idempotencia = itertools.count(1)
+        self.inicializadas = set()
+        self.repositorio = None
+        self.metricas = Metricas()
+        self.conexion_medida = self.metricas.clase_conexion()
+
+    def cerrar(self):
+        with self.lock:
+            if self.mantenimiento is not None:
+                self.mantenimiento.cerrar()
+                self.mantenimiento = None
+            if self.difusor is not None:
+                self.difusor.cerrar()
+                self.difusor = None
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
+
+def app_actual():
+    # Las funciones de acceso a la base tambien se usan fuera de una peticion
+    # (pruebas, serve.py, benchmarks): sin contexto van a la app del modulo
+    return current_app._get_current_object() if has_app_context() else app
+
+def recursos(aplicacion=None):
+    return (aplicacion or app_actual()).extensions['crud']
+
+class ProveedorJson(DefaultJSONProvider):
+    # El codificador se elige una vez, al crear el proveedor
+    def __init__(self, app):
+        super().__init__(app)
+        self.codificador = elegir_codificador(app.config['JSON_ENCODER'])
+        self.metricas = recursos(app).metricas
+
+    def codificar(self, obj):
+        if not self.metricas.activo():
+            return self.codificador.dumps(obj, default=self.default, sort_keys=self.sort_keys,
+                                          ensure_ascii=self.ensure_ascii)
+        inicio = time.perf_counter()
+        try:
+            return self.codificador.dumps(obj, default=self.default, sort_keys=self.sort_keys,
+                                          ensure_ascii=self.ensure_ascii)
+        finally:
+            self.metricas.acumular('serializacion', time.perf_counter() - inicio)
+
+    def dumps(self, obj, **kwargs):
+        return self.codificar(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return self.codificador.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.codificar(obj) + b'\n', mimetype=self.mimetype)
+
+def ruta_db():
+    # Se lee en cada uso: cambiar app.config['DATABASE'] (como hacen las
+    # pruebas, ver fixtures.py) lleva al pool, al escritor y al resto a la base nueva
+    return app_actual().config['DATABASE']
+
+def connection_pragmas():
+    config = app_actual().config
+    pragmas = {
+        'synchronous': config['DB_SYNCHRONOUS'],
+        'busy_timeout': config['DB_BUSY_TIMEOUT'],
+        'mmap_size': config['DB_MMAP_SIZE'],
+        'cache_size': config['DB_CACHE_SIZE'],
+    }
+    pragmas.update(config['DB_PRAGMAS'])
+    return pragmas
 
 def init_db():
-    with app.app_context():
-        db = sqlite3.connect(DATABASE)
-        db.execute('''CREATE TABLE IF NOT EXISTS productos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nombre TEXT NOT NULL,
-            precio REAL NOT NULL,
-            descripcion TEXT)''')
+    aplicacion = app_actual()
+    with aplicacion.app_context():
+        db = sqlite3.connect(ruta_db(), isolation_level=None)
+        # journal_mode queda guardado en el archivo; el resto es por conexion
+        db.execute(f"PRAGMA journal_mode = {aplicacion.config['DB_JOURNAL_MODE']}")
+        aplicar_migraciones(db)
+        db.close()
+
+def preparar_db():
+    # Cada base se inicializa (y actualiza su esquema) la primera vez que se usa
+    database = ruta_db()
+    inicializadas = recursos().inicializadas
+    if database not in inicializadas:
+        init_db()
+        inicializadas.add(database)
+
+def fabrica_conexion():
+    # Sin metricas ni log de lentas las conexiones son sqlite3.Connection
+    # normales y no pagan nada por la instrumentacion
+    config, estado = app_actual().config, recursos()
+    umbral = config['METRICS_SLOW_QUERY_MS']
+    estado.metricas.umbral_lentas = None if umbral is None else umbral / 1000
+    if config['METRICS_ENABLED'] or umbral is not None:
+        return estado.conexion_medida
+    return sqlite3.Connection
+
+def get_pool():
+    config, estado = app_actual().config, recursos()
+    factory = fabrica_conexion()
+    database = ruta_db()
+    with estado.lock:
+        # Si la base cambia (p. ej. en las pruebas) se crea un pool nuevo
+        if estado.pool is None or estado.pool.database != database or estado.pool.factory is not factory:
+            if estado.pool is not None:
+                estado.pool.close()
+            preparar_db()
+            estado.pool = ConnectionPool(database,
+                                         size=config['DB_POOL_SIZE'],
+                                         timeout=config['DB_POOL_TIMEOUT'],
+                                         pragmas=connection_pragmas(),
+                                         factory=factory,
+                                         cached_statements=config['DB_CACHED_STATEMENTS'])
+        return estado.pool
+
+def get_writer():
+    config, estado = app_actual().config, recursos()
+    database = ruta_db()
+    with estado.lock:
+        # Un escritor cuyo hilo termino por un error se reemplaza: la proxima
+        # escritura vuelve a intentar abrir la base
+        if estado.writer is None or estado.writer.database != database or not estado.writer.alive:
+            if estado.writer is not None:
+                estado.writer.close()
+            preparar_db()
+            estado.writer = WriteQueue(database,
+                                       pragmas=connection_pragmas(),
+                                       max_batch=config['DB_WRITE_BATCH'],
+                                       cached_statements=config['DB_CACHED_STATEMENTS'])
+        return estado.writer
+
+def get_cache():
+    config, estado = app_actual().config, recursos()
+    if config['CACHE_BACKEND'] is not None:
+        return config['CACHE_BACKEND']
+    with estado.lock:
+        if estado.cache is None:
+            estado.cache = LRUCache(max_entries=config['CACHE_MAX_ENTRIES'],
+                                    max_bytes=config['CACHE_MAX_BYTES'],
+                                    ttl=config['CACHE_TTL'])
+        return estado.cache
+
+def invalidar_cache(ids=()):
+    estado = recursos()
+    if estado.snapshot is not None:
+        estado.snapshot.pendiente = True
+    if estado.difusor is not None:
+        estado.difusor.avisar()
+    if not app_actual().config['CACHE_ENABLED']:
+        return
+    with estado.lock:
+        estado.cache_generation += 1
+    get_cache().invalidate(['lista'] + [f'producto:{id}' for id in ids])
+
+def get_snapshot():
+    estado = recursos()
+    database = ruta_db()
+    with estado.lock:
+        if estado.snapshot is None or estado.snapshot.database != database:
+            estado.snapshot = Snapshot(database, max_bytes=app_actual().config['SNAPSHOT_MAX_BYTES'])
+        return estado.snapshot
+
+def snapshot_sincronizado():
+    # Devuelve el snapshot al dia, o None si esta apagado o excedido
+    config = app_actual().config
+    if not config['SNAPSHOT_ENABLED'] or not usa_sqlite():
+        return None
+    snapshot = get_snapshot()
+    if not snapshot.activo:
+        return None
+    if (snapshot.pendiente or
+            time.monotonic() - snapshot.verificado >= config['SNAPSHOT_REFRESH_INTERVAL']):
+        if not snapshot.sincronizar(get_db()):
+            return None
+    return snapshot
+
+def get_difusor():
+    aplicacion, estado = app_actual(), recursos()
+    config = aplicacion.config
+    database = ruta_db()
+    with estado.lock:
+        if estado.difusor is None or estado.difusor.database != database:
+            if estado.difusor is not None:
+                estado.difusor.cerrar()
+            estado.difusor = Difusor(database, aplicacion.json.codificar,
+                                     intervalo=config['CHANGES_POLL_INTERVAL'],
+                                     capacidad=config['CHANGES_BUFFER'],
+                                     busy_timeout=config['DB_BUSY_TIMEOUT'])
+        return estado.difusor
+
+def get_mantenimiento():
+    aplicacion, estado = app_actual(), recursos()
+    config = aplicacion.config
+    database = ruta_db()
+    with estado.lock:
+        if estado.mantenimiento is None or estado.mantenimiento.database != database:
+            if estado.mantenimiento is not None:
+                estado.mantenimiento.cerrar()
+            # La tabla mantenimiento tiene que existir antes de reclamar tareas
+            preparar_db()
+            estado.mantenimiento = Mantenimiento(
+                database, pragmas={'busy_timeout': config['DB_BUSY_TIMEOUT']},
+                programa=config['MAINTENANCE_SCHEDULE'],
+                directorio=config['MAINTENANCE_BACKUP_DIR'],
+                conservar=config['MAINTENANCE_BACKUP_KEEP'],
+                opciones={'backup': {'paginas': config['MAINTENANCE_BACKUP_PAGES']},
+                          'incremental_vacuum': {'paginas': config['MAINTENANCE_VACUUM_PAGES']},
+                          'podar_cambios': {'max_edad': config['CHANGES_RETENTION'],
+                                            'max_filas': config['CHANGES_MAX_ROWS']}},
+                revision=config['MAINTENANCE_CHECK_INTERVAL'],
+                historial=config['MAINTENANCE_HISTORY'],
+                max_pendientes=config['MAINTENANCE_MAX_PENDING'],
+                al_terminar=functools.partial(registrar_trabajo, aplicacion))
+        return estado.mantenimiento
+
+def iniciar_mantenimiento():
+    # serve.py y asgi.py lo llaman al arrancar cada worker; sin tareas
+    # programadas el hilo arranca recien con el primer POST /admin/jobs
+    if app_actual().config['MAINTENANCE_SCHEDULE'] and usa_sqlite():
+        get_mantenimiento().iniciar()
+
+def registrar_trabajo(aplicacion, trabajo):
+    # Corre en el hilo de mantenimiento, sin contexto de app
+    if aplicacion.config['METRICS_ENABLED']:
+        metricas = recursos(aplicacion).metricas
+        metricas.contar('crud_maintenance_jobs_total', (('job', trabajo.tarea), ('result', trabajo.estado)))
+        metricas.observar('crud_maintenance_job_duration_seconds', trabajo.duracion, (('job', trabajo.tarea),))
+
+def get_repositorio():
+    return recursos().repositorio
+
+def usa_sqlite():
+    return isinstance(get_repositorio(), RepositorioSQLite)
+
+def crear_repositorio(aplicacion):
+    almacenamiento = aplicacion.config['STORAGE']
+    if callable(almacenamiento):
+        return almacenamiento(aplicacion)
+    if almacenamiento == 'sqlite':
+        return RepositorioSQLite(get_db, write, recursos(aplicacion).metricas)
+    if almacenamiento == 'memory':
+        return RepositorioMemoria()
+    raise ValueError(f'STORAGE desconocido: {almacenamiento!r}')
+
+def write(fn):
+    reserva = g.get('idempotencia') if has_request_context() else None
+    if reserva is not None:
+        if g.escrituras_confirmadas:
+            return g.escrituras_confirmadas.pop(0)
+        fn = idempotency.registrando(fn, *reserva)
+    if app_actual().config['DB_WRITE_QUEUE']:
+        inicio = time.perf_counter()
+        try:
+            return get_writer().execute(fn, app_actual().config['DB_WRITE_TIMEOUT'])
+        finally:
+            recursos().metricas.acumular('escritura', time.perf_counter() - inicio)
+    db = get_db()
+    try:
+        result = fn(db)
         db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return result
 
 def get_db():
-    return sqlite3.connect(DATABASE)
+    if not has_app_context():
+        return sqlite3.connect(ruta_db())
+    db = g.get('db')
+    if db is None:
+        pool = get_pool()
+        inicio = time.perf_counter()
+        db = g.db = pool.acquire()
+        recursos().metricas.acumular('pool', time.perf_counter() - inicio)
+        g.db_pool = pool
+    return db
+
+def release_db(exception):
+    db = g.pop('db', None)
+    if db is not None:
+        g.pop('db_pool').release(db)
+
+def iniciar_metricas():
+    if current_app.config['METRICS_ENABLED']:
+        g.inicio_peticion = time.perf_counter()
+        recursos().metricas.iniciar()
+
+def registrar_metricas(response):
+    inicio = g.pop('inicio_peticion', None)
+    if inicio is None:
+        return response
+    metricas = recursos().metricas
+    metricas.peticion(request.endpoint or 'ninguno', request.method, response.status_code,
+                      time.perf_counter() - inicio, metricas.terminar())
+    return response
+
+def servir_desde_cache():
+    if (not current_app.config['CACHE_ENABLED'] or request.method != 'GET'
+            or request.endpoint not in ('productos', 'producto_id')):
+        return None
+    if request.args.get('stream') in ('1', 'true') or acepta_ndjson():
+        return None
+    key = f'{request.path}?{request.query_string.decode()}'
+    cached = get_cache().get(key)
+    if cached is not None:
+        response = Response(cached.body, status=cached.status, mimetype=cached.mimetype,
+                            headers=cached.headers)
+        response.headers['X-Cache'] = 'HIT'
+        etag, _ = response.get_etag()
+        if etag and request.if_none_match.contains_weak(etag):
+            return no_modificado(response)
+        return response
+    if request.endpoint == 'productos':
+        tags = ('lista',)
+    else:
+        tags = (f"producto:{request.view_args['id']}",)
+    g.cache_entry = (key, tags, recursos().cache_generation)
+
+def guardar_en_cache(response):
+    entry = g.pop('cache_entry', None)
+    if entry is None or response.status_code != 200 or response.is_streamed:
+        return response
+    key, tags, generation = entry
+    # Si hubo una escritura durante la peticion la respuesta puede estar vieja
+    if generation == recursos().cache_generation:
+        headers = [(nombre, valor) for nombre, valor in response.headers.items()
+                   if nombre in ('ETag', 'Last-Modified', 'Cache-Control')]
+        get_cache().set(key, CachedResponse(response.get_data(), response.status_code,
+                                            response.mimetype, headers), tags)
+    response.headers['X-Cache'] = 'MISS'
+    return response
+
+def cliente_peticion(peticion, cabecera, saltos=1):
+    valor = peticion.headers.get(cabecera) if cabecera else None
+    # Cada proxy agrega al final la direccion de quien le hablo: la entrada
+    # que dejo el proxy mas lejano en el que confiamos es la del cliente. Las
+    # anteriores las puede inventar el cliente
+    entradas = [entrada.strip() for entrada in valor.split(',')] if valor else []
+    if saltos < 1 or len(entradas) < saltos or not entradas[-saltos]:
+        return peticion.environ.get('REMOTE_ADDR')
+    return entradas[-saltos]
+
+def get_admision():
+    config, estado = app_actual().config, recursos()
+    politicas = config['RATELIMIT_ENDPOINTS']
+    with estado.lock:
+        # Cambiar RATELIMIT_ENDPOINTS (otro dict) arma un control nuevo
+        if estado.admision is None or estado.admision.politicas is not politicas:
+            estado.admision = ratelimit.ControlAdmision(politicas, config['RATELIMIT_MAX_CLIENTS'])
+        return estado.admision
+
+def admitir_peticion():
+    config = current_app.config
+    if not config['RATELIMIT_ENABLED']:
+        return None
+    # Cada peticion pasa por aqui: el control se busca sin tomar el lock y
+    # los proxies de Flask se resuelven una sola vez
+    estado, peticion = recursos(), request._get_current_object()
+    control = estado.admision
+    if control is None or control.politicas is not config['RATELIMIT_ENDPOINTS']:
+        control = get_admision()
+    endpoint = peticion.endpoint
+    admision = control.buscar(peticion.method, endpoint)
+    if admision is None:
+        return None
+    metricas = estado.metricas
+    inicio = time.perf_counter()
+    resultado, reintentar = admision.admitir(cliente_peticion(peticion, config['RATELIMIT_CLIENT_HEADER'],
+                                                              config['RATELIMIT_TRUSTED_PROXIES']))
+    metricas.acumular('admision', time.perf_counter() - inicio)
+    if config['METRICS_ENABLED']:
+        metricas.contar('crud_admission_requests_total', (('endpoint', endpoint), ('result', resultado)))
+    if resultado != ratelimit.ADMITIDA:
+        if resultado in ratelimit.POR_TASA:
+            response = jsonify({"error": "Demasiadas peticiones; reintente mas tarde", "motivo": resultado})
+            response.status_code = 429
+        else:
+            response = jsonify({"error": "Servidor sobrecargado; reintente mas tarde", "motivo": resultado})
+            response.status_code = 503
+        response.headers['Retry-After'] = str(reintentar)
+        return response
+    # La latencia que compara la politica no incluye la espera en la cola
+    g.admision = (admision, time.perf_counter())
+
+def liberar_al_cerrar(response):
+    # Un stream ocupa su lugar hasta que el servidor cierra el cuerpo; el
+    # resto lo libera liberar_admision al terminar la peticion
+    if response.is_streamed and 'admision' in g:
+        admision, inicio = g.pop('admision')
+        response.call_on_close(lambda: admision.liberar(time.perf_counter() - inicio))
+    return response
+
+def liberar_admision(exception):
+    entrada = g.pop('admision', None)
+    if entrada is not None:
+        admision, inicio = entrada
+        admision.liberar(time.perf_counter() - inicio)
+
+IDEMPOTENTES = ('productos', 'producto_id', 'productos_bulk')
+
+def contar_idempotencia(resultado):
+    if current_app.config['METRICS_ENABLED']:
+        recursos().metricas.contar('crud_idempotency_requests_total', (('result', resultado),))
+
+def aplicar_idempotencia():
+    clave = request.headers.get('Idempotency-Key')
+    config = current_app.config
+    # Las claves se guardan en SQLite: con otro almacenamiento se ignoran
+    if (clave is None or not config['IDEMPOTENCY_ENABLED'] or request.method == 'GET'
+            or request.endpoint not in IDEMPOTENTES or not usa_sqlite()):
+        return None
+    if not 0 < len(clave) <= idempotency.MAX_LARGO:
+        return jsonify({"error": f"Idempotency-Key debe tener entre 1 y {idempotency.MAX_LARGO} caracteres"}), 400
+    firma = idempotency.huella(request.method, request.full_path, request.get_data())
+    ahora, ttl = time.time(), config['IDEMPOTENCY_TTL']
+    # Un reintento de una peticion ya completada se responde con una lectura
+    row = idempotency.buscar(get_db(), clave, ahora, ttl)
+    if row is None or row[1] is None:
+        podar = next(recursos().reservas_idempotencia) % config['IDEMPOTENCY_PRUNE_EVERY'] == 0
+
+        def tomar(db):
+            if podar:
+                idempotency.podar(db, ahora, ttl, config['IDEMPOTENCY_MAX_KEYS'])
+            ocupada = idempotency.reservar(db, clave, firma, ahora, ttl, config['IDEMPOTENCY_LOCK_TIMEOUT'])
+            return ocupada, None if ocupada else idempotency.escrituras(db, clave)
+
+        row, confirmadas = write(tomar)
+        if row is None:
+            contar_idempotencia('reanudada' if confirmadas else 'nueva')
+            g.idempotencia = (clave, firma)
+            # Escrituras que un intento anterior ya confirmo: write() las
+            # devuelve en orden sin volver a ejecutarlas
+            g.escrituras_confirmadas = confirmadas
+            return None
+    resultado = idempotency.resultado(row, firma)
+    contar_idempotencia(resultado)
+    if resultado == idempotency.DISTINTA:
+        return jsonify({"error": "Idempotency-Key ya usada con otra peticion"}), 422
+    if resultado == idempotency.EN_CURSO:
+        response = jsonify({"error": "La peticion original con esta Idempotency-Key sigue en curso"})
+        response.headers['Retry-After'] = '1'
+        return response, 409
+    response = Response(row[2], status=row[1], headers=idempotency.cabeceras_guardadas(row))
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def guardar_idempotencia(response):
+    reserva = g.pop('idempotencia', None)
+    if reserva is None:
+        return response
+    clave, firma = reserva
+    if 200 <= response.status_code < 300:
+        estado, cuerpo = response.status_code, response.get_data()
+        cabeceras = [(nombre, valor) for nombre, valor in response.headers.items()
+                     if nombre in idempotency.CABECERAS]
+        write(lambda db: idempotency.completar(db, clave, firma, estado, cuerpo, cabeceras))
+    else:
+        write(lambda db: idempotency.liberar(db, clave, firma))
+    return response
+
+def liberar_idempotencia(exception):
+    # Un error sin manejar no pasa por after_request: la clave queda libre
+    # para que el cliente reintente
+    reserva = g.pop('idempotencia', None)
+    if reserva is not None:
+        write(lambda db: idempotency.liberar(db, *reserva))
+
+def pool_agotado(error):
+    return jsonify({"error": "Servicio ocupado, intente de nuevo"}), 503
+
+def parse_listado(args):
+    config = app_actual().config
+    consulta = {'paginado': 'limit' in args or 'after' in args}
+    try:
+        limit = int(args.get('limit', config['PAGE_DEFAULT_LIMIT']))
+        after = int(args['after']) if args.get('after') else None
+        precio_min = float(args['precio_min']) if 'precio_min' in args else None
+        precio_max = float(args['precio_max']) if 'precio_max' in args else None
+    except ValueError:
+        raise ValueError('Parametros de consulta invalidos')
+    if limit < 1:
+        raise ValueError('limit debe ser mayor que 0')
+    consulta['limit'] = min(limit, config['PAGE_MAX_LIMIT'])
+    consulta['after'] = after
+
+    fields = args.get('fields')
+    if fields:
+        campos = tuple(campo.strip() for campo in fields.split(',') if campo.strip())
+        desconocidos = [campo for campo in campos if campo not in COLUMNAS]
+        if desconocidos or not campos:
+            raise ValueError(f"Campos desconocidos: {', '.join(desconocidos)}")
+    else:
+        campos = COLUMNAS
+    consulta['campos'] = campos
+    consulta['filtros'] = {'nombre': args.get('nombre') or None,
+                           'precio_min': precio_min, 'precio_max': precio_max}
+    return consulta
+
+def json_en_sql():
+    return app_actual().config['JSON_ROWS_SQL'] and JSON_SQL and usa_sqlite()
+
+def con_version(response, etag, actualizado=None):
+    response.set_etag(etag)
+    if actualizado is not None:
+        response.last_modified = datetime.fromtimestamp(actualizado, timezone.utc)
+    # Obliga al navegador a revalidar siempre con If-None-Match
+    response.cache_control.no_cache = True
+    return response
+
+def no_modificado(response):
+    vacia = Response(status=304)
+    for nombre in ('ETag', 'Last-Modified', 'Cache-Control'):
+        if nombre in response.headers:
+            vacia.headers[nombre] = response.headers[nombre]
+    return vacia
+
+def acepta_ndjson():
+    mejor = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return mejor == 'application/x-ndjson'
+
+def filas_sqlite(consulta, como_json):
+    # Genera listas de filas a medida que se leen. El generador se consume
+    # despues del teardown de la peticion, por eso toma su propia conexion del pool
+    sql, params, columnas = sql_listado(consulta, como_json)
+    chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+    pool = get_pool()
 
-@app.route('/')
+    def generar():
+        db = pool.acquire()
+        try:
+            cursor = db.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            pool.release(db)
+
+    return generar(), columnas
+
+def productos_repositorio(consulta):
+    # Sin SQLite el listado completo ya esta en memoria: se corta en chunks
+    productos, _ = get_repositorio().listar(consulta)
+    chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+    return (productos[i:i + chunk_size] for i in range(0, len(productos), chunk_size))
+
+def stream_productos(consulta, ndjson):
+    consulta = dict(consulta, paginado=False)
+    campos = consulta['campos']
+    como_json = json_en_sql()
+    if usa_sqlite():
+        chunks, columnas = filas_sqlite(consulta, como_json)
+        if not como_json:
+            chunks = (a_dicts(rows, campos, columnas) for rows in chunks)
+    else:
+        chunks = productos_repositorio(consulta)
+
+    def generar():
+        separador = '\n' if ndjson else ','
+        primero = True
+        if not ndjson:
+            yield '['
+        for rows in chunks:
+            if como_json:
+                chunk = separador.join([row[1] for row in rows])
+            else:
+                chunk = separador.join(json.dumps(producto) for producto in rows)
+            if ndjson:
+                chunk += '\n'
+            elif not primero:
+                chunk = ',' + chunk
+            primero = False
+            yield chunk
+        if not ndjson:
+            yield ']'
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(generar(), mimetype=mimetype)
+
+# Las vistas se registran en cada app que arma create_app, en este orden y
+# con el nombre de la funcion como endpoint
+RUTAS = []
+
+def ruta(regla, **opciones):
+    def registrar(vista):
+        RUTAS.append((regla, vista, opciones))
+        return vista
+    return registrar
+
+def requiere_sqlite(vista):
+    @functools.wraps(vista)
+    def envuelta(*args, **kwargs):
+        if not usa_sqlite():
+            return jsonify({"error": "No disponible con este almacenamiento"}), 501
+        return vista(*args, **kwargs)
+    return envuelta
+
+def requiere_admin(vista):
+    @functools.wraps(vista)
+    def envuelta(*args, **kwargs):
+        config = current_app.config
+        if not config['MAINTENANCE_API_ENABLED']:
+            return jsonify({"error": "No encontrado"}), 404
+        token = config['MAINTENANCE_TOKEN']
+        if not ((token and hmac.compare_digest(request.headers.get('X-Maintenance-Token', ''), token))
+                or request.remote_addr in config['MAINTENANCE_ALLOWED_IPS']):
+            return jsonify({"error": "No autorizado"}), 403
+        return vista(*args, **kwargs)
+    return envuelta
+
+@ruta('/metrics')
+def exportar_metricas():
+    config, estado = current_app.config, recursos()
+    if not config['METRICS_ENABLED']:
+        return jsonify({"error": "Metricas deshabilitadas"}), 404
+    extras = []
+    if usa_sqlite():
+        extras += desde_stats('crud_pool', get_pool().stats(), 'Pool de conexiones')
+    if estado.writer is not None:
+        extras += desde_stats('crud_writer', estado.writer.stats(), 'Cola de escritura')
+    if config['CACHE_ENABLED']:
+        extras += desde_stats('crud_cache', get_cache().stats(), 'Cache de respuestas')
+    if config['SNAPSHOT_ENABLED'] and usa_sqlite():
+        extras += desde_stats('crud_snapshot', get_snapshot().stats(), 'Snapshot del catalogo')
+    if estado.difusor is not None:
+        extras += desde_stats('crud_changes', estado.difusor.stats(), 'Feed de cambios')
+    if estado.stats_cache is not None:
+        extras += desde_stats('crud_stats_cache', estado.stats_cache.stats(), 'Cache de estadisticas')
+    if estado.admision is not None:
+        extras += desde_stats('crud_admission', estado.admision.stats(), 'Control de admision')
+    if estado.mantenimiento is not None:
+        extras += desde_stats('crud_maintenance', estado.mantenimiento.stats(), 'Mantenimiento')
+    return Response(estado.metricas.exportar(extras), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@ruta('/')
 def home():
     return render_template('index.html')
 
-@app.route('/productos', methods=['GET', 'POST'])
+@ruta('/productos', methods=['GET', 'POST'])
 def productos():
-    db = get_db()
+    repositorio = get_repositorio()
     if request.method == 'POST':
-        data = request.get_json()
-        db.execute('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
-                   [data['nombre'], data['precio'], data['descripcion']])
-        db.commit()
-        return jsonify({"mensaje": "Producto guardado correctamente"})
-    cursor = db.execute('SELECT * FROM productos')
-    productos = [dict(id=row[0], nombre=row[1], precio=row[2], descripcion=row[3]) for row in cursor.fetchall()]
-    return jsonify(productos)
+        id = repositorio.crear(request.get_json())
+        invalidar_cache()
+        response = jsonify({"mensaje": "Producto guardado correctamente", "id": id})
+        response.set_etag(f'p{id}-1')
+        response.headers['Location'] = f'/productos/{id}'
+        return response
+    try:
+        consulta = parse_listado(request.args)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    ndjson = acepta_ndjson()
+    streaming = ndjson or request.args.get('stream') in ('1', 'true')
+    snapshot = None
+    if not streaming and Snapshot.puede_listar(consulta):
+        snapshot = snapshot_sincronizado()
+    if snapshot is not None:
+        version, actualizado = snapshot.version, snapshot.actualizado
+    else:
+        # La version del catalogo basta para responder 304 sin leer filas
+        version, actualizado = repositorio.version()
+    etag = f'c{version}-nd' if ndjson else f'c{version}'
+    if request.if_none_match.contains_weak(etag):
+        return con_version(Response(status=304), etag, actualizado)
+    if streaming:
+        return con_version(stream_productos(consulta, ndjson), etag, actualizado)
+    if snapshot is not None:
+        productos, siguiente = snapshot.listar(consulta)
+    elif json_en_sql():
+        cuerpo, siguiente = repositorio.listar_json(consulta)
+        if consulta['paginado']:
+            cuerpo = f'{{"productos":{cuerpo},"next":{json.dumps(siguiente)}}}'
+        return con_version(Response(cuerpo, mimetype='application/json'), etag, actualizado)
+    else:
+        productos, siguiente = repositorio.listar(consulta)
+    if consulta['paginado']:
+        response = jsonify({"productos": productos, "next": siguiente})
+    else:
+        response = jsonify(productos)
+    return con_version(response, etag, actualizado)
 
-@app.route('/productos/<int:id>', methods=['GET', 'PUT', 'DELETE'])
-def producto_id(id):
+def validar_producto(item, con_id=False):
+    if not isinstance(item, dict):
+        return 'Se esperaba un objeto'
+    requeridos = ('id', 'nombre', 'precio', 'descripcion') if con_id else ('nombre', 'precio', 'descripcion')
+    faltantes = [campo for campo in requeridos if campo not in item]
+    if faltantes:
+        return f"Faltan campos: {', '.join(faltantes)}"
+    if con_id and (not isinstance(item['id'], int) or isinstance(item['id'], bool)):
+        return 'id invalido'
+    # Un tipo que SQLite no acepta (o un NULL en nombre) haria fallar el
+    # lote entero; se rechaza solo este elemento
+    if not isinstance(item['nombre'], str) or not item['nombre'].strip():
+        return 'nombre invalido'
+    if not isinstance(item['precio'], (int, float)) or isinstance(item['precio'], bool):
+        return 'precio invalido'
+    if item['descripcion'] is not None and not isinstance(item['descripcion'], str):
+        return 'descripcion invalida'
+    return None
+
+def leer_lote():
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise ValueError('Se esperaba una lista')
+    maximo = current_app.config['BULK_MAX_ITEMS']
+    if len(items) > maximo:
+        raise ValueError(f"Maximo {maximo} elementos por lote")
+    return items
+
+@ruta('/productos/bulk', methods=['POST', 'PUT', 'DELETE'])
+def productos_bulk():
+    try:
+        items = leer_lote()
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    repositorio = get_repositorio()
+    resultados = [None] * len(items)
+
+    if request.method == 'POST':
+        validos = []
+        for i, item in enumerate(items):
+            error = validar_producto(item)
+            if error:
+                resultados[i] = {"error": error}
+            else:
+                validos.append((i, item))
+
+        ids = repositorio.crear_lote([item for _, item in validos])
+        invalidar_cache()
+        for (i, _), id in zip(validos, ids):
+            resultados[i] = {"id": id}
+        return jsonify({"resultados": resultados, "creados": len(validos)})
+
+    if request.method == 'PUT':
+        validos = []
+        for i, item in enumerate(items):
+            error = validar_producto(item, con_id=True)
+            if error:
+                resultados[i] = {"error": error}
+            else:
+                validos.append((i, item))
+
+        existentes = repositorio.actualizar_lote([item for _, item in validos])
+        invalidar_cache(existentes)
+        actualizados = 0
+        for i, item in validos:
+            if item['id'] in existentes:
+                resultados[i] = {"id": item['id']}
+                actualizados += 1
+            else:
+                resultados[i] = {"id": item['id'], "error": "Producto no encontrado"}
+        return jsonify({"resultados": resultados, "actualizados": actualizados})
+
+    validos = []
+    for i, item in enumerate(items):
+        if isinstance(item, int) and not isinstance(item, bool):
+            validos.append((i, item))
+        else:
+            resultados[i] = {"error": "id invalido"}
+
+    existentes = repositorio.eliminar_lote([id for _, id in validos])
+    invalidar_cache(existentes)
+    for i, id in validos:
+        resultados[i] = {"id": id} if id in existentes else {"id": id, "error": "Producto no encontrado"}
+    return jsonify({"resultados": resultados, "eliminados": len(existentes)})
+
+def consulta_fts(texto):
+    # Cada palabra se busca como termino literal (entre comillas); un '*'
+    # final la convierte en prefijo. No se agrega por defecto porque un
+    # prefijo obliga a FTS5 a leer la lista completa de documentos del termino
+    terminos = []
+    for palabra in texto.split():
+        prefijo = palabra.endswith('*')
+        palabra = palabra.rstrip('*').replace('"', '""')
+        if palabra:
+            terminos.append(f'"{palabra}"*' if prefijo else f'"{palabra}"')
+    return ' '.join(terminos) or None
+
+def leer_seq(valor):
+    if valor is None:
+        return None
+    seq = int(valor)
+    if seq < 0:
+        raise ValueError('since debe ser mayor o igual a 0')
+    return seq
+
+@ruta('/productos/changes')
+@requiere_sqlite
+def cambios_productos():
+    try:
+        since = leer_seq(request.args.get('since'))
+        limit = min(int(request.args.get('limit', current_app.config['CHANGES_MAX_LIMIT'])),
+                    current_app.config['CHANGES_MAX_LIMIT'])
+        if limit < 1:
+            raise ValueError('limit debe ser mayor que 0')
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
     db = get_db()
+    # Sin since solo se informa el punto de partida: el cliente lo guarda,
+    # carga el listado y despues pide los cambios desde ahi
+    if since is None:
+        return jsonify({"cambios": [], "next": ultimo_seq(db), "mas": False})
+    try:
+        cambios = leer_cambios(db, since, limit + 1)
+    except CambiosPerdidos:
+        return jsonify({"error": "Los cambios pedidos ya no estan disponibles; recargue el listado",
+                        "next": ultimo_seq(db)}), 410
+    mas = len(cambios) > limit
+    cambios = cambios[:limit]
+    return jsonify({"cambios": cambios, "next": cambios[-1]['seq'] if cambios else since, "mas": mas})
+
+@ruta('/productos/changes/stream')
+@requiere_sqlite
+def stream_cambios():
+    # EventSource reconecta mandando el ultimo id recibido en Last-Event-ID
+    try:
+        since = leer_seq(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    if since is None:
+        since = ultimo_seq(get_db())
+    # asgi.py marca las peticiones cuyo cuerpo puede recorrer sin hilos
+    asincrono = request.environ.get('crud.async', False)
+    limite = current_app.config['CHANGES_MAX_SUBSCRIBERS' if asincrono else 'CHANGES_MAX_STREAMS']
+    difusor = get_difusor()
+    if not difusor.reservar(not asincrono, limite):
+        response = jsonify({"error": "Demasiados streams abiertos, intente de nuevo"})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    # Igual que en stream_productos el cuerpo se consume tras el teardown:
+    # se toma una conexion del pool solo mientras se lee SQLite
+    pool = get_pool()
+    limit = current_app.config['CHANGES_MAX_LIMIT']
+
+    def leer(seq):
+        db = pool.acquire()
+        try:
+            return leer_cambios(db, seq, limit)
+        finally:
+            pool.release(db)
+
+    stream = StreamCambios(difusor, leer, since, not asincrono,
+                           latido=current_app.config['CHANGES_HEARTBEAT'],
+                           duracion=current_app.config['CHANGES_STREAM_MAX_AGE'])
+    if asincrono:
+        request.environ['crud.async_body'] = stream.asincrono
+    response = Response(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Evita que un proxy (nginx) acumule los eventos
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def get_stats_cache():
+    estado = recursos()
+    with estado.lock:
+        if estado.stats_cache is None:
+            # La clave lleva la version del catalogo: nunca queda vieja y el
+            # TTL no hace falta
+            estado.stats_cache = LRUCache(max_entries=current_app.config['STATS_CACHE_ENTRIES'], ttl=float('inf'))
+        return estado.stats_cache
+
+def leer_percentiles(valor):
+    if valor is None:
+        return tuple(current_app.config['STATS_PERCENTILES'])
+    percentiles = tuple(float(p) for p in valor.split(',') if p.strip())
+    if any(not 0 <= p <= 100 for p in percentiles):
+        raise ValueError('Los percentiles deben estar entre 0 y 100')
+    return percentiles
+
+@ruta('/productos/stats')
+@requiere_sqlite
+def estadisticas_productos():
+    try:
+        ancho = float(request.args['width']) if request.args.get('width') else None
+        if ancho is not None and not 0 < ancho < float('inf'):
+            raise ValueError('width debe ser un numero mayor que 0')
+        percentiles = leer_percentiles(request.args.get('percentiles'))
+    except (ValueError, OverflowError) as error:
+        return jsonify({"error": str(error)}), 400
+    nombre = request.args.get('nombre') or None
+    db = get_db()
+    version, actualizado = version_catalogo(db)
+    etag = f's{version}'
+    if request.if_none_match.contains_weak(etag):
+        return con_version(Response(status=304), etag, actualizado)
+    cache = get_stats_cache()
+    clave = (ruta_db(), version, nombre, ancho, percentiles)
+    guardada = cache.get(clave)
+    if guardada is None:
+        # Tras una escritura, las peticiones simultaneas esperan al primer
+        # calculo en lugar de repetirlo
+        with recursos().stats_lock:
+            guardada = cache.get(clave)
+            if guardada is None:
+                condiciones, params = filtro_nombre(nombre)
+                try:
+                    resultado = calcular(db, ancho, percentiles, condiciones, params,
+                                         buckets=current_app.config['STATS_DEFAULT_BUCKETS'],
+                                         max_buckets=current_app.config['STATS_MAX_BUCKETS'])
+                except ValueError as error:
+                    return jsonify({"error": str(error)}), 400
+                except OverflowError:
+                    return jsonify({"error": "width demasiado chico para el rango de precios"}), 400
+                guardada = CachedResponse(current_app.json.codificar(resultado), 200, 'application/json')
+                cache.set(clave, guardada)
+    return con_version(Response(guardada.body, mimetype=guardada.mimetype), etag, actualizado)
+
+@ruta('/productos/search')
+@requiere_sqlite
+def buscar_productos():
+    consulta = consulta_fts(request.args.get('q', ''))
+    if consulta is None:
+        return jsonify({"error": "Falta el parametro q"}), 400
+    try:
+        limit = min(int(request.args.get('limit', current_app.config['SEARCH_DEFAULT_LIMIT'])),
+                    current_app.config['SEARCH_MAX_LIMIT'])
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "Parametros de consulta invalidos"}), 400
+    if limit < 1 or offset < 0:
+        return jsonify({"error": "Parametros de consulta invalidos"}), 400
+
+    db = get_db()
+    ventana = current_app.config['SEARCH_RANK_WINDOW']
+    try:
+        # Fase 1: ids ordenados por relevancia. Con SEARCH_RANK_WINDOW solo se
+        # ordenan las `ventana` coincidencias mas recientes (aproximado)
+        filtro, params, truncado = '', [consulta], False
+        if ventana:
+            corte = db.execute('''SELECT rowid FROM productos_fts WHERE productos_fts MATCH ?
+                ORDER BY rowid DESC LIMIT 1 OFFSET ?''', [consulta, ventana]).fetchone()
+            if corte is not None:
+                filtro, params, truncado = ' AND rowid > ?', [consulta, corte[0]], True
+        ids = [row[0] for row in db.execute(
+            f'SELECT rowid FROM productos_fts WHERE productos_fts MATCH ?{filtro} ORDER BY rank LIMIT ? OFFSET ?',
+            params + [limit + 1, offset])]
+    except sqlite3.OperationalError as error:
+        if 'no such table' in str(error):
+            return jsonify({"error": "Busqueda no disponible"}), 501
+        raise
+    siguiente = offset + limit if len(ids) > limit else None
+    ids = ids[:limit]
+    if not ids:
+        return jsonify({"resultados": [], "next": None, "truncado": truncado})
+
+    # Fase 2: datos y fragmentos resaltados solo de la pagina pedida. Con
+    # rowid IN (...) FTS5 busca cada id por separado, asi highlight() y
+    # snippet() corren sobre la pagina y no sobre todas las coincidencias
+    marcas = ', '.join('?' * len(ids))
+    filas = {row[0]: row for row in db.execute(f'''SELECT p.id, p.nombre, p.precio, p.descripcion,
+               highlight(productos_fts, 0, '<mark>', '</mark>'),
+               snippet(productos_fts, 1, '<mark>', '</mark>', '…', 12)
+        FROM productos_fts JOIN productos p ON p.id = productos_fts.rowid
+        WHERE productos_fts MATCH ? AND productos_fts.rowid IN ({marcas})''',
+        [consulta] + ids)}
+    resultados = [dict(id=row[0], nombre=row[1], precio=row[2], descripcion=row[3],
+                       resaltado=dict(nombre=row[4], descripcion=row[5]))
+                  for row in (filas[id] for id in ids if id in filas)]
+    return jsonify({"resultados": resultados, "next": siguiente, "truncado": truncado})
+
+@ruta('/productos/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+def producto_id(id):
+    repositorio = get_repositorio()
     if request.method == 'GET':
-        cursor = db.execute('SELECT * FROM productos WHERE id = ?', [id])
-        row = cursor.fetchone()
+        snapshot = snapshot_sincronizado()
+        if snapshot is not None:
+            row = snapshot.obtener(id)
+        else:
+            row = repositorio.obtener(id)
         if row:
-            return jsonify(dict(id=row[0], nombre=row[1], precio=row[2], descripcion=row[3]))
+            etag = f'p{row.id}-{row.version}'
+            if request.if_none_match.contains_weak(etag):
+                return con_version(Response(status=304), etag)
+            return con_version(jsonify(row.datos()), etag)
         else:
             return jsonify({"error": "Producto no encontrado"}), 404
 
-    elif request.method == 'PUT':
-        data = request.get_json()
-        db.execute('UPDATE productos SET nombre = ?, precio = ?, descripcion = ? WHERE id = ?',
-                   [data['nombre'], data['precio'], data['descripcion'], id])
-        db.commit()
-        return jsonify({"mensaje": "Producto actualizado"})
+    versiones = versiones_if_match(id)
+    if versiones is None and current_app.config['WRITE_REQUIRE_IF_MATCH']:
+        return jsonify({"error": "Se requiere If-Match con el ETag del producto"}), 428
+
+    if request.method == 'PUT':
+        try:
+            version = repositorio.actualizar(id, request.get_json(), versiones)
+        except VersionDistinta as error:
+            return precondicion_fallida(id, error.version)
+        invalidar_cache([id])
+        response = jsonify({"mensaje": "Producto actualizado"})
+        if version is not None:
+            response.set_etag(f'p{id}-{version}')
+        return response
 
     elif request.method == 'DELETE':
-        db.execute('DELETE FROM productos WHERE id = ?', [id])
-        db.commit()
+        try:
+            repositorio.eliminar(id, versiones)
+        except VersionDistinta as error:
+            return precondicion_fallida(id, error.version)
+        invalidar_cache([id])
         return jsonify({"mensaje": "Producto eliminado"})
 
+def versiones_if_match(id):
+    """None sin If-Match; '*' para ``If-Match: *``; si no, las versiones del
+    producto que acepta el cliente. Se aceptan ETags debiles porque la
+    compresion los marca asi (ver compression.py)."""
+    if_match = request.if_match
+    if not if_match:
+        return None
+    if if_match.star_tag:
+        return '*'
+    versiones = set()
+    for etag in if_match.as_set(include_weak=True):
+        prefijo, _, version = etag.rpartition('-')
+        if prefijo == f'p{id}' and version.isdigit():
+            versiones.add(int(version))
+    return versiones
+
+def precondicion_fallida(id, version):
+    if version is None:
+        response = jsonify({"error": "Producto no encontrado"})
+    else:
+        response = jsonify({"error": "El producto cambio; vuelva a leerlo", "version": version})
+        response.set_etag(f'p{id}-{version}')
+    return response, 412
+
+@ruta('/admin/jobs', methods=['GET', 'POST'])
+@requiere_admin
+@requiere_sqlite
+def trabajos_mantenimiento():
+    if request.method == 'GET':
+        # Crear el Mantenimiento no arranca su hilo
+        trabajos = get_mantenimiento().trabajos()
+        return jsonify({"trabajos": [trabajo.como_dict() for trabajo in trabajos]})
+    datos = request.get_json(silent=True)
+    if not isinstance(datos, dict) or not isinstance(datos.get('tarea'), str):
+        return jsonify({"error": 'Se espera {"tarea": ..., "opciones": {...}}'}), 400
+    try:
+        trabajo = get_mantenimiento().encolar(datos['tarea'], datos.get('opciones') or {})
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    except ColaLlena as error:
+        return jsonify({"error": str(error)}), 503, {'Retry-After': '60'}
+    response = jsonify(trabajo.como_dict())
+    response.headers['Location'] = f'/admin/jobs/{trabajo.id}'
+    return response, 202
+
+@ruta('/admin/jobs/<int:id>')
+@requiere_admin
+@requiere_sqlite
+def trabajo_mantenimiento(id):
+    trabajo = get_mantenimiento().trabajo(id)
+    if trabajo is None:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+    return jsonify(trabajo.como_dict())
+
+def create_app(config=None):
+    """Arma una app con su propia configuracion y sus propios recursos.
+
+    La configuracion sale de CONFIGURACION, despues de las variables CRUD_*
+    del entorno (p. ej. CRUD_DB_POOL_SIZE=16; CRUD_DATABASE fija la base) y
+    por ultimo de ``config``."""
+    aplicacion = Flask(__name__)
+    aplicacion.config.update(CONFIGURACION)
+    aplicacion.config.from_prefixed_env('CRUD')
+    aplicacion.config.setdefault('DATABASE', os.path.join(os.path.dirname(__file__), 'productos.db'))
+    if config:
+        aplicacion.config.update(config)
+
+    estado = aplicacion.extensions['crud'] = Recursos()
+    estado.repositorio = crear_repositorio(aplicacion)
+    aplicacion.json = ProveedorJson(aplicacion)
+    # La compresion queda dentro del perfilado para que su costo aparezca en el perfil
+    aplicacion.wsgi_app = ProfilingMiddleware(
+        CompressionMiddleware(aplicacion.wsgi_app, aplicacion.config, estado.metricas), aplicacion.config)
+
+    aplicacion.teardown_appcontext(release_db)
+    # Las metricas van antes que el cache: la medicion empieza antes de
+    # buscar en el cache y termina despues de guardar la respuesta. La
+    # admision va entre ambos, asi los rechazos tambien se miden
+    for hook in (iniciar_metricas, admitir_peticion, servir_desde_cache, aplicar_idempotencia):
+        aplicacion.before_request(hook)
+    for hook in (registrar_metricas, guardar_en_cache, guardar_idempotencia, liberar_al_cerrar):
+        aplicacion.after_request(hook)
+    for hook in (liberar_idempotencia, liberar_admision):
+        aplicacion.teardown_request(hook)
+    for error in (PoolTimeout, WriteTimeout, WriterClosed):
+        aplicacion.register_error_handler(error, pool_agotado)
+    for regla, vista, opciones in RUTAS:
+        aplicacion.add_url_rule(regla, view_func=vista, **opciones)
+    return aplicacion
+
+app = create_app()
+
 if __name__ == '__main__':
     init_db()
-    app.run(debug=True)
\ No newline at end of file
+    iniciar_mantenimiento()
+    app.run(debug=True)
@@ -0,0 +1,162 @@
+"""Compara el servidor WSGI (werkzeug con hilos) contra el modo ASGI (uvicorn).
+
+Uso: python bench_asgi.py [--rows 10000] [--duration 5] [--concurrency 10 100 1000]
+
+Levanta cada servidor en un subproceso sobre la misma base temporal y lo
+carga con N clientes concurrentes haciendo GET /productos/<id> (keep-alive
+cuando el servidor lo permite).
+Reporta peticiones por segundo y latencias p50/p95/p99.
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def servir(modo, port, database):
+    import backend
+    backend.app.config['DATABASE'] = database
+    backend.init_db()
+    if modo == 'wsgi':
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class Handler(WSGIRequestHandler):
+            # Sin log por peticion, igual que uvicorn con log_level=error
+            def log_request(self, *args, **kwargs):
+                pass
+
+        make_server('127.0.0.1', port, backend.app, threaded=True,
+                    request_handler=Handler).serve_forever()
+    else:
+        import uvicorn
+        from asgi import AsgiAdapter
+        uvicorn.run(AsgiAdapter(backend.app, on_startup=backend.init_db),
+                    host='127.0.0.1', port=port, log_level='error', backlog=4096)
+
+
+async def esperar_puerto(port, timeout=15.0):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f'El servidor no abrio el puerto {port}')
+
+
+async def peticion(reader, writer, path):
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    await writer.drain()
+    cabeceras = await reader.readuntil(b'\r\n\r\n')
+    estado = int(cabeceras.split(b' ', 2)[1])
+    longitud, cerrar = 0, False
+    for linea in cabeceras.lower().split(b'\r\n'):
+        if linea.startswith(b'content-length:'):
+            longitud = int(linea.split(b':', 1)[1])
+        elif linea == b'connection: close':
+            cerrar = True
+    await reader.readexactly(longitud)
+    return estado, cerrar
+
+
+async def cliente(port, rows, fin, latencias, errores):
+    # El servidor de desarrollo de werkzeug cierra la conexion tras cada
+    # respuesta (HTTP/1.0); en ese caso se mide tambien la reconexion
+    writer = None
+    try:
+        while time.monotonic() < fin:
+            inicio = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            estado, cerrar = await peticion(reader, writer, f'/productos/{random.randint(1, rows)}')
+            latencias.append(time.perf_counter() - inicio)
+            if estado != 200:
+                errores.append(estado)
+            if cerrar:
+                writer.close()
+                writer = None
+    except (OSError, asyncio.IncompleteReadError) as error:
+        errores.append(type(error).__name__)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def cargar(port, rows, concurrencia, duracion):
+    latencias, errores = [], []
+    fin = time.monotonic() + duracion
+    await asyncio.gather(*(cliente(port, rows, fin, latencias, errores) for _ in range(concurrencia)))
+    return latencias, errores
+
+
+def percentil(valores, p):
+    return statistics.quantiles(valores, n=100)[p - 1] if len(valores) > 1 else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--serve', choices=['wsgi', 'asgi'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        servir(args.serve, args.port, args.db)
+        return
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    db = sqlite3.connect(path)
+    db.execute('''CREATE TABLE productos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT NOT NULL,
+        precio REAL NOT NULL,
+        descripcion TEXT)''')
+    db.executemany('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
+                   ((f'Vehiculo {i}', 10000.0 + i, 'Modelo') for i in range(args.rows)))
+    db.commit()
+    db.close()
+
+    print(f"{'servidor':<8}{'conexiones':>11}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errores':>9}")
+    try:
+        for modo in ('wsgi', 'asgi'):
+            port = puerto_libre()
+            servidor = subprocess.Popen([sys.executable, __file__, '--serve', modo,
+                                         '--port', str(port), '--db', path])
+            try:
+                asyncio.run(esperar_puerto(port))
+                for concurrencia in args.concurrency:
+                    latencias, errores = asyncio.run(cargar(port, args.rows, concurrencia, args.duration))
+                    ms = [l * 1000 for l in latencias]
+                    print(f'{modo:<8}{concurrencia:>11}{len(latencias) / args.duration:>10.0f}'
+                          f'{percentil(ms, 50):>9.1f}{percentil(ms, 95):>9.1f}{percentil(ms, 99):>9.1f}'
+                          f'{len(errores):>9}')
+            finally:
+                servidor.terminate()
+                servidor.wait()
+    finally:
+        for sufijo in ('', '-wal', '-shm'):
+            if os.path.exists(path + sufijo):
+                os.unlink(path + sufijo)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Mide razon de compresion y costo de CPU por algoritmo y nivel sobre
+respuestas reales de GET /productos, para elegir COMPRESSION_LEVELS.
+
+Uso: python bench_compression.py [--rows 100000] [--limit 1000] [--repeat 5]
+
+Para cada algoritmo disponible (gzip; br y zstd si estan instalados) y cada
+nivel reporta el tamaño comprimido, la razon, los ms por respuesta y el
+throughput de entrada. La primera fila es la respuesta sin comprimir.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import backend
+from benchmark import sembrar
+from compression import ALGORITMOS
+
+NIVELES = {'gzip': (1, 3, 6, 9), 'br': (1, 4, 6, 9), 'zstd': (1, 3, 6, 12)}
+
+
+def medir(algoritmo, nivel, cuerpo, repeticiones):
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.thread_time()
+        comprimido = ALGORITMOS[algoritmo](nivel).final(cuerpo)
+        mejor = min(mejor, time.thread_time() - inicio)
+    return mejor, len(comprimido)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--limit', type=int, default=1000,
+                        help='tamaño de pagina medido; 0 mide el listado completo')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(path)
+    sembrar(path, args.rows)
+    backend.app.config['DATABASE'] = path
+    backend.app.config['COMPRESSION_ENABLED'] = False
+    try:
+        ruta = f'/productos?limit={args.limit}' if args.limit else '/productos'
+        cuerpo = backend.app.test_client().get(ruta).get_data()
+        print(f'{ruta}: {len(cuerpo) / 1024:.1f} KiB sin comprimir\n')
+        print(f"{'algoritmo':<10}{'nivel':>6}{'KiB':>10}{'razon':>8}{'ms':>9}{'MB/s':>9}")
+        for algoritmo in ALGORITMOS:
+            for nivel in NIVELES[algoritmo]:
+                segundos, tamano = medir(algoritmo, nivel, cuerpo, args.repeat)
+                print(f'{algoritmo:<10}{nivel:>6}{tamano / 1024:>10.1f}{len(cuerpo) / tamano:>8.1f}'
+                      f'{segundos * 1000:>9.2f}{len(cuerpo) / segundos / 1e6:>9.0f}')
+    finally:
+        for sufijo in ('', '-wal', '-shm'):
+            if os.path.exists(path + sufijo):
+                os.unlink(path + sufijo)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Costo por llamada de GET /productos/<id>, capa por capa.
+
+Uso: python bench_detalle.py [--rows 10000] [--calls 20000] [--repeat 5] [--variants 256]
+
+Cada linea hace --calls llamadas (lecturas de ids al azar, salvo en los
+listados) y reporta el mejor de --repeat intentos, en microsegundos por
+llamada:
+  - sqlite: execute + fetchone en una conexion, con el cache de sentencias
+    configurado (DB_CACHED_STATEMENTS) y sin cache (cached_statements=0,
+    que compila la sentencia en cada llamada);
+  - fila -> dict: armar el dict de la respuesta desde la tupla, por indice
+    como antes o con Producto.datos();
+  - repositorio: RepositorioSQLite.obtener con la conexion de la peticion;
+  - vista: la peticion entera contra la app WSGI (sin el cliente de pruebas
+    de Flask, que agrega mas que la propia vista);
+  - listados: --variants paginas de listado con textos SQL distintos (orden
+    de los campos, JSON armado en SQLite o no, con o sin cursor), en ronda,
+    con el cache por defecto de sqlite3 (128) y con el configurado. Las que
+    no entran en el cache se vuelven a compilar en cada uso.
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import backend
+from benchmark import sembrar
+from repository import COLUMNAS, OBTENER, Producto, sql_listado
+
+
+def medir(fn, ids, repeticiones):
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        for id in ids:
+            fn(id)
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor / len(ids) * 1e6
+
+
+def listados():
+    """(sql, params) de paginas de 20 filas, cada una con un texto distinto."""
+    ordenes = [orden for largo in range(1, len(COLUMNAS) + 1)
+               for orden in itertools.permutations(COLUMNAS, largo)]
+    sin_filtros = {'nombre': None, 'precio_min': None, 'precio_max': None}
+    for como_json, after in itertools.product((False, True), (None, 100)):
+        for campos in ordenes:
+            consulta = {'campos': campos, 'after': after, 'limit': 20, 'paginado': True, 'filtros': sin_filtros}
+            sql, params, _ = sql_listado(consulta, como_json)
+            yield sql, params
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--variants', type=int, default=256, help='textos SQL distintos de listado')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(path)
+    sembrar(path, args.rows)
+    app = backend.create_app({'DATABASE': path})
+    rng = random.Random(0)
+    ids = [rng.randint(1, args.rows) for _ in range(args.calls)]
+    resultados = []
+    try:
+        for cache in (app.config['DB_CACHED_STATEMENTS'], 0):
+            db = sqlite3.connect(path, cached_statements=cache)
+            resultados.append((f'sqlite (cached_statements={cache})',
+                               medir(lambda id: db.execute(OBTENER, (id,)).fetchone(), ids, args.repeat)))
+            db.close()
+
+        db = sqlite3.connect(path)
+        filas = {id: db.execute(OBTENER, (id,)).fetchone() for id in set(ids)}
+        db.close()
+        resultados.append(('fila -> dict por indice', medir(
+            lambda id: (lambda row: dict(id=row[0], nombre=row[1], precio=row[2], descripcion=row[3]))(filas[id]),
+            ids, args.repeat)))
+        resultados.append(('fila -> Producto.datos()', medir(
+            lambda id: Producto._make(filas[id]).datos(), ids, args.repeat)))
+
+        with app.app_context():
+            repositorio = backend.get_repositorio()
+            resultados.append(('repositorio.obtener', medir(repositorio.obtener, ids, args.repeat)))
+
+        entornos = {}
+
+        def vista(id):
+            entorno = entornos.get(id)
+            if entorno is None:
+                entorno = entornos[id] = {
+                    'REQUEST_METHOD': 'GET', 'PATH_INFO': f'/productos/{id}', 'QUERY_STRING': '',
+                    'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                    'wsgi.url_scheme': 'http', 'wsgi.input': None, 'wsgi.errors': None,
+                }
+            cuerpo = app.wsgi_app(dict(entorno), lambda estado, cabeceras, exc_info=None: None)
+            b''.join(cuerpo)
+            if hasattr(cuerpo, 'close'):
+                cuerpo.close()
+
+        vista(ids[0])
+        resultados.append(('vista GET /productos/<id>', medir(vista, ids, args.repeat)))
+
+        sentencias = list(itertools.islice(listados(), args.variants))
+        ronda = [i % len(sentencias) for i in range(args.calls)]
+        for cache in (128, app.config['DB_CACHED_STATEMENTS']):
+            db = sqlite3.connect(path, cached_statements=cache)
+            resultados.append((f'{len(sentencias)} listados (cached_statements={cache})', medir(
+                lambda i: db.execute(*sentencias[i]).fetchall(), ronda, args.repeat)))
+            db.close()
+    finally:
+        backend.recursos(app).cerrar()
+        for sufijo in ('', '-wal', '-shm'):
+            if os.path.exists(path + sufijo):
+                os.unlink(path + sufijo)
+
+    print(f"{'capa':<36}{'us/llamada':>12}")
+    for nombre, micros in resultados:
+        print(f'{nombre:<36}{micros:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
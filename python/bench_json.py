@@ -0,0 +1,68 @@
+"""Mide filas codificadas por segundo en GET /productos segun el codificador
+JSON y el camino de armado de filas.
+
+Uso: python bench_json.py [--rows 100000] [--repeat 5] [--limit N]
+
+Combinaciones: codificador (json / orjson si esta instalado) x filas armadas
+en Python (un dict por fila + jsonify) o en SQLite (json_object). La primera
+fila del reporte es el camino original (json + dicts).
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import backend
+from benchmark import sembrar
+from encoding import CODIFICADORES, JSON_SQL
+
+
+def medir(client, path, repeticiones):
+    client.get(path)  # calentamiento: pool, cache de paginas de SQLite
+    mejor = float('inf')
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        response = client.get(path)
+        response.get_data()
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor, len(response.get_data())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--limit', type=int, help='medir una pagina de este tamano en vez del listado completo')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(path)
+    sembrar(path, args.rows)
+    backend.app.config['DATABASE'] = path
+    app = backend.app
+    ruta = f'/productos?limit={args.limit}' if args.limit else '/productos'
+    filas = min(args.limit or args.rows, args.rows)
+
+    combinaciones = [(nombre, False) for nombre in CODIFICADORES]
+    if JSON_SQL:
+        combinaciones += [(nombre, True) for nombre in CODIFICADORES]
+    print(f"{'codificador':<12}{'filas en':<10}{'ms':>9}{'filas/s':>12}{'MB':>7}{'mejora':>8}")
+    base = None
+    try:
+        for nombre, en_sql in combinaciones:
+            app.config['JSON_ENCODER'] = nombre
+            app.config['JSON_ROWS_SQL'] = en_sql
+            app.json = backend.ProveedorJson(app)
+            segundos, tamano = medir(app.test_client(), ruta, args.repeat)
+            base = base or segundos
+            print(f"{nombre:<12}{'sqlite' if en_sql else 'python':<10}{segundos * 1000:>9.1f}"
+                  f'{filas / segundos:>12,.0f}{tamano / 1e6:>7.1f}{base / segundos:>7.1f}x')
+    finally:
+        for sufijo in ('', '-wal', '-shm'):
+            if os.path.exists(path + sufijo):
+                os.unlink(path + sufijo)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Compara GET /productos normal contra el modo streaming (JSON y NDJSON).
+
+Uso: python bench_streaming.py [--rows 1000000]
+
+Mide tiempo hasta el primer byte, tiempo total y pico de memoria
+(tracemalloc) de cada modo sobre una base temporal con N filas.
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+import backend
+
+
+def sembrar(path, rows):
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('''CREATE TABLE IF NOT EXISTS productos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT NOT NULL,
+        precio REAL NOT NULL,
+        descripcion TEXT)''')
+    db.executemany('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
+                   ((f'Vehiculo {i}', 10000.0 + i, f'Modelo {i % 50}') for i in range(rows)))
+    db.commit()
+    db.close()
+
+
+def medir(client, url, headers=None):
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    response = client.get(url, headers=headers, buffered=False)
+    primer_byte = None
+    total_bytes = 0
+    for chunk in response.response:
+        if primer_byte is None:
+            primer_byte = time.perf_counter() - inicio
+        total_bytes += len(chunk)
+    total = time.perf_counter() - inicio
+    response.close()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'ttfb_s': primer_byte, 'total_s': total, 'peak_mb': pico / 2 ** 20,
+            'bytes': total_bytes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    original = backend.app.config['DATABASE']
+    backend.app.config['DATABASE'] = path
+    try:
+        sembrar(path, args.rows)
+        backend.init_db()
+        client = backend.app.test_client()
+        modos = [
+            ('lista (jsonify)', '/productos', None),
+            ('stream JSON', '/productos?stream=1', None),
+            ('stream NDJSON', '/productos', {'Accept': 'application/x-ndjson'}),
+        ]
+        print(f'{args.rows} filas')
+        print(f"{'modo':<18}{'TTFB (s)':>10}{'total (s)':>11}{'pico (MB)':>11}")
+        for nombre, url, headers in modos:
+            r = medir(client, url, headers)
+            print(f"{nombre:<18}{r['ttfb_s']:>10.3f}{r['total_s']:>11.3f}{r['peak_mb']:>11.1f}")
+    finally:
+        backend.app.config['DATABASE'] = original
+        for sufijo in ('', '-wal', '-shm'):
+            if os.path.exists(path + sufijo):
+                os.unlink(path + sufijo)
+
+
+if __name__ == '__main__':
+    main()
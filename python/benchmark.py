@@ -0,0 +1,405 @@
+"""Banco de pruebas de carga para la API de productos.
+
+Uso:
+  python benchmark.py --mode inproc --rows 10000 --concurrency 8 --duration 10
+  python benchmark.py --mode inproc --storage memory --mix detalle=60,listado=15,crear=10,editar=15
+  python benchmark.py --mode socket --workers 4 --threads 8 --rows 1000000 --db /tmp/bench.db
+  python benchmark.py --url http://127.0.0.1:5000 --mix detalle=50,crear=25,editar=25
+  python benchmark.py ... --output resultados.json --compare anterior.json
+
+Modos:
+  inproc  cliente de pruebas de Flask en el mismo proceso (mide la app sola)
+  socket  levanta serve.py en un subproceso y lo carga por HTTP (keep-alive)
+  --url   carga un servidor ya levantado
+
+Con --storage memory (solo inproc) la app guarda los productos en memoria
+(ver repository.py): sirve de referencia para ver cuanto del tiempo se va en
+SQLite. La busqueda no esta disponible ahi y responde 501.
+
+Reporta, por operacion, throughput y latencias p50/p95/p99. Con --output se
+guarda el resultado en JSON (con el commit actual) para comparar corridas.
+Con --db la base sembrada se conserva y se reutiliza en la siguiente corrida.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from migrations import aplicar_migraciones, crear_productos
+
+MARCAS = ('Toyota', 'Ford', 'Chevrolet', 'Nissan', 'Mazda', 'Honda', 'Kia', 'Hyundai',
+          'Renault', 'Volkswagen', 'Peugeot', 'Subaru')
+MODELOS = ('Sedan', 'Hatchback', 'Pickup', 'SUV', 'Coupe', 'Van', 'Camaro', 'Corolla',
+           'Mustang', 'Civic', 'Sentra', 'Rio')
+PALABRAS = ('automatico', 'manual', 'diesel', 'gasolina', 'hibrido', 'electrico', 'turbo',
+            'rojo', 'negro', 'blanco', 'gris', 'azul', 'usado', 'nuevo', 'importado', 'garantia')
+
+# Operacion -> (peso por defecto, estados esperados)
+OPERACIONES = {
+    'detalle': (60, {200, 404}),
+    'listado': (15, {200}),
+    'busqueda': (5, {200, 501}),
+    'crear': (10, {200, 201}),
+    'editar': (8, {200, 404}),
+    'eliminar': (2, {200, 404}),
+}
+
+
+def fila_aleatoria(rng, i):
+    marca, modelo = rng.choice(MARCAS), rng.choice(MODELOS)
+    return (f'{marca} {modelo} {i}', round(rng.uniform(5000, 90000), 2),
+            ' '.join(rng.sample(PALABRAS, 4)))
+
+
+def sembrar(path, filas, semilla=1):
+    """Crea la base con ``filas`` productos. Inserta sin journal ni triggers y
+    aplica las migraciones al final, asi el indice FTS se construye una vez."""
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    crear_productos(db)
+    rng = random.Random(semilla)
+    db.execute('BEGIN')
+    db.executemany('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
+                   (fila_aleatoria(rng, i) for i in range(filas)))
+    db.execute('COMMIT')
+    db.execute('PRAGMA journal_mode = WAL')
+    aplicar_migraciones(db)
+    db.execute('ANALYZE')
+    db.close()
+
+
+def sembrar_memoria(repositorio, filas, semilla=1):
+    # Las mismas filas que sembrar(), para comparar con la misma carga
+    rng = random.Random(semilla)
+    repositorio.crear_lote([dict(zip(('nombre', 'precio', 'descripcion'), fila_aleatoria(rng, i)))
+                            for i in range(filas)])
+
+
+def preparar_base(path, filas):
+    if path and os.path.exists(path):
+        db = sqlite3.connect(path)
+        try:
+            existentes = db.execute('SELECT COUNT(*) FROM productos').fetchone()[0]
+        except sqlite3.OperationalError:
+            existentes = -1
+        db.close()
+        if existentes >= filas:
+            print(f'Reutilizando {path} ({existentes} filas)')
+            return path, existentes, False
+        for sufijo in ('', '-wal', '-shm'):
+            if os.path.exists(path + sufijo):
+                os.unlink(path + sufijo)
+    temporal = path is None
+    if temporal:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(path)
+    inicio = time.perf_counter()
+    sembrar(path, filas)
+    print(f'Sembradas {filas} filas en {time.perf_counter() - inicio:.1f} s')
+    return path, filas, temporal
+
+
+class ClienteLocal:
+    """Cliente de pruebas de Flask: una instancia por hilo."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def __call__(self, method, path, body=None):
+        response = self.client.open(path, method=method, data=body,
+                                    content_type='application/json' if body else None)
+        response.close()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class ClienteHttp:
+    """Cliente HTTP/1.1 con keep-alive; reconecta si el servidor cierra."""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.conn = None
+
+    def __call__(self, method, path, body=None):
+        for intento in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                headers = {'Content-Type': 'application/json'} if body else {}
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                response.read()
+                if response.will_close:
+                    self.close()
+                return response.status
+            except (ConnectionError, http.client.HTTPException):
+                self.close()
+                if intento:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Carga:
+    """Genera peticiones segun la mezcla pedida y acumula latencias por operacion."""
+
+    def __init__(self, mezcla, filas, semilla=0):
+        self.nombres = list(mezcla)
+        self.pesos = [mezcla[n] for n in self.nombres]
+        self.max_id = max(filas, 1)
+        self.semilla = semilla
+        self._lock = threading.Lock()
+
+    def peticion(self, op, rng):
+        if op == 'detalle':
+            return 'GET', f'/productos/{rng.randint(1, self.max_id)}', None
+        if op == 'listado':
+            return 'GET', f'/productos?limit=100&after={rng.randint(0, self.max_id)}', None
+        if op == 'busqueda':
+            return 'GET', f'/productos/search?q={rng.choice(MODELOS)}&limit=20', None
+        if op == 'eliminar':
+            return 'DELETE', f'/productos/{rng.randint(1, self.max_id)}', None
+        nombre, precio, descripcion = fila_aleatoria(rng, rng.randint(0, 10 ** 6))
+        body = json.dumps({'nombre': nombre, 'precio': precio, 'descripcion': descripcion})
+        if op == 'crear':
+            with self._lock:
+                self.max_id += 1
+            return 'POST', '/productos', body
+        return 'PUT', f'/productos/{rng.randint(1, self.max_id)}', body
+
+    def trabajador(self, cliente, indice, fin, salida):
+        rng = random.Random(self.semilla * 1000 + indice)
+        latencias = {op: [] for op in self.nombres}
+        errores = {op: 0 for op in self.nombres}
+        try:
+            while time.monotonic() < fin:
+                op = rng.choices(self.nombres, self.pesos)[0]
+                method, path, body = self.peticion(op, rng)
+                inicio = time.perf_counter()
+                try:
+                    estado = cliente(method, path, body)
+                except (OSError, http.client.HTTPException):
+                    estado = None
+                latencias[op].append(time.perf_counter() - inicio)
+                if estado not in OPERACIONES[op][1]:
+                    errores[op] += 1
+        finally:
+            cliente.close()
+        salida.append((latencias, errores))
+
+    def correr(self, fabrica, concurrencia, duracion):
+        salida = []
+        fin = time.monotonic() + duracion
+        hilos = [threading.Thread(target=self.trabajador, args=(fabrica(), i, fin, salida))
+                 for i in range(concurrencia)]
+        inicio = time.perf_counter()
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        transcurrido = time.perf_counter() - inicio
+        latencias = {op: [] for op in self.nombres}
+        errores = {op: 0 for op in self.nombres}
+        for parciales, fallos in salida:
+            for op in self.nombres:
+                latencias[op].extend(parciales[op])
+                errores[op] += fallos[op]
+        return resumir(latencias, errores, transcurrido)
+
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return None
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def metricas(valores, errores, transcurrido):
+    ordenados = sorted(valores)
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'peticiones': len(ordenados),
+        'errores': errores,
+        'req_s': round(len(ordenados) / transcurrido, 1) if transcurrido else 0.0,
+        'media_ms': ms(sum(ordenados) / len(ordenados)) if ordenados else None,
+        'p50_ms': ms(percentil(ordenados, 50)),
+        'p95_ms': ms(percentil(ordenados, 95)),
+        'p99_ms': ms(percentil(ordenados, 99)),
+        'max_ms': ms(ordenados[-1]) if ordenados else None,
+    }
+
+
+def resumir(latencias, errores, transcurrido):
+    resultado = {op: metricas(latencias[op], errores[op], transcurrido) for op in latencias}
+    todas = [v for valores in latencias.values() for v in valores]
+    resultado['total'] = metricas(todas, sum(errores.values()), transcurrido)
+    return resultado
+
+
+def imprimir(resultado, anterior=None):
+    print(f"{'operacion':<10}{'peticiones':>11}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'errores':>9}{'vs anterior':>14}")
+    fmt = lambda v: f'{v:>9.2f}' if v is not None else f"{'-':>9}"
+    for op, m in resultado.items():
+        delta = ''
+        previo = (anterior or {}).get(op)
+        if previo and previo.get('req_s'):
+            delta = f"{(m['req_s'] / previo['req_s'] - 1) * 100:+.1f}% req/s"
+        print(f"{op:<10}{m['peticiones']:>11}{m['req_s']:>10.0f}{fmt(m['p50_ms'])}{fmt(m['p95_ms'])}"
+              f"{fmt(m['p99_ms'])}{m['errores']:>9}{delta:>14}")
+
+
+def commit_actual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def parse_mezcla(texto):
+    if not texto:
+        return {op: peso for op, (peso, _) in OPERACIONES.items()}
+    mezcla = {}
+    for parte in texto.split(','):
+        op, _, peso = parte.partition('=')
+        op = op.strip()
+        if op not in OPERACIONES:
+            raise argparse.ArgumentTypeError(f'Operacion desconocida: {op} (use {", ".join(OPERACIONES)})')
+        mezcla[op] = float(peso or 1)
+    return mezcla
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def esperar_puerto(host, port, timeout=30.0):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'El servidor no abrio el puerto {port}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Banco de pruebas de carga de la API',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog=__doc__)
+    parser.add_argument('--mode', choices=['inproc', 'socket'], default='inproc')
+    parser.add_argument('--storage', choices=['sqlite', 'memory'], default='sqlite',
+                        help='almacenamiento de la app (modo inproc)')
+    parser.add_argument('--url', help='servidor ya levantado (ignora --mode, --rows y --db)')
+    parser.add_argument('--rows', type=int, default=10000, help='filas a sembrar')
+    parser.add_argument('--db', help='base a reutilizar/conservar entre corridas')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8],
+                        help='clientes concurrentes (varios valores = varias corridas)')
+    parser.add_argument('--duration', type=float, default=10.0, help='segundos por corrida')
+    parser.add_argument('--warmup', type=float, default=1.0, help='segundos de calentamiento')
+    parser.add_argument('--mix', type=parse_mezcla, default=parse_mezcla(None),
+                        help='pesos por operacion, p. ej. detalle=70,listado=20,crear=10')
+    parser.add_argument('--workers', type=int, default=1, help='workers de serve.py (modo socket)')
+    parser.add_argument('--threads', type=int, default=8, help='hilos por worker (modo socket)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='guardar resultados en este JSON')
+    parser.add_argument('--compare', help='JSON de una corrida anterior para comparar')
+    args = parser.parse_args(argv)
+
+    anterior = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            anterior = {c['concurrencia']: c['resultados'] for c in json.load(f)['corridas']}
+
+    servidor = None
+    path, temporal, filas = None, False, args.rows
+    try:
+        if args.url:
+            partes = urlsplit(args.url)
+            fabrica = lambda: ClienteHttp(partes.hostname, partes.port or 80)
+            modo = 'url'
+        elif args.mode == 'inproc' and args.storage == 'memory':
+            import backend
+            modo = 'inproc'
+            app = backend.create_app({'STORAGE': 'memory'})
+            sembrar_memoria(backend.recursos(app).repositorio, filas)
+            fabrica = lambda: ClienteLocal(app)
+        else:
+            path, filas, temporal = preparar_base(args.db, args.rows)
+            modo = args.mode
+            if modo == 'inproc':
+                import backend
+                app = backend.create_app({'DATABASE': path})
+                with app.app_context():
+                    backend.init_db()
+                fabrica = lambda: ClienteLocal(app)
+            else:
+                port = puerto_libre()
+                serve = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py')
+                servidor = subprocess.Popen([sys.executable, serve, '--bind', f'127.0.0.1:{port}',
+                                             '--workers', str(args.workers), '--threads', str(args.threads),
+                                             '--database', path, '--max-requests', '0'])
+                esperar_puerto('127.0.0.1', port)
+                fabrica = lambda: ClienteHttp('127.0.0.1', port)
+
+        carga = Carga(args.mix, filas, args.seed)
+        if args.warmup > 0:
+            carga.correr(fabrica, max(args.concurrency), args.warmup)
+        corridas = []
+        for concurrencia in args.concurrency:
+            print(f'\n{modo}: {concurrencia} clientes, {args.duration:.0f} s, {filas} filas')
+            resultados = carga.correr(fabrica, concurrencia, args.duration)
+            imprimir(resultados, anterior.get(concurrencia))
+            corridas.append({'concurrencia': concurrencia, 'resultados': resultados})
+    finally:
+        if servidor is not None:
+            servidor.terminate()
+            servidor.wait()
+        if temporal:
+            for sufijo in ('', '-wal', '-shm'):
+                if os.path.exists(path + sufijo):
+                    os.unlink(path + sufijo)
+
+    if args.output:
+        informe = {
+            'fecha': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit_actual(),
+            'modo': modo,
+            'almacenamiento': args.storage if modo == 'inproc' else None,
+            'filas': filas,
+            'duracion': args.duration,
+            'mezcla': args.mix,
+            'workers': args.workers if modo == 'socket' else None,
+            'threads': args.threads if modo == 'socket' else None,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'corridas': corridas,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(informe, f, indent=2)
+        print(f'\nResultados guardados en {args.output}')
+
+
+if __name__ == '__main__':
+    main()
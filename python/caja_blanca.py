@@ -1,41 +1,33 @@
 import unittest
 import json
-import tempfile
-import os
 import sqlite3
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
 import sys
 sys.path.append('.')
 
 # Importamos el módulo a probar
-from backend import app, init_db, get_db, DATABASE
+from backend import init_db, get_db
+import fixtures
 
 class TestBackendCajaBlanca(unittest.TestCase):
     
     def setUp(self):
         """Configuración antes de cada prueba"""
-        self.app = app
-        self.app.config['TESTING'] = True
-        self.client = self.app.test_client()
-        
-        # Crear base de datos temporal
-        self.test_db = tempfile.NamedTemporaryFile(delete=False)
-        self.test_db.close()
+        # Crear base de datos temporal, ya inicializada (ver fixtures.py)
+        self.test_db = fixtures.nueva_base()
         
-        # Reemplazar la base de datos por la temporal
-        global DATABASE
-        self.original_db = DATABASE
-        DATABASE = self.test_db.name
-        
-        # Inicializar base de datos
-        with self.app.app_context():
-            init_db()
+        # Una app propia sobre la base temporal, sin tocar la del módulo
+        self.app = fixtures.crear_app(self.test_db)
+        self.client = self.app.test_client()
     
     def tearDown(self):
         """Limpieza después de cada prueba"""
-        global DATABASE
-        DATABASE = self.original_db
-        os.unlink(self.test_db.name)
+        fixtures.cerrar_app(self.app)
+        fixtures.borrar_base(self.test_db)
+    
+    def conectar(self):
+        """Conexión directa a la base de la prueba, fuera de una petición"""
+        return sqlite3.connect(self.test_db)
     
     # ==================== PRUEBAS DE RUTA / PATH COVERAGE ====================
     
@@ -57,7 +49,7 @@ class TestBackendCajaBlanca(unittest.TestCase):
     def test_productos_get_con_datos(self):
         """Prueba GET /productos con datos existentes"""
         # Insertar datos de prueba
-        db = get_db()
+        db = self.conectar()
         db.execute('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
                    ['Test Product', 10.5, 'Test Description'])
         db.commit()
@@ -85,7 +77,7 @@ class TestBackendCajaBlanca(unittest.TestCase):
         self.assertEqual(data['mensaje'], 'Producto guardado correctamente')
         
         # Verificar inserción en BD
-        db = get_db()
+        db = self.conectar()
         cursor = db.execute('SELECT * FROM productos WHERE nombre = ?', ['Nuevo Producto'])
         row = cursor.fetchone()
         self.assertIsNotNone(row)
@@ -93,7 +85,7 @@ class TestBackendCajaBlanca(unittest.TestCase):
     def test_producto_id_get_existente(self):
         """Prueba GET /productos/{id} - producto existente"""
         # Insertar producto de prueba
-        db = get_db()
+        db = self.conectar()
         cursor = db.execute('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
                            ['Test Product', 15.0, 'Test Desc'])
         db.commit()
@@ -114,7 +106,7 @@ class TestBackendCajaBlanca(unittest.TestCase):
     def test_producto_id_put(self):
         """Prueba PUT /productos/{id} - actualización"""
         # Insertar producto inicial
-        db = get_db()
+        db = self.conectar()
         cursor = db.execute('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
                            ['Original', 10.0, 'Original Desc'])
         db.commit()
@@ -143,7 +135,7 @@ class TestBackendCajaBlanca(unittest.TestCase):
     def test_producto_id_delete(self):
         """Prueba DELETE /productos/{id} - eliminación"""
         # Insertar producto
-        db = get_db()
+        db = self.conectar()
         cursor = db.execute('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
                            ['Para Eliminar', 5.0, 'Delete me'])
         db.commit()
@@ -164,7 +156,7 @@ class TestBackendCajaBlanca(unittest.TestCase):
     def test_init_db_tabla_no_existe(self):
         """Prueba init_db cuando la tabla no existe"""
         # Eliminar tabla si existe
-        db = get_db()
+        db = self.conectar()
         db.execute('DROP TABLE IF EXISTS productos')
         db.commit()
         
@@ -179,9 +171,10 @@ class TestBackendCajaBlanca(unittest.TestCase):
     
     def test_get_db_conexion(self):
         """Prueba get_db() retorna conexión válida"""
-        db = get_db()
-        self.assertIsInstance(db, sqlite3.Connection)
-        db.close()
+        # La conexión sale del pool de la app y vuelve al cerrar el contexto
+        with self.app.app_context():
+            db = get_db()
+            self.assertIsInstance(db, sqlite3.Connection)
     
     # ==================== PRUEBAS DE RAMA / BRANCH COVERAGE ====================
     
@@ -201,7 +194,7 @@ class TestBackendCajaBlanca(unittest.TestCase):
     def test_producto_id_todos_metodos(self):
         """Prueba todas las ramas de producto_id() (GET, PUT, DELETE)"""
         # Crear producto para las pruebas
-        db = get_db()
+        db = self.conectar()
         cursor = db.execute('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
                            ['Multi Test', 1.0, 'Test'])
         db.commit()
@@ -231,7 +224,7 @@ class TestBackendCajaBlanca(unittest.TestCase):
     def test_decision_producto_existe_vs_no_existe(self):
         """Prueba decisión if row: en producto_id GET"""
         # Decisión TRUE: producto existe
-        db = get_db()
+        db = self.conectar()
         cursor = db.execute('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
                            ['Exists', 1.0, 'Test'])
         db.commit()
@@ -254,7 +247,7 @@ class TestBackendCajaBlanca(unittest.TestCase):
         self.assertEqual(len(data_empty), 0)
         
         # Caso múltiples iteraciones
-        db = get_db()
+        db = self.conectar()
         for i in range(3):
             db.execute('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
                       [f'Product {i}', i * 10.0, f'Desc {i}'])
@@ -295,7 +288,7 @@ class TestBackendCajaBlanca(unittest.TestCase):
                                    content_type='application/json')
         
         # Verificar en nueva conexión (simula persistencia)
-        new_db = get_db()
+        new_db = self.conectar()
         cursor = new_db.execute('SELECT * FROM productos WHERE nombre = ?', ['DB Test'])
         row = cursor.fetchone()
         self.assertIsNotNone(row)
@@ -0,0 +1,343 @@
+"""Feed de cambios del catalogo sobre la tabla ``cambios`` (ver migrations.py).
+
+Un solo hilo por proceso (``Difusor``) consulta la bitacora y guarda los
+ultimos eventos ya codificados; cada suscriptor los toma de ahi, asi que
+cien clientes conectados cuestan una consulta por intervalo y no cien. Las
+escrituras del propio proceso lo despiertan al instante (``avisar``); las de
+otros workers se ven en el siguiente sondeo.
+
+``StreamCambios`` es el cuerpo de un stream SSE. Se puede recorrer como
+iterable WSGI (ocupa un hilo mientras espera) o como iterador asincrono
+(``asincrono()``), que es lo que usa asgi.py para no ocupar ninguno.
+
+``podar_cambios`` acota la bitacora; la corre la tarea de mantenimiento
+del mismo nombre (ver maintenance.py).
+"""
+import asyncio
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger('crud.cambios')
+
+OPERACIONES = {'I': 'insert', 'U': 'update', 'D': 'delete'}
+
+
+class CambiosPerdidos(Exception):
+    """Los cambios pedidos ya se podaron (o la base es otra): hay que recargar."""
+
+
+def leer_cambios(db, since, limit):
+    """Cambios con ``seq > since`` en orden. ``producto`` es el estado actual
+    de la fila (None si ya no existe), asi que aplicarlos es idempotente.
+
+    Lanza CambiosPerdidos si entre ``since`` y el primer cambio disponible
+    falta alguno: seq es AUTOINCREMENT y solo tiene huecos por poda.
+    """
+    # Las filas y ultimo_seq se leen en la misma transaccion: una escritura
+    # confirmada entre las dos lecturas haria parecer perdidos los cambios
+    # de un cliente al dia
+    propia = not db.in_transaction
+    if propia:
+        db.execute('BEGIN')
+    try:
+        rows = db.execute('''SELECT c.seq, c.operacion, c.producto_id, p.nombre, p.precio, p.descripcion
+                             FROM cambios c LEFT JOIN productos p ON p.id = c.producto_id
+                             WHERE c.seq > ? ORDER BY c.seq LIMIT ?''', [since, limit]).fetchall()
+        if rows:
+            if rows[0][0] != since + 1:
+                raise CambiosPerdidos()
+        elif since != ultimo_seq(db):
+            raise CambiosPerdidos()
+    finally:
+        if propia:
+            db.execute('COMMIT')
+    return [evento(row) for row in rows]
+
+
+def ultimo_seq(db):
+    row = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'cambios'").fetchone()
+    return row[0] if row else 0
+
+
+def podar_cambios(db, max_edad=None, max_filas=None, ahora=None, lote=10000):
+    """Borra los cambios de mas de ``max_edad`` segundos y los que sobran de
+    los ``max_filas`` ultimos; devuelve cuantos borro. Quien pida cambios
+    podados recibe CambiosPerdidos (410) y recarga el listado.
+
+    Borra de a ``lote`` filas por transaccion para no frenar a los que
+    escriben; ``db`` tiene que estar en autocommit.
+    """
+    hasta = 0
+    if max_filas is not None:
+        hasta = ultimo_seq(db) - max_filas
+    if max_edad is not None:
+        ahora = time.time() if ahora is None else ahora
+        viejo = db.execute('SELECT MAX(seq) FROM cambios WHERE momento < ?', [ahora - max_edad]).fetchone()[0]
+        hasta = max(hasta, viejo or 0)
+    desde = db.execute('SELECT MIN(seq) FROM cambios').fetchone()[0]
+    borrados = 0
+    while desde is not None and desde <= hasta:
+        borrados += db.execute('DELETE FROM cambios WHERE seq >= ? AND seq < ? AND seq <= ?',
+                               [desde, desde + lote, hasta]).rowcount
+        desde += lote
+    return borrados
+
+
+def evento(row):
+    seq, operacion, id, nombre, precio, descripcion = row
+    producto = None
+    if nombre is not None:
+        producto = dict(id=id, nombre=nombre, precio=precio, descripcion=descripcion)
+    return dict(seq=seq, operacion=OPERACIONES[operacion], id=id, producto=producto)
+
+
+def sse(evento, codificar):
+    return b'id: %d\nevent: cambio\ndata: %s\n\n' % (evento['seq'], codificar(evento))
+
+
+class Difusor:
+    """Sondea la bitacora en un hilo propio mientras haya suscriptores."""
+
+    def __init__(self, database, codificar, intervalo=0.5, capacidad=1000, busy_timeout=5000):
+        self.database = database
+        self.codificar = codificar
+        self.intervalo = intervalo
+        self.capacidad = capacidad
+        self.busy_timeout = busy_timeout
+        # (seq, bytes SSE) contiguos por seq; ``base`` es el seq
+        # anterior al primero guardado
+        self.eventos = deque(maxlen=capacidad)
+        self.base = self.ultimo = None
+        self.cerrado = False
+        self._cond = threading.Condition()
+        self._despertar = threading.Event()
+        self._callbacks = set()
+        self._reservas = {True: 0, False: 0}
+        self._hilo = None
+        self._stats = {'sondeos': 0, 'eventos': 0, 'errores': 0, 'rechazados': 0}
+
+    # -- suscripciones ----------------------------------------------------
+
+    def reservar(self, bloqueante, limite):
+        """Cuenta un stream nuevo; False si ya hay ``limite`` de su tipo
+        (los bloqueantes ocupan un hilo de WSGI, los asincronos no)."""
+        with self._cond:
+            if self.cerrado or self._reservas[bloqueante] >= limite:
+                self._stats['rechazados'] += 1
+                return False
+            self._reservas[bloqueante] += 1
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._correr, name='cambios', daemon=True)
+                self._hilo.start()
+        self.avisar()
+        return True
+
+    def liberar(self, bloqueante):
+        with self._cond:
+            self._reservas[bloqueante] -= 1
+
+    def suscribir(self, callback):
+        # ``callback`` se llama desde el hilo del difusor tras cada lote
+        with self._cond:
+            self._callbacks.add(callback)
+
+    def desuscribir(self, callback):
+        with self._cond:
+            self._callbacks.discard(callback)
+
+    def avisar(self):
+        self._despertar.set()
+
+    def cerrar(self):
+        """Termina los streams abiertos (parada del worker)."""
+        with self._cond:
+            self.cerrado = True
+            self._cond.notify_all()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+        self.avisar()
+
+    # -- lecturas ---------------------------------------------------------
+
+    def pendientes(self, seq):
+        """Eventos guardados posteriores a ``seq`` como [(seq, bytes)], o None
+        si ``seq`` es anterior a lo guardado (hay que leer de SQLite)."""
+        with self._cond:
+            if self.base is None or seq < self.base:
+                return None
+            inicio = seq - self.base
+            return list(itertools.islice(self.eventos, inicio, None))
+
+    def esperar(self, seq, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.cerrado or self.hay_nuevos(seq), timeout)
+
+    # -- hilo de sondeo ---------------------------------------------------
+
+    def _correr(self):
+        db = sqlite3.connect(self.database, check_same_thread=False)
+        db.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        try:
+            while not self.cerrado:
+                if not self._activos():
+                    # Sin suscriptores no se sondea ni se guarda historia; al
+                    # volver alguno se empieza por la cola de la bitacora
+                    with self._cond:
+                        self.eventos.clear()
+                        self.base = self.ultimo = None
+                    self._despertar.wait()
+                else:
+                    self._despertar.wait(self.intervalo)
+                self._despertar.clear()
+                if self._activos() and not self.cerrado:
+                    try:
+                        self._sondear(db)
+                    except Exception:
+                        # Cualquier error (SQLite, codificar un evento) se
+                        # cuenta y se reintenta en el siguiente sondeo: si el
+                        # hilo terminara los streams quedarian sin eventos
+                        self._stats['errores'] += 1
+                        log.exception('Error al sondear los cambios de %s', self.database)
+        finally:
+            db.close()
+
+    def _activos(self):
+        with self._cond:
+            return sum(self._reservas.values())
+
+    def _sondear(self, db):
+        self._stats['sondeos'] += 1
+        maximo = ultimo_seq(db)
+        if maximo == self.ultimo:
+            return
+        desde, reiniciar = self.ultimo, False
+        if desde is None or not desde < maximo <= desde + self.capacidad:
+            # Arranque o rafaga mayor que lo que se guarda: solo interesa la
+            # cola; los suscriptores atrasados leen de SQLite
+            desde, reiniciar = max(maximo - self.capacidad, 0), True
+        try:
+            lote = leer_cambios(db, desde, self.capacidad)
+        except CambiosPerdidos:
+            lote, desde, reiniciar = [], maximo, True
+        nuevos = [(e['seq'], sse(e, self.codificar)) for e in lote]
+        with self._cond:
+            if reiniciar:
+                self.eventos.clear()
+            self.eventos.extend(nuevos)
+            self.base = self.eventos[0][0] - 1 if self.eventos else desde
+            self.ultimo = nuevos[-1][0] if nuevos else desde
+            self._stats['eventos'] += len(nuevos)
+            self._cond.notify_all()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback()
+
+    def hay_nuevos(self, seq):
+        return self.ultimo is not None and self.ultimo > seq
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(suscriptores=sum(self._reservas.values()), bloqueantes=self._reservas[True],
+                         guardados=len(self.eventos), seq=self.ultimo or 0)
+        return stats
+
+
+class StreamCambios:
+    """Cuerpo de ``GET /productos/changes/stream`` en formato SSE.
+
+    ``leer(seq)`` devuelve los cambios posteriores desde SQLite (o lanza
+    CambiosPerdidos); solo se usa al conectar y cuando el cliente quedo
+    detras de lo que guarda el difusor. Tras ``duracion`` segundos el stream
+    se cierra y el navegador reconecta con Last-Event-ID.
+    """
+
+    def __init__(self, difusor, leer, seq, bloqueante, latido=15.0, duracion=300.0):
+        self.difusor = difusor
+        self.leer = leer
+        self.seq = seq
+        self.bloqueante = bloqueante
+        self.latido = latido
+        self.fin = time.monotonic() + duracion
+        self._liberado = False
+
+    def _desde_sqlite(self):
+        try:
+            eventos = self.leer(self.seq)
+        except CambiosPerdidos:
+            return None
+        return [(e['seq'], sse(e, self.difusor.codificar)) for e in eventos]
+
+    def _bloque(self, eventos):
+        self.seq = eventos[-1][0]
+        return b''.join(datos for _, datos in eventos)
+
+    def _reset(self):
+        self.fin = 0
+        return b'event: reset\ndata: {}\n\n'
+
+    def primero(self):
+        # Al conectar siempre se lee de SQLite: valida ``since`` aunque el
+        # difusor todavia no haya sondeado
+        eventos = self._desde_sqlite()
+        if eventos is None:
+            return self._reset()
+        return b'retry: 3000\n\n' + (self._bloque(eventos) if eventos else b'')
+
+    def __iter__(self):
+        try:
+            yield self.primero()
+            while time.monotonic() < self.fin and not self.difusor.cerrado:
+                eventos = self.difusor.pendientes(self.seq)
+                if eventos is None:
+                    eventos = self._desde_sqlite()
+                    if eventos is None:
+                        yield self._reset()
+                        return
+                if eventos:
+                    yield self._bloque(eventos)
+                elif not self.difusor.esperar(self.seq, self.latido):
+                    yield b': ping\n\n'
+        finally:
+            self.close()
+
+    async def asincrono(self, executor=None):
+        """Continua el stream sin ocupar hilos: espera en el event loop a que
+        el difusor avise. Se usa despues de consumir ``primero()``."""
+        loop = asyncio.get_running_loop()
+        hay_nuevos = asyncio.Event()
+
+        def avisar():
+            loop.call_soon_threadsafe(hay_nuevos.set)
+
+        self.difusor.suscribir(avisar)
+        try:
+            while time.monotonic() < self.fin and not self.difusor.cerrado:
+                eventos = self.difusor.pendientes(self.seq)
+                if eventos is None:
+                    eventos = await loop.run_in_executor(executor, self._desde_sqlite)
+                    if eventos is None:
+                        yield self._reset()
+                        return
+                if eventos:
+                    yield self._bloque(eventos)
+                    continue
+                hay_nuevos.clear()
+                if self.difusor.hay_nuevos(self.seq):
+                    continue
+                try:
+                    await asyncio.wait_for(hay_nuevos.wait(), self.latido)
+                except asyncio.TimeoutError:
+                    yield b': ping\n\n'
+        finally:
+            self.difusor.desuscribir(avisar)
+
+    def close(self):
+        if not self._liberado:
+            self._liberado = True
+            self.difusor.liberar(self.bloqueante)
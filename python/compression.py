@@ -0,0 +1,272 @@
+"""Compresion de respuestas como middleware WSGI.
+
+El algoritmo se negocia con ``Accept-Encoding`` entre los disponibles: gzip
+siempre, br si esta instalado ``brotli`` y zstd si esta ``zstandard``. A
+igual calidad pedida por el cliente gana el primero de
+COMPRESSION_ALGORITHMS.
+
+  - Respuestas con Content-Length: se comprimen enteras si superan
+    COMPRESSION_MIN_SIZE. Las que traen ETag (las que se repiten) se
+    guardan ya comprimidas para no volver a comprimir el mismo cuerpo (la
+    cache de respuestas de backend.py guarda el cuerpo sin comprimir).
+  - Respuestas en streaming: cada chunk se comprime y se vacia con un flush
+    para que el cliente lo reciba sin esperar al final.
+
+Las respuestas comprimidas llevan ``Vary: Accept-Encoding`` y el ETag
+pasa a debil (``W/"..."``), que es lo que compara If-None-Match en la app.
+"""
+import hashlib
+import time
+import zlib
+
+from werkzeug.http import parse_accept_header, parse_options_header
+
+from cache import CachedResponse, LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CompresorGzip:
+    nombre = 'gzip'
+
+    def __init__(self, nivel=1):
+        self._c = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+
+    def parcial(self, datos):
+        return self._c.compress(datos) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def final(self, datos=b''):
+        return self._c.compress(datos) + self._c.flush()
+
+
+class CompresorBrotli:
+    nombre = 'br'
+
+    def __init__(self, nivel=4):
+        self._c = brotli.Compressor(quality=nivel)
+
+    def parcial(self, datos):
+        return self._c.process(datos) + self._c.flush()
+
+    def final(self, datos=b''):
+        return self._c.process(datos) + self._c.finish()
+
+
+class CompresorZstd:
+    nombre = 'zstd'
+
+    def __init__(self, nivel=3):
+        self._c = zstandard.ZstdCompressor(level=nivel).compressobj()
+
+    def parcial(self, datos):
+        return self._c.compress(datos) + self._c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def final(self, datos=b''):
+        return self._c.compress(datos) + self._c.flush()
+
+
+ALGORITMOS = {'gzip': CompresorGzip}
+if brotli is not None:
+    ALGORITMOS['br'] = CompresorBrotli
+if zstandard is not None:
+    ALGORITMOS['zstd'] = CompresorZstd
+
+
+def negociar(accept_encoding, preferidos):
+    """Algoritmo a usar segun Accept-Encoding, o None si ninguno sirve."""
+    if not accept_encoding:
+        return None
+    aceptados = parse_accept_header(accept_encoding)
+    mejor, calidad_mejor = None, 0
+    for nombre in preferidos:
+        if nombre not in ALGORITMOS:
+            continue
+        calidad = aceptados.quality(nombre)
+        if calidad > calidad_mejor:
+            mejor, calidad_mejor = nombre, calidad
+    return mejor
+
+
+def debil(etag):
+    return etag if etag.startswith('W/') else f'W/{etag}'
+
+
+class CompressionMiddleware:
+    """Envuelve una aplicacion WSGI; como ProfilingMiddleware lee ``config``
+    en cada peticion. Con ``metricas`` y METRICS_ENABLED cuenta bytes de
+    entrada y salida y el tiempo de CPU de compresion por algoritmo."""
+
+    def __init__(self, app, config, metricas=None):
+        self.app = app
+        self.config = config
+        self.metricas = metricas
+        self._cache = None
+
+    def __call__(self, environ, start_response):
+        config = self.config
+        if not config.get('COMPRESSION_ENABLED') or environ['REQUEST_METHOD'] == 'HEAD':
+            return self.app(environ, start_response)
+        inicio = {}
+
+        def capturar(status, headers, exc_info=None):
+            inicio['status'], inicio['headers'] = status, headers
+            return escritos.append
+
+        escritos = []
+        iterable = self.app(environ, capturar)
+        status, headers = inicio['status'], inicio['headers']
+        nombres = {nombre.lower(): valor for nombre, valor in headers}
+        tipo = parse_options_header(nombres.get('content-type', ''))[0]
+        if (tipo not in config['COMPRESSION_MIMETYPES'] or 'content-encoding' in nombres
+                or environ.get('crud.async_body') is not None):
+            # No comprimible (o el cuerpo lo recorre asgi.py por su cuenta)
+            return self.sin_comprimir(start_response, status, headers, escritos, iterable)
+        headers = self.con_vary(headers, nombres)
+        algoritmo = negociar(environ.get('HTTP_ACCEPT_ENCODING'), config['COMPRESSION_ALGORITHMS'])
+        motivo = None
+        if algoritmo is None:
+            motivo = 'cliente'
+        elif status[:3] in ('204', '206', '304'):
+            motivo = 'estado'
+        elif 'no-transform' in nombres.get('cache-control', ''):
+            motivo = 'no-transform'
+        elif 'content-length' in nombres and int(nombres['content-length']) < config['COMPRESSION_MIN_SIZE']:
+            motivo = 'pequena'
+        if motivo is not None:
+            self.contar('crud_compression_skipped_total', (('reason', motivo),))
+            return self.sin_comprimir(start_response, status, headers, escritos, iterable)
+        if 'content-length' in nombres:
+            return self.completa(start_response, status, headers, nombres, algoritmo,
+                                 escritos, iterable)
+        return self.streaming(start_response, status, headers, algoritmo, escritos, iterable)
+
+    @staticmethod
+    def con_vary(headers, nombres):
+        vary = nombres.get('vary')
+        if vary is None:
+            return headers + [('Vary', 'Accept-Encoding')]
+        if 'accept-encoding' in vary.lower():
+            return headers
+        return [(n, f'{v}, Accept-Encoding' if n.lower() == 'vary' else v) for n, v in headers]
+
+    @staticmethod
+    def sin_comprimir(start_response, status, headers, escritos, iterable):
+        write = start_response(status, headers)
+        for datos in escritos:
+            write(datos)
+        return iterable
+
+    def comprimidos(self, headers, algoritmo, longitud=None):
+        salida = []
+        for nombre, valor in headers:
+            clave = nombre.lower()
+            if clave == 'content-length':
+                continue
+            if clave == 'etag':
+                valor = debil(valor)
+            salida.append((nombre, valor))
+        salida.append(('Content-Encoding', algoritmo))
+        if longitud is not None:
+            salida.append(('Content-Length', str(longitud)))
+        return salida
+
+    def completa(self, start_response, status, headers, nombres, algoritmo, escritos, iterable):
+        try:
+            cuerpo = b''.join(escritos) + b''.join(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        niveles = self.config['COMPRESSION_LEVELS']
+        cache, clave = self.get_cache(), None
+        if cache is not None and 'etag' in nombres:
+            # La clave es el contenido y no el ETag: el ETag del listado es
+            # la version del catalogo y no distingue parametros ni bases. Un
+            # digest de 128 bits y no hash(): con 64 bits dos cuerpos que
+            # choquen servirian la respuesta de otro
+            clave = (algoritmo, niveles.get(algoritmo), len(cuerpo),
+                     hashlib.blake2b(cuerpo, digest_size=16).digest())
+            guardada = cache.get(clave)
+            if guardada is not None:
+                self.contar('crud_compression_cache_hits_total', (('algorithm', algoritmo),))
+                start_response(status, self.comprimidos(headers, algoritmo, len(guardada.body)))
+                return [guardada.body]
+        cpu = time.thread_time()
+        comprimido = self.compresor(algoritmo).final(cuerpo)
+        cpu = time.thread_time() - cpu
+        self.medir(algoritmo, len(cuerpo), len(comprimido), cpu)
+        if len(comprimido) >= len(cuerpo):
+            self.contar('crud_compression_skipped_total', (('reason', 'sin_ganancia'),))
+            start_response(status, headers)
+            return [cuerpo]
+        if clave is not None:
+            cache.set(clave, CachedResponse(comprimido, None, None))
+        start_response(status, self.comprimidos(headers, algoritmo, len(comprimido)))
+        return [comprimido]
+
+    def streaming(self, start_response, status, headers, algoritmo, escritos, iterable):
+        compresor = self.compresor(algoritmo)
+        start_response(status, self.comprimidos(headers, algoritmo))
+
+        def generar():
+            entrada = salida = 0
+            cpu = 0.0
+            try:
+                for partes in (escritos, iterable):
+                    for datos in partes:
+                        if not datos:
+                            continue
+                        inicio = time.thread_time()
+                        chunk = compresor.parcial(datos)
+                        cpu += time.thread_time() - inicio
+                        entrada += len(datos)
+                        salida += len(chunk)
+                        yield chunk
+                inicio = time.thread_time()
+                chunk = compresor.final()
+                cpu += time.thread_time() - inicio
+                salida += len(chunk)
+                yield chunk
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+                self.medir(algoritmo, entrada, salida, cpu)
+
+        return generar()
+
+    def compresor(self, algoritmo):
+        nivel = self.config['COMPRESSION_LEVELS'].get(algoritmo)
+        return ALGORITMOS[algoritmo]() if nivel is None else ALGORITMOS[algoritmo](nivel)
+
+    def get_cache(self):
+        entradas = self.config.get('COMPRESSION_CACHE_ENTRIES')
+        if not entradas:
+            return None
+        if self._cache is None:
+            self._cache = LRUCache(max_entries=entradas,
+                                   max_bytes=self.config['COMPRESSION_CACHE_MAX_BYTES'],
+                                   ttl=self.config['COMPRESSION_CACHE_TTL'])
+        return self._cache
+
+    def activas(self):
+        return self.metricas is not None and self.config.get('METRICS_ENABLED')
+
+    def contar(self, nombre, etiquetas):
+        if self.activas():
+            self.metricas.contar(nombre, etiquetas)
+
+    def medir(self, algoritmo, entrada, salida, cpu):
+        if not self.activas():
+            return
+        etiquetas = (('algorithm', algoritmo),)
+        self.metricas.contar('crud_compression_responses_total', etiquetas)
+        self.metricas.contar('crud_compression_bytes_in_total', etiquetas, entrada)
+        self.metricas.contar('crud_compression_bytes_out_total', etiquetas, salida)
+        self.metricas.contar('crud_compression_cpu_seconds_total', etiquetas, cpu)
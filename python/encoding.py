@@ -0,0 +1,86 @@
+"""Codificacion JSON: orjson si esta instalado, si no la libreria estandar.
+
+Para los listados hay ademas un camino que no construye un dict por fila:
+SQLite arma el objeto JSON de cada fila con json_object() y Python solo une
+los textos. json_object() escribe los REAL con 15 digitos significativos,
+lo que no alcanza para recuperar el double (0.1 + 0.2 saldria como 0.3):
+las columnas REAL se escriben aparte con 17 digitos. El valor es exacto pero
+el texto puede ser mas largo que el de Python (0.1 sale 0.10000000000000001),
+por eso el camino no esta activo por defecto (ver JSON_ROWS_SQL).
+"""
+import json
+import sqlite3
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class CodificadorStdlib:
+    nombre = 'json'
+
+    def dumps(self, obj, default=None, sort_keys=False, ensure_ascii=True):
+        return json.dumps(obj, default=default, sort_keys=sort_keys, ensure_ascii=ensure_ascii,
+                          separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class CodificadorOrjson:
+    nombre = 'orjson'
+
+    def dumps(self, obj, default=None, sort_keys=False, ensure_ascii=True):
+        # orjson siempre emite UTF-8 (ignora ensure_ascii). Las fechas pasan
+        # por ``default`` para que salgan igual que con el proveedor de Flask
+        opciones = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            opciones |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=default, option=opciones)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+CODIFICADORES = {'json': CodificadorStdlib}
+if orjson is not None:
+    CODIFICADORES['orjson'] = CodificadorOrjson
+
+
+def elegir_codificador(nombre='auto'):
+    if nombre == 'auto':
+        nombre = 'orjson' if 'orjson' in CODIFICADORES else 'json'
+    if nombre not in CODIFICADORES:
+        raise ValueError(f'Codificador JSON no disponible: {nombre} '
+                         f'(disponibles: {", ".join(CODIFICADORES)})')
+    return CODIFICADORES[nombre]()
+
+
+def soporta_json_sql():
+    try:
+        sqlite3.connect(':memory:').execute("SELECT json_object('a', 1)").close()
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+# SQLite compilado sin JSON1 (anterior a 3.38 sin la extension) usa el camino
+# con dicts
+JSON_SQL = soporta_json_sql()
+
+
+def objeto_sql(campos, reales=()):
+    """Expresion SQL que arma el objeto JSON de una fila. ``campos`` debe
+    venir ya validado contra las columnas conocidas; los de ``reales`` se
+    escriben sin perder precision."""
+    def valor(campo):
+        if campo in reales:
+            # '!' habilita mas de 16 digitos y deja siempre el punto decimal
+            return f"json(printf('%!.17g', {campo}))"
+        return campo
+    return 'json_object(' + ', '.join(f"'{campo}', {valor(campo)}" for campo in campos) + ')'
+
+
+def unir_filas(rows, indice=1):
+    return '[' + ','.join([row[indice] for row in rows]) + ']'
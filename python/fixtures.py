@@ -0,0 +1,88 @@
+"""Bases de datos aisladas para las pruebas.
+
+Cada proceso de pruebas tiene su propio directorio y una plantilla ya
+migrada; cada prueba recibe una copia de la plantilla (copiar un archivo
+cuesta bastante menos que correr las migraciones) y su propia app armada
+con ``create_app({'DATABASE': ...})``, sin tocar la app del modulo backend
+ni su configuracion. Asi varios procesos (ver run_tests.py) corren las
+pruebas a la vez sin compartir archivos, y una prueba no hereda pool,
+caches ni metricas de otra.
+
+El directorio va en /dev/shm cuando existe: las bases quedan en memoria pero
+siguen siendo archivos, con WAL y varias conexiones como en produccion (una
+base ``:memory:`` con cache compartida no tiene WAL y bloquea por tabla).
+CRUD_TEST_DIR elige otro directorio.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+import unittest
+
+_directorio = None
+_plantilla = None
+
+
+def directorio():
+    global _directorio
+    if _directorio is None:
+        padre = os.environ.get('CRUD_TEST_DIR') or ('/dev/shm' if os.path.isdir('/dev/shm') else None)
+        _directorio = tempfile.mkdtemp(prefix=f'crud-pruebas-{os.getpid()}-', dir=padre)
+        atexit.register(shutil.rmtree, _directorio, True)
+    return _directorio
+
+
+def crear_app(path, **config):
+    """App nueva sobre la base ``path``; se cierra con ``cerrar_app``."""
+    import backend
+    return backend.create_app(dict(config, DATABASE=path, TESTING=True))
+
+
+def cerrar_app(aplicacion):
+    import backend
+    backend.recursos(aplicacion).cerrar()
+
+
+def plantilla():
+    global _plantilla
+    if _plantilla is None:
+        import backend
+        path = os.path.join(directorio(), 'plantilla.db')
+        aplicacion = crear_app(path)
+        with aplicacion.app_context():
+            backend.init_db()
+        cerrar_app(aplicacion)
+        _plantilla = path
+    return _plantilla
+
+
+def nueva_base(migrada=True):
+    """Ruta de una base nueva del proceso: copia de la plantilla, o un
+    archivo vacio con ``migrada=False``."""
+    fd, path = tempfile.mkstemp(suffix='.db', dir=directorio())
+    os.close(fd)
+    if migrada:
+        shutil.copyfile(plantilla(), path)
+    return path
+
+
+def borrar_base(path):
+    for sufijo in ('', '-wal', '-shm'):
+        if os.path.exists(path + sufijo):
+            os.unlink(path + sufijo)
+
+
+class BaseAislada(unittest.TestCase):
+    """Cada prueba corre contra su propia base, en ``self.temp_db_name``,
+    con su propia app en ``self.app``"""
+
+    migrada = True
+
+    def setUp(self):
+        super().setUp()
+        self.temp_db_name = nueva_base(self.migrada)
+        self.app = crear_app(self.temp_db_name)
+        # Las limpiezas corren en orden inverso: primero se cierra la app
+        # (conexiones e hilos) y despues se borra la base
+        self.addCleanup(borrar_base, self.temp_db_name)
+        self.addCleanup(cerrar_app, self.app)
@@ -0,0 +1,108 @@
+"""Escrituras idempotentes con la cabecera ``Idempotency-Key``.
+
+La primera peticion con una clave la reserva en la tabla ``idempotencia``
+(ver migrations.py) y, si termina con 2xx, guarda ahi su respuesta. Un
+reintento con la misma clave recibe esa respuesta sin volver a escribir en
+productos; si la primera ya termino basta una lectura. La tabla es comun a
+todos los workers, asi que el reintento puede caer en cualquiera.
+
+  - misma clave con otra peticion (metodo, ruta o cuerpo distintos): 422;
+  - misma clave mientras la original sigue en curso: 409;
+  - una respuesta que no es 2xx libera la clave para reintentar;
+  - una reserva que nunca se completo (el worker murio) se puede volver a
+    tomar pasados ``espera`` segundos. Cada escritura de la peticion guarda
+    su resultado en la reserva dentro de su misma transaccion
+    (``registrando``); el reintento que la toma recibe esos resultados en
+    lugar de volver a escribir, asi un alta confirmada no se repite;
+  - las claves vencen a los ``ttl`` segundos y ``podar`` deja a lo sumo
+    ``maximo``.
+"""
+import hashlib
+import json
+
+CABECERAS = ('Content-Type', 'ETag', 'Location')
+MAX_LARGO = 255
+
+REPETIDA = 'repetida'
+EN_CURSO = 'en_curso'
+DISTINTA = 'distinta'
+
+
+def huella(metodo, ruta, cuerpo):
+    return hashlib.sha256(b'%s %s\n%s' % (metodo.encode(), ruta.encode(), cuerpo)).hexdigest()
+
+
+def buscar(db, clave, ahora, ttl):
+    """La fila vigente de ``clave`` como (huella, estado, cuerpo, cabeceras,
+    creado, escrituras), o None."""
+    row = db.execute('''SELECT huella, estado, cuerpo, cabeceras, creado, escrituras
+                        FROM idempotencia WHERE clave = ?''', [clave]).fetchone()
+    if row is None or row[4] < ahora - ttl:
+        return None
+    return row
+
+
+def reservar(db, clave, firma, ahora, ttl, espera):
+    """Dentro de la transaccion de escritura: toma la clave y devuelve None, o
+    devuelve la fila que ya la ocupa."""
+    row = buscar(db, clave, ahora, ttl)
+    if row is not None and not (row[1] is None and row[4] < ahora - espera):
+        return row
+    if row is not None and row[0] == firma:
+        # Reserva abandonada de la misma peticion: conserva sus escrituras
+        db.execute('UPDATE idempotencia SET creado = ? WHERE clave = ?', [ahora, clave])
+    else:
+        db.execute('INSERT OR REPLACE INTO idempotencia (clave, huella, creado) VALUES (?, ?, ?)',
+                   [clave, firma, ahora])
+    return None
+
+
+def escrituras(db, clave):
+    """Resultados de las escrituras que la reserva de ``clave`` ya confirmo."""
+    row = db.execute('SELECT escrituras FROM idempotencia WHERE clave = ?', [clave]).fetchone()
+    return json.loads(row[0]) if row and row[0] else []
+
+
+def registrando(fn, clave, firma):
+    """Envuelve la escritura ``fn(db)`` para que guarde su resultado en la
+    reserva en la misma transaccion. Los conjuntos se guardan como listas."""
+    def escribir(db):
+        resultado = fn(db)
+        anteriores = escrituras(db, clave)
+        db.execute('UPDATE idempotencia SET escrituras = ? WHERE clave = ? AND huella = ? AND estado IS NULL',
+                   [json.dumps(anteriores + [resultado], default=sorted), clave, firma])
+        return resultado
+    return escribir
+
+
+def resultado(row, firma):
+    """Que hacer con una peticion cuya clave ya ocupa ``row``."""
+    if row[0] != firma:
+        return DISTINTA
+    if row[1] is None:
+        return EN_CURSO
+    return REPETIDA
+
+
+def completar(db, clave, firma, estado, cuerpo, cabeceras):
+    db.execute('''UPDATE idempotencia SET estado = ?, cuerpo = ?, cabeceras = ?
+                  WHERE clave = ? AND huella = ? AND estado IS NULL''',
+               [estado, cuerpo, json.dumps(cabeceras), clave, firma])
+
+
+def liberar(db, clave, firma):
+    db.execute('DELETE FROM idempotencia WHERE clave = ? AND huella = ? AND estado IS NULL', [clave, firma])
+
+
+def cabeceras_guardadas(row):
+    return [tuple(cabecera) for cabecera in json.loads(row[3] or '[]')]
+
+
+def podar(db, ahora, ttl, maximo):
+    """Borra las claves vencidas y, si quedan mas de ``maximo``, las mas viejas.
+    Devuelve cuantas borro."""
+    borradas = db.execute('DELETE FROM idempotencia WHERE creado < ?', [ahora - ttl]).rowcount
+    borradas += db.execute('''DELETE FROM idempotencia WHERE rowid IN (
+                                  SELECT rowid FROM idempotencia ORDER BY creado DESC LIMIT -1 OFFSET ?)''',
+                           [maximo]).rowcount
+    return borradas
@@ -0,0 +1,520 @@
+"""Mantenimiento de la base en segundo plano: VACUUM, ANALYZE, vacuum
+incremental y copias de seguridad.
+
+Despues de muchos ciclos de altas y bajas (como los de test-estabilidad.py)
+el archivo queda con paginas libres y las estadisticas del planificador
+viejas. Estas tareas son caras, asi que no corren dentro de una peticion:
+cada worker tiene un ``Mantenimiento`` con un hilo que las corre de a una,
+con su propia conexion, y guarda el estado de cada trabajo (progreso,
+duracion, resultado) para consultarlo por la API (/admin/jobs). A lo sumo
+``max_pendientes`` trabajos esperan en la cola; con la cola llena
+``encolar`` lanza ColaLlena.
+
+  - vacuum: reescribe la base entera. Las lecturas siguen (WAL), pero el
+    VACUUM toma el lock de escritura de principio a fin: una escritura
+    espera a lo sumo ``busy_timeout`` (DB_BUSY_TIMEOUT en backend.py, 5 s)
+    y despues falla con "database is locked". En una base grande conviene
+    correrlo sin trafico de escritura, o usar incremental_vacuum. Con
+    ``auto_vacuum`` cambia ademas el modo (p. ej. a 'incremental', para
+    usar la tarea siguiente);
+  - incremental_vacuum: devuelve al sistema las paginas libres de a
+    ``paginas`` por transaccion, sin frenar las escrituras mas que eso.
+    Requiere auto_vacuum=INCREMENTAL;
+  - analyze: recalcula las estadisticas que usa el planificador;
+  - podar_cambios: borra de la bitacora ``cambios`` lo que tenga mas de
+    ``max_edad`` segundos o quede fuera de las ``max_filas`` ultimas (ver
+    changes.py). Los clientes del feed que pidan cambios podados reciben
+    410 y recargan; el snapshot recarga el catalogo;
+  - backup: copia en linea con la API de backup de SQLite. Lecturas y
+    escrituras siguen mientras copia. Se copia de a ``paginas``; como una
+    escritura de otra conexion hace volver a empezar la copia, despues de
+    ``reintentos`` reinicios se copia todo en un solo paso (una lectura
+    consistente en WAL, sin bloquear a los que escriben). La copia se
+    escribe aparte y se renombra al terminar.
+
+Con ``programa`` ({tarea: segundos}) el hilo tambien corre tareas
+periodicas. La tabla ``mantenimiento`` (ver migrations.py) registra la
+ultima corrida de cada una, asi que con varios workers solo uno la corre
+en cada periodo.
+
+Tambien se usa desde la linea de comandos, contra el archivo y sin pasar
+por el servidor:
+
+    python maintenance.py [--database productos.db] vacuum [--auto-vacuum incremental]
+    python maintenance.py analyze
+    python maintenance.py podar_cambios [--max-edad 604800] [--max-filas 100000]
+    python maintenance.py incremental_vacuum [--paginas 256]
+    python maintenance.py backup respaldo.db [--paginas 1024]
+"""
+import argparse
+import collections
+import glob
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from changes import podar_cambios
+
+EN_COLA = 'en_cola'
+CORRIENDO = 'corriendo'
+TERMINADO = 'terminado'
+FALLIDO = 'fallido'
+CANCELADO = 'cancelado'
+
+MODOS_AUTO_VACUUM = ('none', 'full', 'incremental')
+
+log = logging.getLogger('crud.mantenimiento')
+
+
+class ColaLlena(RuntimeError):
+    """Ya hay ``max_pendientes`` trabajos esperando."""
+
+
+class Trabajo:
+    """Una corrida de una tarea; ``avanzar`` lo actualiza desde el hilo."""
+
+    def __init__(self, id, tarea, opciones, origen='api'):
+        self.id = id
+        self.tarea = tarea
+        self.opciones = opciones
+        self.origen = origen
+        self.estado = EN_COLA
+        self.progreso = 0.0
+        self.detalle = {}
+        self.creado = time.time()
+        self.inicio = self.fin = None
+        self.resultado = self.error = None
+
+    def avanzar(self, progreso, **detalle):
+        self.progreso = progreso
+        self.detalle.update(detalle)
+
+    @property
+    def duracion(self):
+        if self.inicio is None:
+            return None
+        return (self.fin or time.time()) - self.inicio
+
+    def como_dict(self):
+        return {
+            'id': self.id, 'tarea': self.tarea, 'opciones': self.opciones, 'origen': self.origen,
+            'estado': self.estado, 'progreso': round(self.progreso, 4), 'detalle': self.detalle,
+            'creado': self.creado, 'inicio': self.inicio, 'fin': self.fin, 'duracion': self.duracion,
+            'resultado': self.resultado, 'error': self.error,
+        }
+
+
+# -- tareas -----------------------------------------------------------------
+# Cada una recibe una conexion en autocommit (isolation_level=None), el
+# Trabajo para informar el avance y sus opciones; devuelve el resultado
+
+def tamano(db):
+    return {
+        'paginas': db.execute('PRAGMA page_count').fetchone()[0],
+        'libres': db.execute('PRAGMA freelist_count').fetchone()[0],
+        'page_size': db.execute('PRAGMA page_size').fetchone()[0],
+    }
+
+
+def checkpoint(db):
+    # En WAL el archivo principal se achica recien al pasar el WAL a la base;
+    # con lectores activos el checkpoint puede quedar a medias (ocupado=1)
+    ocupado, _, _ = db.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    return ocupado
+
+
+def compactar(db, trabajo, auto_vacuum=None):
+    antes = tamano(db)
+    if auto_vacuum is not None:
+        # El modo nuevo se aplica con el VACUUM que sigue
+        db.execute(f'PRAGMA auto_vacuum = {auto_vacuum.upper()}')
+    db.execute('VACUUM')
+    trabajo.avanzar(1.0)
+    despues = tamano(db)
+    return {
+        'paginas_antes': antes['paginas'], 'libres_antes': antes['libres'],
+        'paginas_despues': despues['paginas'], 'libres_despues': despues['libres'],
+        'bytes_liberados': (antes['paginas'] - despues['paginas']) * despues['page_size'],
+        'auto_vacuum': MODOS_AUTO_VACUUM[db.execute('PRAGMA auto_vacuum').fetchone()[0]],
+        'checkpoint_ocupado': checkpoint(db),
+    }
+
+
+def compactar_incremental(db, trabajo, paginas=256, pausa=0.01):
+    if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        raise ValueError('auto_vacuum no es INCREMENTAL; corra una vez vacuum con auto_vacuum=incremental')
+    antes = tamano(db)
+    inicial = libres = antes['libres']
+    while libres:
+        # execute() avanza una sola vez las sentencias sin columnas (y el
+        # pragma libera una pagina por paso); executescript lo corre entero
+        db.executescript(f'PRAGMA incremental_vacuum({int(paginas)});')
+        restantes = db.execute('PRAGMA freelist_count').fetchone()[0]
+        if restantes >= libres:
+            break
+        libres = restantes
+        trabajo.avanzar(1 - libres / inicial, libres=libres)
+        # Entre pasos las escrituras de los workers toman el lock
+        time.sleep(pausa)
+    trabajo.avanzar(1.0, libres=libres)
+    return {
+        'paginas_antes': antes['paginas'], 'libres_antes': inicial,
+        'paginas_despues': db.execute('PRAGMA page_count').fetchone()[0], 'libres_despues': libres,
+        'bytes_liberados': (inicial - libres) * antes['page_size'],
+        'checkpoint_ocupado': checkpoint(db),
+    }
+
+
+def analizar(db, trabajo):
+    db.execute('ANALYZE')
+    trabajo.avanzar(1.0)
+    return {'estadisticas': db.execute('SELECT COUNT(*) FROM sqlite_stat1').fetchone()[0]}
+
+
+def podar(db, trabajo, max_edad=None, max_filas=None):
+    borrados = podar_cambios(db, max_edad=max_edad, max_filas=max_filas)
+    trabajo.avanzar(1.0)
+    return {'borrados': borrados,
+            'restantes': db.execute('SELECT COUNT(*) FROM cambios').fetchone()[0]}
+
+
+class _Reiniciada(Exception):
+    pass
+
+
+def respaldar(db, trabajo, destino, paginas=1024, reintentos=3):
+    parcial = destino + '.parcial'
+    if os.path.exists(parcial):
+        os.unlink(parcial)
+    anterior = [None]
+    reinicios = [0]
+
+    def seguir(estado, restantes, total):
+        if anterior[0] is not None and restantes > anterior[0]:
+            reinicios[0] += 1
+            if reinicios[0] > reintentos:
+                raise _Reiniciada()
+        anterior[0] = restantes
+        trabajo.avanzar((total - restantes) / total if total else 1.0, paginas=total, reinicios=reinicios[0])
+
+    copia = sqlite3.connect(parcial)
+    try:
+        try:
+            db.backup(copia, pages=paginas, progress=seguir)
+            un_paso = False
+        except _Reiniciada:
+            db.backup(copia, pages=-1)
+            un_paso = True
+        # La copia queda en un solo archivo, sin -wal
+        copia.execute('PRAGMA journal_mode = DELETE')
+        total = copia.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        copia.close()
+    os.replace(parcial, destino)
+    trabajo.avanzar(1.0)
+    return {'destino': destino, 'bytes': os.path.getsize(destino), 'paginas': total,
+            'reinicios': reinicios[0], 'un_paso': un_paso}
+
+
+TAREAS = {
+    'vacuum': compactar,
+    'incremental_vacuum': compactar_incremental,
+    'analyze': analizar,
+    'podar_cambios': podar,
+    'backup': respaldar,
+}
+
+
+def _entero_positivo(valor):
+    return isinstance(valor, int) and not isinstance(valor, bool) and valor > 0
+
+
+def _segundos(valor):
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool) and 0 < valor < float('inf')
+
+
+def _nombre_archivo(valor):
+    # Por la API solo se elige el nombre: la copia queda en ``directorio``
+    return (isinstance(valor, str) and valor not in ('', '.', '..')
+            and os.path.basename(valor) == valor and not valor.endswith('.parcial'))
+
+
+# Opciones que acepta cada tarea desde la API, con su validacion
+OPCIONES = {
+    'vacuum': {'auto_vacuum': lambda valor: valor in MODOS_AUTO_VACUUM},
+    'incremental_vacuum': {'paginas': _entero_positivo},
+    'analyze': {},
+    'podar_cambios': {'max_edad': _segundos, 'max_filas': _entero_positivo},
+    'backup': {'destino': _nombre_archivo, 'paginas': _entero_positivo},
+}
+
+
+def validar(tarea, opciones):
+    if tarea not in TAREAS:
+        raise ValueError(f"Tarea desconocida: {tarea!r} (una de {', '.join(TAREAS)})")
+    if not isinstance(opciones, dict):
+        raise ValueError('opciones debe ser un objeto')
+    for nombre, valor in opciones.items():
+        valida = OPCIONES[tarea].get(nombre)
+        if valida is None:
+            raise ValueError(f'Opcion desconocida para {tarea}: {nombre!r}')
+        if not valida(valor):
+            raise ValueError(f'Valor invalido para {nombre}: {valor!r}')
+
+
+def reclamar(db, tarea, ahora, intervalo):
+    """True si a este worker le toca correr ``tarea``. La primera vez solo
+    registra el momento: la tarea corre pasado un intervalo."""
+    if db.execute('INSERT OR IGNORE INTO mantenimiento (tarea, ultimo) VALUES (?, ?)',
+                  [tarea, ahora]).rowcount:
+        return False
+    return db.execute('UPDATE mantenimiento SET ultimo = ? WHERE tarea = ? AND ultimo <= ?',
+                      [ahora, tarea, ahora - intervalo]).rowcount == 1
+
+
+class Mantenimiento:
+    """Cola de trabajos de mantenimiento de una base, corridos de a uno en
+    un hilo propio que arranca con el primer trabajo (o con ``iniciar``)."""
+
+    def __init__(self, database, pragmas=None, programa=None, directorio=None, conservar=7,
+                 opciones=None, revision=60.0, historial=100, max_pendientes=10, al_terminar=None):
+        self.database = database
+        self.pragmas = pragmas or {}
+        self.programa = dict(programa or {})
+        self.directorio = directorio or os.path.join(os.path.dirname(os.path.abspath(database)), 'respaldos')
+        self.conservar = conservar
+        # Opciones por defecto de cada tarea (p. ej. {'backup': {'paginas': 1024}})
+        self.opciones = opciones or {}
+        self.revision = revision
+        self.max_pendientes = max_pendientes
+        self.al_terminar = al_terminar
+        self.cerrado = False
+        self._ids = itertools.count(1)
+        self._cola = collections.deque()
+        # Trabajos recientes por id, terminados o no, para consultarlos
+        self._trabajos = collections.OrderedDict()
+        self._historial = historial
+        self._actual = None
+        self._db = None
+        self._cond = threading.Condition()
+        self._hilo = None
+        self._stats = {'trabajos': 0, 'errores': 0, 'rechazados': 0}
+        for tarea in self.programa:
+            validar(tarea, {})
+
+    def iniciar(self):
+        with self._cond:
+            if self._hilo is None and not self.cerrado:
+                self._hilo = threading.Thread(target=self._correr, name='mantenimiento', daemon=True)
+                self._hilo.start()
+
+    def encolar(self, tarea, opciones=None, origen='api'):
+        """Agrega un trabajo y lo devuelve; ValueError si la tarea o las
+        opciones no son validas, ColaLlena si ya hay ``max_pendientes``."""
+        opciones = dict(opciones or {})
+        validar(tarea, opciones)
+        with self._cond:
+            if self.cerrado:
+                raise RuntimeError('Mantenimiento cerrado')
+            if self.max_pendientes is not None and len(self._cola) >= self.max_pendientes:
+                self._stats['rechazados'] += 1
+                raise ColaLlena(f'Ya hay {len(self._cola)} trabajos pendientes')
+            trabajo = Trabajo(next(self._ids), tarea, opciones, origen)
+            self._cola.append(trabajo)
+            self._trabajos[trabajo.id] = trabajo
+            while len(self._trabajos) > self._historial:
+                viejo = next(iter(self._trabajos.values()))
+                if viejo.estado in (EN_COLA, CORRIENDO):
+                    break
+                self._trabajos.popitem(last=False)
+            self._cond.notify_all()
+        self.iniciar()
+        return trabajo
+
+    def trabajo(self, id):
+        with self._cond:
+            return self._trabajos.get(id)
+
+    def trabajos(self):
+        """Los trabajos recientes, el ultimo primero."""
+        with self._cond:
+            return list(reversed(self._trabajos.values()))
+
+    def esperar(self, trabajo, timeout=None):
+        """True si ``trabajo`` termino (bien o mal) dentro de ``timeout``."""
+        with self._cond:
+            return self._cond.wait_for(lambda: trabajo.estado not in (EN_COLA, CORRIENDO), timeout)
+
+    def cerrar(self):
+        """Cancela lo pendiente e interrumpe el trabajo en curso (un VACUUM o
+        una copia a medias se deshacen)."""
+        with self._cond:
+            self.cerrado = True
+            while self._cola:
+                self._cola.popleft().estado = CANCELADO
+            if self._db is not None:
+                self._db.interrupt()
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            actual = self._actual
+            stats = dict(self._stats)
+            stats.update(pendientes=len(self._cola), en_curso=int(actual is not None),
+                         progreso=actual.progreso if actual else 0.0,
+                         segundos_en_curso=actual.duracion if actual else 0.0)
+        return stats
+
+    # -- hilo -------------------------------------------------------------
+
+    def conectar(self):
+        db = sqlite3.connect(self.database, isolation_level=None, check_same_thread=False)
+        for nombre, valor in self.pragmas.items():
+            db.execute(f'PRAGMA {nombre} = {valor}')
+        return db
+
+    def _correr(self):
+        proxima = time.monotonic() if self.programa else None
+        while True:
+            with self._cond:
+                while not self.cerrado and not self._cola:
+                    if proxima is not None and time.monotonic() >= proxima:
+                        break
+                    self._cond.wait(None if proxima is None else proxima - time.monotonic())
+                if self.cerrado:
+                    return
+                trabajo = self._cola.popleft() if self._cola else None
+            if trabajo is not None:
+                self._ejecutar(trabajo)
+            else:
+                self._revisar_programa()
+                proxima = time.monotonic() + self.revision
+
+    def _revisar_programa(self):
+        try:
+            db = self.conectar()
+            try:
+                ahora = time.time()
+                for tarea, intervalo in self.programa.items():
+                    if reclamar(db, tarea, ahora, intervalo):
+                        self.encolar(tarea, origen='programado')
+            finally:
+                db.close()
+        except (sqlite3.Error, RuntimeError):
+            log.exception('No se pudo revisar el programa de mantenimiento')
+
+    def _ejecutar(self, trabajo):
+        opciones = dict(self.opciones.get(trabajo.tarea, {}), **trabajo.opciones)
+        nombrado = trabajo.tarea == 'backup' and 'destino' not in trabajo.opciones
+        if trabajo.tarea == 'backup':
+            opciones['destino'] = os.path.join(self.directorio, trabajo.opciones.get('destino') or self._nombre(trabajo))
+        try:
+            db = self.conectar()
+        except sqlite3.Error as error:
+            self._terminar(trabajo, error=error)
+            return
+        with self._cond:
+            if self.cerrado:
+                trabajo.estado = CANCELADO
+                db.close()
+                return
+            self._db, self._actual = db, trabajo
+            trabajo.estado, trabajo.inicio = CORRIENDO, time.time()
+        try:
+            if trabajo.tarea == 'backup':
+                os.makedirs(self.directorio, exist_ok=True)
+            resultado = TAREAS[trabajo.tarea](db, trabajo, **opciones)
+            if nombrado:
+                resultado['borrados'] = self._rotar()
+        except Exception as error:
+            self._terminar(trabajo, error=error)
+        else:
+            self._terminar(trabajo, resultado=resultado)
+        finally:
+            with self._cond:
+                self._db = None
+            db.close()
+
+    def _nombre(self, trabajo):
+        base = os.path.splitext(os.path.basename(self.database))[0]
+        return f"{base}-{time.strftime('%Y%m%d-%H%M%S')}-{trabajo.id}.db"
+
+    def _rotar(self):
+        # Solo las copias con nombre automatico; quedan las ``conservar`` ultimas
+        base = os.path.splitext(os.path.basename(self.database))[0]
+        copias = sorted(glob.glob(os.path.join(glob.escape(self.directorio), f'{glob.escape(base)}-*.db')),
+                        key=os.path.getmtime)
+        viejas = copias[:max(len(copias) - self.conservar, 0)]
+        for path in viejas:
+            os.unlink(path)
+        return len(viejas)
+
+    def _terminar(self, trabajo, resultado=None, error=None):
+        with self._cond:
+            trabajo.fin = time.time()
+            if trabajo.inicio is None:
+                trabajo.inicio = trabajo.fin
+            if error is None:
+                trabajo.estado, trabajo.resultado = TERMINADO, resultado
+                trabajo.progreso = 1.0
+                self._stats['trabajos'] += 1
+            else:
+                trabajo.estado, trabajo.error = FALLIDO, str(error) or type(error).__name__
+                self._stats['errores'] += 1
+            self._actual = None
+            self._cond.notify_all()
+        if error is not None:
+            log.warning('Mantenimiento %s (#%d) fallo: %s', trabajo.tarea, trabajo.id, trabajo.error)
+        if self.al_terminar is not None:
+            try:
+                self.al_terminar(trabajo)
+            except Exception:
+                log.exception('Error registrando el trabajo de mantenimiento #%d', trabajo.id)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default=os.environ.get('CRUD_DATABASE')
+                        or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'productos.db'))
+    parser.add_argument('--busy-timeout', type=int, default=5000)
+    tareas = parser.add_subparsers(dest='tarea', required=True)
+    tareas.add_parser('vacuum').add_argument('--auto-vacuum', choices=MODOS_AUTO_VACUUM)
+    tareas.add_parser('analyze')
+    tareas.add_parser('incremental_vacuum').add_argument('--paginas', type=int, default=256)
+    poda = tareas.add_parser('podar_cambios')
+    poda.add_argument('--max-edad', type=float)
+    poda.add_argument('--max-filas', type=int)
+    backup = tareas.add_parser('backup')
+    backup.add_argument('destino')
+    backup.add_argument('--paginas', type=int, default=1024)
+    args = parser.parse_args(argv)
+
+    opciones = {clave: valor for clave, valor in vars(args).items()
+                if clave not in ('database', 'busy_timeout', 'tarea') and valor is not None}
+    trabajo = Trabajo(0, args.tarea, opciones, origen='cli')
+    avanzar = trabajo.avanzar
+
+    def informar(progreso, **detalle):
+        avanzar(progreso, **detalle)
+        print(f'\r{args.tarea}: {progreso:6.1%}', end='', file=sys.stderr, flush=True)
+
+    trabajo.avanzar = informar
+    db = sqlite3.connect(args.database, isolation_level=None)
+    db.execute(f'PRAGMA busy_timeout = {int(args.busy_timeout)}')
+    trabajo.inicio = time.time()
+    try:
+        resultado = TAREAS[args.tarea](db, trabajo, **opciones)
+    finally:
+        db.close()
+    print(file=sys.stderr)
+    print(json.dumps(dict(resultado, duracion=round(time.time() - trabajo.inicio, 3)), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+import bisect
+import logging
+import sqlite3
+import threading
+import time
+
+# Limites (en segundos) de los histogramas de latencia
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+AYUDA = {
+    'crud_http_requests_total': 'Peticiones HTTP atendidas',
+    'crud_http_request_duration_seconds': 'Duracion de la peticion (hasta el primer byte en streaming)',
+    'crud_phase_duration_seconds': 'Tiempo por fase dentro de la peticion',
+    'crud_slow_queries_total': 'Consultas que superaron el umbral de consulta lenta',
+    'crud_compression_responses_total': 'Respuestas comprimidas',
+    'crud_compression_bytes_in_total': 'Bytes antes de comprimir (la razon es bytes_in / bytes_out)',
+    'crud_compression_bytes_out_total': 'Bytes despues de comprimir',
+    'crud_compression_cpu_seconds_total': 'Tiempo de CPU gastado comprimiendo',
+    'crud_compression_cache_hits_total': 'Respuestas servidas ya comprimidas desde la cache',
+    'crud_compression_skipped_total': 'Respuestas comprimibles que se enviaron sin comprimir',
+    'crud_idempotency_requests_total': 'Escrituras con Idempotency-Key por resultado (nueva, reanudada, repetida, en_curso, distinta)',
+    'crud_admission_requests_total': 'Peticiones con politica de admision por resultado (admitida, limite_cliente, limite_endpoint, cola_llena, latencia, espera_agotada)',
+    'crud_maintenance_jobs_total': 'Trabajos de mantenimiento por tarea y resultado (terminado, fallido)',
+    'crud_maintenance_job_duration_seconds': 'Duracion de los trabajos de mantenimiento',
+}
+
+log_lentas = logging.getLogger('crud.consultas_lentas')
+
+_local = threading.local()
+
+
+class Histograma:
+    __slots__ = ('buckets', 'conteos', 'suma', 'total')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.conteos = [0] * len(buckets)
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        i = bisect.bisect_left(self.buckets, valor)
+        if i < len(self.conteos):
+            self.conteos[i] += 1
+        self.suma += valor
+        self.total += 1
+
+
+class Metricas:
+    """Contadores e histogramas con etiquetas, exportables en formato Prometheus.
+
+    Los tiempos por fase (pool, db, serializacion, ...) se acumulan en una
+    variable local al hilo entre ``iniciar()`` y ``terminar()``; fuera de una
+    peticion medida ``acumular()`` no hace nada.
+    """
+
+    def __init__(self, buckets=BUCKETS, umbral_lentas=None):
+        self.buckets = tuple(buckets)
+        self.umbral_lentas = umbral_lentas
+        self._contadores = {}
+        self._histogramas = {}
+        self._lock = threading.Lock()
+
+    # Las etiquetas son tuplas de pares (nombre, valor); quien llama debe
+    # pasarlas siempre en el mismo orden
+
+    def contar(self, nombre, etiquetas=(), valor=1):
+        clave = (nombre, etiquetas)
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def observar(self, nombre, segundos, etiquetas=()):
+        with self._lock:
+            self._observar((nombre, etiquetas), segundos)
+
+    def _observar(self, clave, segundos):
+        histograma = self._histogramas.get(clave)
+        if histograma is None:
+            histograma = self._histogramas[clave] = Histograma(self.buckets)
+        histograma.observar(segundos)
+
+    def peticion(self, endpoint, method, status, duracion, fases):
+        """Registra una peticion completa tomando el lock una sola vez."""
+        clave = ('crud_http_requests_total',
+                 (('endpoint', endpoint), ('method', method), ('status', str(status))))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + 1
+            self._observar(('crud_http_request_duration_seconds',
+                            (('endpoint', endpoint), ('method', method))), duracion)
+            for fase, segundos in fases.items():
+                self._observar(('crud_phase_duration_seconds',
+                                (('endpoint', endpoint), ('phase', fase))), segundos)
+
+    def iniciar(self):
+        _local.tiempos = {}
+
+    def terminar(self):
+        return _local.__dict__.pop('tiempos', None) or {}
+
+    @staticmethod
+    def activo():
+        return getattr(_local, 'tiempos', None) is not None
+
+    @staticmethod
+    def acumular(fase, segundos):
+        tiempos = getattr(_local, 'tiempos', None)
+        if tiempos is not None:
+            tiempos[fase] = tiempos.get(fase, 0.0) + segundos
+
+    def consulta_lenta(self, sql, segundos):
+        self.contar('crud_slow_queries_total')
+        log_lentas.warning('Consulta lenta (%.1f ms): %s', segundos * 1000, ' '.join(sql.split()))
+
+    def clase_conexion(self):
+        """Conexion SQLite cuyos cursores miden execute/fetch y avisan de
+        las consultas lentas. Solo se usa con las metricas activadas."""
+        metricas = self
+
+        class CursorMedido(sqlite3.Cursor):
+            _sql = None
+            _segundos = 0.0
+            _avisado = False
+
+            def _medir(self, inicio):
+                segundos = time.perf_counter() - inicio
+                Metricas.acumular('db', segundos)
+                # Cuenta execute + fetch de la misma consulta; avisa una vez
+                self._segundos += segundos
+                umbral = metricas.umbral_lentas
+                if umbral is not None and not self._avisado and self._segundos >= umbral:
+                    self._avisado = True
+                    metricas.consulta_lenta(self._sql, self._segundos)
+
+            def execute(self, sql, parameters=()):
+                self._sql, self._segundos, self._avisado = sql, 0.0, False
+                inicio = time.perf_counter()
+                try:
+                    return super().execute(sql, parameters)
+                finally:
+                    self._medir(inicio)
+
+            def executemany(self, sql, seq_of_parameters):
+                self._sql, self._segundos, self._avisado = sql, 0.0, False
+                inicio = time.perf_counter()
+                try:
+                    return super().executemany(sql, seq_of_parameters)
+                finally:
+                    self._medir(inicio)
+
+            def fetchone(self):
+                inicio = time.perf_counter()
+                try:
+                    return super().fetchone()
+                finally:
+                    self._medir(inicio)
+
+            def fetchmany(self, size=None):
+                inicio = time.perf_counter()
+                try:
+                    return super().fetchmany(self.arraysize if size is None else size)
+                finally:
+                    self._medir(inicio)
+
+            def fetchall(self):
+                inicio = time.perf_counter()
+                try:
+                    return super().fetchall()
+                finally:
+                    self._medir(inicio)
+
+            def __next__(self):
+                inicio = time.perf_counter()
+                try:
+                    return super().__next__()
+                finally:
+                    self._medir(inicio)
+
+        class ConexionMedida(sqlite3.Connection):
+            def cursor(self, factory=CursorMedido):
+                return super().cursor(factory)
+
+            def execute(self, sql, parameters=()):
+                return self.cursor().execute(sql, parameters)
+
+            def executemany(self, sql, seq_of_parameters):
+                return self.cursor().executemany(sql, seq_of_parameters)
+
+        return ConexionMedida
+
+    def exportar(self, extras=()):
+        """Texto en formato de exposicion de Prometheus. ``extras`` son
+        tuplas (nombre, tipo, ayuda, valor) de medidores externos."""
+        with self._lock:
+            contadores = sorted(self._contadores.items())
+            histogramas = sorted((clave, (list(h.conteos), h.suma, h.total))
+                                 for clave, h in self._histogramas.items())
+        lineas = []
+        vistos = set()
+
+        def cabecera(nombre, tipo, ayuda=None):
+            if nombre not in vistos:
+                vistos.add(nombre)
+                lineas.append(f'# HELP {nombre} {ayuda or AYUDA.get(nombre, nombre)}')
+                lineas.append(f'# TYPE {nombre} {tipo}')
+
+        for (nombre, etiquetas), valor in contadores:
+            cabecera(nombre, 'counter')
+            lineas.append(f'{nombre}{formatear_etiquetas(etiquetas)} {valor}')
+        for (nombre, etiquetas), (conteos, suma, total) in histogramas:
+            cabecera(nombre, 'histogram')
+            acumulado = 0
+            for limite, conteo in zip(self.buckets, conteos):
+                acumulado += conteo
+                le = formatear_etiquetas(etiquetas + (('le', repr(limite)),))
+                lineas.append(f'{nombre}_bucket{le} {acumulado}')
+            lineas.append(f"{nombre}_bucket{formatear_etiquetas(etiquetas + (('le', '+Inf'),))} {total}")
+            lineas.append(f'{nombre}_sum{formatear_etiquetas(etiquetas)} {suma}')
+            lineas.append(f'{nombre}_count{formatear_etiquetas(etiquetas)} {total}')
+        for nombre, tipo, ayuda, valor in extras:
+            cabecera(nombre, tipo, ayuda)
+            lineas.append(f'{nombre} {valor}')
+        return '\n'.join(lineas) + '\n'
+
+
+def formatear_etiquetas(etiquetas):
+    if not etiquetas:
+        return ''
+    pares = ','.join(f'{clave}="{escapar(valor)}"' for clave, valor in etiquetas)
+    return '{' + pares + '}'
+
+
+def escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Estadisticas de pool/escritor/cache que son acumulativas (el resto son
+# valores instantaneos)
+ACUMULATIVAS = {'checkouts', 'waits', 'wait_seconds', 'timeouts', 'created', 'discarded',
+                'jobs', 'batches', 'errors', 'hits', 'misses', 'evictions', 'expirations',
+                'invalidations', 'cargas', 'sincronizaciones', 'cambios_aplicados', 'sondeos',
+                'eventos', 'errores', 'rechazados', 'trabajos',
+                'admitidas', 'rechazadas'}
+
+
+def desde_stats(prefijo, stats, ayuda):
+    """Convierte el dict de ``stats()`` de un componente en medidores extra."""
+    extras = []
+    for clave, valor in sorted(stats.items()):
+        if clave in ACUMULATIVAS:
+            extras.append((f'{prefijo}_{clave}_total', 'counter', f'{ayuda}: {clave}', valor))
+        else:
+            extras.append((f'{prefijo}_{clave}', 'gauge', f'{ayuda}: {clave}', valor))
+    return extras
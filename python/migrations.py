@@ -0,0 +1,178 @@
+import sqlite3
+import time
+
+AHORA_SQL = "(julianday('now') - 2440587.5) * 86400.0"
+
+
+def crear_productos(db):
+    db.execute('''CREATE TABLE IF NOT EXISTS productos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT NOT NULL,
+        precio REAL NOT NULL,
+        descripcion TEXT)''')
+
+
+def versiones(db):
+    columnas = {row[1] for row in db.execute('PRAGMA table_info(productos)')}
+    if 'version' not in columnas:
+        db.execute('ALTER TABLE productos ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+    # Version global del catalogo: la suben los triggers en cada escritura,
+    # venga de la API o de cualquier otra conexion
+    db.execute('''CREATE TABLE IF NOT EXISTS catalogo (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL,
+        actualizado REAL NOT NULL)''')
+    db.execute(f'INSERT OR IGNORE INTO catalogo (id, version, actualizado) VALUES (1, 0, {AHORA_SQL})')
+    for nombre, evento in (('productos_ai', 'INSERT'),
+                           ('productos_au', 'UPDATE OF nombre, precio, descripcion'),
+                           ('productos_ad', 'DELETE')):
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS {nombre} AFTER {evento} ON productos
+            BEGIN
+                UPDATE catalogo SET version = version + 1, actualizado = {AHORA_SQL} WHERE id = 1;
+            END''')
+    db.execute('''CREATE TRIGGER IF NOT EXISTS productos_version
+        AFTER UPDATE OF nombre, precio, descripcion ON productos
+        BEGIN
+            UPDATE productos SET version = OLD.version + 1 WHERE id = NEW.id;
+        END''')
+
+
+def indices_busqueda(db):
+    db.execute('CREATE INDEX IF NOT EXISTS idx_productos_nombre ON productos (nombre)')
+    # Necesario para que LIKE 'prefijo%' (sin distinguir mayusculas) use indice
+    db.execute('CREATE INDEX IF NOT EXISTS idx_productos_nombre_nocase ON productos (nombre COLLATE NOCASE)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_productos_precio ON productos (precio)')
+
+
+def busqueda_texto(db):
+    try:
+        db.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS productos_fts USING fts5(
+            nombre, descripcion,
+            content='productos', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2')''')
+    except sqlite3.OperationalError:
+        # SQLite compilado sin FTS5: la busqueda queda deshabilitada
+        return
+    db.execute('''CREATE TRIGGER IF NOT EXISTS productos_fts_ai AFTER INSERT ON productos
+        BEGIN
+            INSERT INTO productos_fts (rowid, nombre, descripcion)
+            VALUES (NEW.id, NEW.nombre, NEW.descripcion);
+        END''')
+    db.execute('''CREATE TRIGGER IF NOT EXISTS productos_fts_ad AFTER DELETE ON productos
+        BEGIN
+            INSERT INTO productos_fts (productos_fts, rowid, nombre, descripcion)
+            VALUES ('delete', OLD.id, OLD.nombre, OLD.descripcion);
+        END''')
+    db.execute('''CREATE TRIGGER IF NOT EXISTS productos_fts_au AFTER UPDATE OF nombre, descripcion ON productos
+        BEGIN
+            INSERT INTO productos_fts (productos_fts, rowid, nombre, descripcion)
+            VALUES ('delete', OLD.id, OLD.nombre, OLD.descripcion);
+            INSERT INTO productos_fts (rowid, nombre, descripcion)
+            VALUES (NEW.id, NEW.nombre, NEW.descripcion);
+        END''')
+    # El nombre pesa mas que la descripcion en el ranking
+    db.execute("INSERT INTO productos_fts (productos_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+    db.execute("INSERT INTO productos_fts (productos_fts) VALUES ('rebuild')")
+
+
+def registro_cambios(db):
+    # Bitacora de cambios por producto, escrita por triggers para que la
+    # llenen tanto la API como cualquier otra conexion. seq es
+    # AUTOINCREMENT: nunca se reutiliza aunque se poden filas viejas
+    db.execute('''CREATE TABLE IF NOT EXISTS cambios (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        producto_id INTEGER NOT NULL,
+        operacion TEXT NOT NULL CHECK (operacion IN ('I', 'U', 'D')),
+        momento REAL NOT NULL)''')
+    for nombre, evento, fila, operacion in (('cambios_ai', 'INSERT', 'NEW', 'I'),
+                                            ('cambios_au', 'UPDATE OF nombre, precio, descripcion', 'NEW', 'U'),
+                                            ('cambios_ad', 'DELETE', 'OLD', 'D')):
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS {nombre} AFTER {evento} ON productos
+            BEGIN
+                INSERT INTO cambios (producto_id, operacion, momento)
+                VALUES ({fila}.id, '{operacion}', {AHORA_SQL});
+            END''')
+
+
+def claves_idempotencia(db):
+    # Respuestas guardadas por Idempotency-Key (ver idempotency.py). estado
+    # NULL es una reserva: la peticion original todavia no termino
+    db.execute('''CREATE TABLE IF NOT EXISTS idempotencia (
+        clave TEXT PRIMARY KEY,
+        huella TEXT NOT NULL,
+        estado INTEGER,
+        cuerpo BLOB,
+        cabeceras TEXT,
+        creado REAL NOT NULL)''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_idempotencia_creado ON idempotencia (creado)')
+
+
+def tareas_mantenimiento(db):
+    # Ultima corrida de cada tarea programada (ver maintenance.py): el worker
+    # que actualiza la fila es el unico que la corre en ese periodo
+    db.execute('''CREATE TABLE IF NOT EXISTS mantenimiento (
+        tarea TEXT PRIMARY KEY,
+        ultimo REAL NOT NULL)''')
+
+
+def escrituras_idempotentes(db):
+    # Resultado de cada escritura confirmada por la peticion de una reserva
+    # (ver idempotency.py): un reintento que toma la reserva abandonada los
+    # repite en lugar de volver a escribir
+    columnas = [row[1] for row in db.execute('PRAGMA table_info(idempotencia)')]
+    if 'escrituras' not in columnas:
+        db.execute('ALTER TABLE idempotencia ADD COLUMN escrituras TEXT')
+
+
+# Pasos en orden; cada uno debe ser idempotente (IF NOT EXISTS) porque una
+# base cuya tabla productos se borro a mano vuelve a aplicarlos todos
+MIGRACIONES = [
+    (1, 'tabla productos', crear_productos),
+    (2, 'version por fila y version del catalogo', versiones),
+    (3, 'indices por nombre y precio', indices_busqueda),
+    (4, 'busqueda de texto completo (FTS5)', busqueda_texto),
+    (5, 'bitacora de cambios', registro_cambios),
+    (6, 'claves de idempotencia', claves_idempotencia),
+    (7, 'tareas de mantenimiento programadas', tareas_mantenimiento),
+    (8, 'escrituras confirmadas por clave de idempotencia', escrituras_idempotentes),
+]
+
+
+def version_actual(db):
+    return db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def existe_productos(db):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'productos'").fetchone() is not None
+
+
+def aplicar_migraciones(db, migraciones=MIGRACIONES):
+    """Aplica las migraciones pendientes; ``db`` debe estar en modo autocommit
+    (isolation_level=None). Devuelve las versiones aplicadas."""
+    db.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        descripcion TEXT NOT NULL,
+        aplicada REAL NOT NULL)''')
+    # Caso comun (cada worker, cada base de prueba): nada pendiente, sin
+    # abrir una transaccion por paso
+    if migraciones and version_actual(db) >= migraciones[-1][0] and existe_productos(db):
+        return []
+    aplicadas = []
+    for version, descripcion, paso in migraciones:
+        # BEGIN IMMEDIATE serializa a varios procesos migrando a la vez
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if not existe_productos(db):
+                db.execute('DELETE FROM schema_version')
+            if version <= version_actual(db):
+                db.execute('COMMIT')
+                continue
+            paso(db)
+            db.execute('INSERT INTO schema_version (version, descripcion, aplicada) VALUES (?, ?, ?)',
+                       [version, descripcion, time.time()])
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        aplicadas.append(version)
+    return aplicadas
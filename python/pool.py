@@ -0,0 +1,110 @@
+import queue
+import sqlite3
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Pool acotado de conexiones SQLite reutilizables entre peticiones."""
+
+    def __init__(self, database, size=8, timeout=5.0, pragmas=None, factory=sqlite3.Connection,
+                 cached_statements=128):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(pragmas or {})
+        self.factory = factory
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'discarded': 0,
+        }
+
+    def _connect(self):
+        # Cada conexion guarda compiladas las ultimas ``cached_statements``
+        # sentencias distintas (por texto SQL)
+        db = sqlite3.connect(self.database, check_same_thread=False, factory=self.factory,
+                             cached_statements=self.cached_statements)
+        # Los PRAGMA se aplican una sola vez, al crear la conexion
+        for name, value in self.pragmas.items():
+            db.execute(f'PRAGMA {name} = {value}')
+        return db
+
+    def acquire(self):
+        try:
+            db = self._idle.get_nowait()
+        except queue.Empty:
+            db = None
+        if db is None:
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    self._stats['created'] += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    db = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                inicio = time.perf_counter()
+                try:
+                    db = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    raise PoolTimeout('No hay conexiones disponibles en el pool')
+                with self._lock:
+                    self._stats['waits'] += 1
+                    self._stats['wait_seconds'] += time.perf_counter() - inicio
+        with self._lock:
+            self._stats['checkouts'] += 1
+        return db
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        if self._closed:
+            self._discard(db)
+            return
+        self._idle.put(db)
+
+    def _discard(self, db):
+        db.close()
+        with self._lock:
+            self._created -= 1
+            self._stats['discarded'] += 1
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(db)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['open'] = self._created
+        stats['idle'] = self._idle.qsize()
+        stats['in_use'] = stats['open'] - stats['idle']
+        return stats
@@ -0,0 +1,177 @@
+"""Perfilado opcional por peticion, como middleware WSGI.
+
+Una peticion se perfila si:
+  - la pide un cliente autorizado con la cabecera ``X-Profile`` o el
+    parametro ``?_profile=`` (valor ``return`` devuelve el perfil en lugar
+    de la respuesta; cualquier otro lo guarda en PROFILE_DIR), o
+  - cae en el muestreo continuo (PROFILE_SAMPLE_RATE), que siempre guarda.
+
+Autorizado es quien manda ``X-Profile-Token`` igual a PROFILE_TOKEN o llega
+desde una de PROFILE_ALLOWED_IPS (vacia por defecto): sin configurar nada
+nadie puede pedir un perfil.
+
+Modos (PROFILE_MODE):
+  cprofile  perfilador determinista; genera un .prof de pstats (snakeviz,
+            ``python -m pstats``)
+  sample    muestreador de pilas cada PROFILE_INTERVAL segundos; genera un
+            .folded (pilas colapsadas para flamegraph.pl o speedscope).
+            Cuesta mucho menos que cprofile en la peticion perfilada.
+"""
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from urllib.parse import parse_qs
+
+
+class Muestreador:
+    """Toma la pila de un hilo a intervalos fijos y cuenta pilas identicas."""
+
+    def __init__(self, thread_id, intervalo=0.001):
+        self.thread_id = thread_id
+        self.intervalo = intervalo
+        self.pilas = Counter()
+        self._fin = threading.Event()
+        self._hilo = threading.Thread(target=self._correr, name='profiler', daemon=True)
+
+    def __enter__(self):
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._fin.set()
+        self._hilo.join()
+
+    def _correr(self):
+        while not self._fin.wait(self.intervalo):
+            frame = sys._current_frames().get(self.thread_id)
+            pila = []
+            while frame is not None:
+                code = frame.f_code
+                pila.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if pila:
+                self.pilas[';'.join(reversed(pila))] += 1
+
+    def colapsado(self):
+        return ''.join(f'{pila} {n}\n' for pila, n in self.pilas.most_common())
+
+
+class ProfilingMiddleware:
+    """Envuelve una aplicacion WSGI; lee la configuracion en cada peticion
+    desde ``config`` (p. ej. ``app.config``), asi que se activa sin reiniciar."""
+
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+        # Un solo perfil a la vez: los perfiladores no se pueden anidar y asi
+        # el costo del perfilado queda acotado a una peticion
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        config = self.config
+        if not config.get('PROFILE_ENABLED'):
+            return self.app(environ, start_response)
+        pedido = self.pedido(environ)
+        if pedido is None:
+            tasa = config.get('PROFILE_SAMPLE_RATE') or 0.0
+            if not (tasa and config.get('PROFILE_DIR') and random.random() < tasa):
+                return self.app(environ, start_response)
+            pedido = 'store'
+        if not self._lock.acquire(blocking=False):
+            return self.app(environ, start_response)
+        try:
+            return self.perfilar(environ, start_response, pedido)
+        finally:
+            self._lock.release()
+
+    def pedido(self, environ):
+        valor = environ.get('HTTP_X_PROFILE')
+        if valor is None and '_profile' in environ.get('QUERY_STRING', ''):
+            valor = parse_qs(environ['QUERY_STRING']).get('_profile', [None])[0]
+        if not valor or not self.autorizado(environ):
+            return None
+        if valor == 'return' or not self.config.get('PROFILE_DIR'):
+            return 'return'
+        return 'store'
+
+    def autorizado(self, environ):
+        token = self.config.get('PROFILE_TOKEN')
+        if token and hmac.compare_digest(environ.get('HTTP_X_PROFILE_TOKEN', ''), token):
+            return True
+        return environ.get('REMOTE_ADDR') in self.config.get('PROFILE_ALLOWED_IPS', ())
+
+    def perfilar(self, environ, start_response, pedido):
+        inicio = {}
+
+        def capturar(status, headers, exc_info=None):
+            inicio['status'], inicio['headers'] = status, headers
+            return lambda data: partes.append(data)
+
+        # El cuerpo se consume dentro del perfil para incluir las respuestas
+        # en streaming; la respuesta perfilada queda en memoria
+        partes = []
+        modo = self.config.get('PROFILE_MODE', 'cprofile')
+        comienzo = time.perf_counter()
+        if modo == 'sample':
+            perfil = Muestreador(threading.get_ident(), self.config.get('PROFILE_INTERVAL', 0.001))
+            with perfil:
+                self.consumir(environ, capturar, partes)
+        else:
+            perfil = cProfile.Profile()
+            perfil.enable()
+            try:
+                self.consumir(environ, capturar, partes)
+            finally:
+                perfil.disable()
+        duracion = time.perf_counter() - comienzo
+
+        if pedido == 'return':
+            cuerpo = self.reporte(perfil).encode('utf-8')
+            start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8'),
+                                      ('Content-Length', str(len(cuerpo))),
+                                      ('X-Profile-Duration', f'{duracion * 1000:.1f}ms')])
+            return [cuerpo]
+        archivo = self.guardar(environ, perfil)
+        headers = [(nombre, valor) for nombre, valor in inicio['headers']]
+        headers.append(('X-Profile-File', os.path.basename(archivo)))
+        start_response(inicio['status'], headers)
+        return partes
+
+    def consumir(self, environ, start_response, partes):
+        iterable = self.app(environ, start_response)
+        try:
+            partes.extend(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    @staticmethod
+    def reporte(perfil, lineas=40):
+        if isinstance(perfil, Muestreador):
+            return perfil.colapsado()
+        salida = io.StringIO()
+        pstats.Stats(perfil, stream=salida).sort_stats('cumulative').print_stats(lineas)
+        return salida.getvalue()
+
+    def guardar(self, environ, perfil):
+        directorio = self.config['PROFILE_DIR']
+        os.makedirs(directorio, exist_ok=True)
+        ruta = re.sub(r'[^A-Za-z0-9]+', '_', environ.get('PATH_INFO', '')).strip('_') or 'raiz'
+        nombre = f"{time.strftime('%Y%m%d-%H%M%S')}-{environ['REQUEST_METHOD']}-{ruta}-{uuid.uuid4().hex[:8]}"
+        if isinstance(perfil, Muestreador):
+            archivo = os.path.join(directorio, nombre + '.folded')
+            with open(archivo, 'w', encoding='utf-8') as f:
+                f.write(perfil.colapsado())
+        else:
+            archivo = os.path.join(directorio, nombre + '.prof')
+            perfil.dump_stats(archivo)
+        return archivo
@@ -3,23 +3,21 @@ import json
 import tempfile
 import os
 import sqlite3
-from backend import app
+from unittest.mock import patch
+import fixtures
+from cache import CachedResponse, LRUCache
+from migrations import MIGRACIONES, aplicar_migraciones
+from pool import ConnectionPool, PoolTimeout
 
-class TestBackend(unittest.TestCase):
-    
-    def setUp(self):
-        """Configuración antes de cada prueba"""
-        app.config['TESTING'] = True
-        self.app = app.test_client()
+class TestBackend(fixtures.BaseAislada):
 
-        # Crear base de datos temporal (Windows compatible)
-        fd, self.temp_db_name = tempfile.mkstemp(suffix=".db")
-        os.close(fd)
+    # Base vacia: la tabla se crea aqui y las migraciones corren al usarla
+    migrada = False
 
-        # Cambiar la base de datos en el backend
-        import backend
-        self.original_database = backend.DATABASE
-        backend.DATABASE = self.temp_db_name
+    def setUp(self):
+        """Configuración antes de cada prueba"""
+        super().setUp()
+        self.client = self.app.test_client()
 
         # Crear la tabla
         db = sqlite3.connect(self.temp_db_name)
@@ -31,16 +29,9 @@ class TestBackend(unittest.TestCase):
         db.commit()
         db.close()
 
-    def tearDown(self):
-        """Limpieza después de cada prueba"""
-        import backend
-        backend.DATABASE = self.original_database
-        if os.path.exists(self.temp_db_name):
-            os.unlink(self.temp_db_name)
-
     def insert_test_product(self, nombre="Producto Test", precio=10.99, descripcion="Descripción test"):
         """Helper para insertar un producto de prueba"""
-        db = sqlite3.connect(self.temp_db.name)
+        db = sqlite3.connect(self.temp_db_name)
         cursor = db.execute('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)',
                           [nombre, precio, descripcion])
         product_id = cursor.lastrowid
@@ -50,12 +41,12 @@ class TestBackend(unittest.TestCase):
 
     def test_home_route(self):
         """Prueba la ruta principal"""
-        response = self.app.get('/')
+        response = self.client.get('/')
         self.assertEqual(response.status_code, 200)
 
     def test_get_productos_empty(self):
         """Prueba obtener productos cuando la base está vacía"""
-        response = self.app.get('/productos')
+        response = self.client.get('/productos')
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
         self.assertEqual(data, [])
@@ -68,7 +59,7 @@ class TestBackend(unittest.TestCase):
             'descripcion': 'Laptop gaming'
         }
         
-        response = self.app.post('/productos',
+        response = self.client.post('/productos',
                                data=json.dumps(producto_data),
                                content_type='application/json')
         
@@ -77,7 +68,7 @@ class TestBackend(unittest.TestCase):
         self.assertEqual(data['mensaje'], 'Producto guardado correctamente')
         
         # Verificar que el producto se guardó en la base de datos
-        db = sqlite3.connect(self.temp_db.name)
+        db = sqlite3.connect(self.temp_db_name)
         cursor = db.execute('SELECT * FROM productos WHERE nombre = ?', ['Laptop'])
         row = cursor.fetchone()
         self.assertIsNotNone(row)
@@ -92,7 +83,7 @@ class TestBackend(unittest.TestCase):
         self.insert_test_product("Producto 1", 10.0, "Descripción 1")
         self.insert_test_product("Producto 2", 20.0, "Descripción 2")
         
-        response = self.app.get('/productos')
+        response = self.client.get('/productos')
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
         
@@ -104,7 +95,7 @@ class TestBackend(unittest.TestCase):
         """Prueba obtener un producto específico que existe"""
         product_id = self.insert_test_product("Producto Específico", 25.50, "Descripción específica")
         
-        response = self.app.get(f'/productos/{product_id}')
+        response = self.client.get(f'/productos/{product_id}')
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
         
@@ -115,7 +106,7 @@ class TestBackend(unittest.TestCase):
 
     def test_get_producto_by_id_not_exists(self):
         """Prueba obtener un producto que no existe"""
-        response = self.app.get('/productos/999')
+        response = self.client.get('/productos/999')
         self.assertEqual(response.status_code, 404)
         data = json.loads(response.data)
         self.assertEqual(data['error'], 'Producto no encontrado')
@@ -130,7 +121,7 @@ class TestBackend(unittest.TestCase):
             'descripcion': 'Descripción actualizada'
         }
         
-        response = self.app.put(f'/productos/{product_id}',
+        response = self.client.put(f'/productos/{product_id}',
                               data=json.dumps(updated_data),
                               content_type='application/json')
         
@@ -139,7 +130,7 @@ class TestBackend(unittest.TestCase):
         self.assertEqual(data['mensaje'], 'Producto actualizado')
         
         # Verificar que el producto se actualizó en la base de datos
-        db = sqlite3.connect(self.temp_db.name)
+        db = sqlite3.connect(self.temp_db_name)
         cursor = db.execute('SELECT * FROM productos WHERE id = ?', [product_id])
         row = cursor.fetchone()
         self.assertEqual(row[1], 'Producto Actualizado')
@@ -151,13 +142,13 @@ class TestBackend(unittest.TestCase):
         """Prueba eliminar un producto existente"""
         product_id = self.insert_test_product("Producto a Eliminar", 5.0, "Para eliminar")
         
-        response = self.app.delete(f'/productos/{product_id}')
+        response = self.client.delete(f'/productos/{product_id}')
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
         self.assertEqual(data['mensaje'], 'Producto eliminado')
         
         # Verificar que el producto fue eliminado de la base de datos
-        db = sqlite3.connect(self.temp_db.name)
+        db = sqlite3.connect(self.temp_db_name)
         cursor = db.execute('SELECT * FROM productos WHERE id = ?', [product_id])
         row = cursor.fetchone()
         self.assertIsNone(row)
@@ -172,18 +163,18 @@ class TestBackend(unittest.TestCase):
             'descripcion': 'Prueba CRUD completa'
         }
         
-        response = self.app.post('/productos',
+        response = self.client.post('/productos',
                                data=json.dumps(producto_data),
                                content_type='application/json')
         self.assertEqual(response.status_code, 200)
         
         # READ - obtener todos los productos
-        response = self.app.get('/productos')
+        response = self.client.get('/productos')
         data = json.loads(response.data)
         product_id = data[0]['id']
         
         # READ - obtener producto específico
-        response = self.app.get(f'/productos/{product_id}')
+        response = self.client.get(f'/productos/{product_id}')
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
         self.assertEqual(data['nombre'], 'Producto CRUD')
@@ -195,27 +186,27 @@ class TestBackend(unittest.TestCase):
             'descripcion': 'Descripción actualizada'
         }
         
-        response = self.app.put(f'/productos/{product_id}',
+        response = self.client.put(f'/productos/{product_id}',
                               data=json.dumps(updated_data),
                               content_type='application/json')
         self.assertEqual(response.status_code, 200)
         
         # Verificar actualización
-        response = self.app.get(f'/productos/{product_id}')
+        response = self.client.get(f'/productos/{product_id}')
         data = json.loads(response.data)
         self.assertEqual(data['nombre'], 'Producto CRUD Actualizado')
         
         # DELETE
-        response = self.app.delete(f'/productos/{product_id}')
+        response = self.client.delete(f'/productos/{product_id}')
         self.assertEqual(response.status_code, 200)
         
         # Verificar eliminación
-        response = self.app.get(f'/productos/{product_id}')
+        response = self.client.get(f'/productos/{product_id}')
         self.assertEqual(response.status_code, 404)
 
     def test_json_invalid_format(self):
         """Prueba con JSON malformado"""
-        response = self.app.post('/productos',
+        response = self.client.post('/productos',
                                data='{"nombre": "Test", "precio":}',  # JSON inválido
                                content_type='application/json')
         
@@ -229,7 +220,7 @@ class TestBackend(unittest.TestCase):
             # Falta precio y descripcion
         }
         
-        response = self.app.post('/productos',
+        response = self.client.post('/productos',
                                data=json.dumps(incomplete_data),
                                content_type='application/json')
         
@@ -237,6 +228,1569 @@ class TestBackend(unittest.TestCase):
         self.assertEqual(response.status_code, 500)
 
 
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_db_name = fixtures.nueva_base(migrada=False)
+        self.addCleanup(fixtures.borrar_base, self.temp_db_name)
+
+    def test_reutiliza_conexiones(self):
+        """Prueba que el pool devuelve la misma conexión tras liberarla"""
+        pool = ConnectionPool(self.temp_db_name, size=2)
+        db = pool.acquire()
+        pool.release(db)
+        self.assertIs(pool.acquire(), db)
+        stats = pool.stats()
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['created'], 1)
+        pool.close()
+
+    def test_pragmas_aplicados(self):
+        """Prueba que los PRAGMA se aplican al crear la conexión"""
+        pool = ConnectionPool(self.temp_db_name, pragmas={'cache_size': -4000})
+        db = pool.acquire()
+        self.assertEqual(db.execute('PRAGMA cache_size').fetchone()[0], -4000)
+        pool.release(db)
+        pool.close()
+
+    def test_pool_agotado(self):
+        """Prueba que se lanza PoolTimeout cuando no hay conexiones libres"""
+        pool = ConnectionPool(self.temp_db_name, size=1, timeout=0.01)
+        pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_peticiones_comparten_pool(self):
+        """Prueba que varias peticiones no abren una conexión cada una"""
+        import backend
+        aplicacion = fixtures.crear_app(self.temp_db_name)
+        self.addCleanup(fixtures.cerrar_app, aplicacion)
+        with aplicacion.app_context():
+            backend.init_db()
+        client = aplicacion.test_client()
+        for _ in range(5):
+            self.assertEqual(client.get('/productos').status_code, 200)
+        stats = backend.recursos(aplicacion).pool.stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['in_use'], 0)
+
+
+class BaseDatosTemporal(fixtures.BaseAislada):
+    """Base para pruebas que necesitan una base inicializada con init_db"""
+
+    def insertar(self, filas):
+        db = sqlite3.connect(self.temp_db_name)
+        db.executemany('INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)', filas)
+        db.commit()
+        db.close()
+
+
+class TestEscrituraConcurrente(BaseDatosTemporal):
+    def test_init_db_activa_wal(self):
+        """Prueba que init_db deja la base en modo WAL"""
+        db = sqlite3.connect(self.temp_db_name)
+        self.assertEqual(db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        db.close()
+
+    def test_posts_concurrentes_sin_bloqueos(self):
+        """Prueba que escrituras concurrentes no producen 'database is locked'"""
+        import threading
+        import backend
+        errores = []
+
+        def crear(i):
+            client = self.app.test_client()
+            for j in range(10):
+                response = client.post('/productos', json={
+                    'nombre': f'Auto {i}-{j}', 'precio': 1.0, 'descripcion': 'x'})
+                if response.status_code != 200:
+                    errores.append(response.status_code)
+
+        hilos = [threading.Thread(target=crear, args=(i,)) for i in range(8)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+
+        self.assertEqual(errores, [])
+        db = sqlite3.connect(self.temp_db_name)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM productos').fetchone()[0], 80)
+        db.close()
+        with self.app.app_context():
+            stats = backend.get_writer().stats()
+        self.assertEqual(stats['jobs'], 80)
+        self.assertEqual(stats['errors'], 0)
+
+    def test_escritor_sin_base_falla_los_pendientes(self):
+        """Prueba que si el escritor no puede abrir la base las escrituras fallan en lugar de colgarse"""
+        from writer import WriteQueue, WriterClosed
+        escritor = WriteQueue(os.path.join(self.temp_db_name, 'no', 'existe.db'))
+        with self.assertRaises(WriterClosed):
+            escritor.execute(lambda db: 1, timeout=5)
+        self.assertFalse(escritor.alive)
+        with self.assertRaises(WriterClosed):
+            escritor.submit(lambda db: 1)
+        escritor.close()
+
+    def test_escritor_ocupado_responde_503(self):
+        """Prueba que una escritura que excede DB_WRITE_TIMEOUT responde 503 y no se ejecuta"""
+        import threading
+        import backend
+        self.app.config['DB_WRITE_TIMEOUT'] = 0.05
+        liberar = threading.Event()
+        with self.app.app_context():
+            escritor = backend.get_writer()
+        bloqueo = escritor.submit(lambda db: liberar.wait(5))
+        response = self.app.test_client().post('/productos', json={
+            'nombre': 'Auto', 'precio': 1.0, 'descripcion': 'x'})
+        liberar.set()
+        bloqueo.result()
+        self.assertEqual(response.status_code, 503)
+        escritor.execute(lambda db: None)
+        db = sqlite3.connect(self.temp_db_name)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM productos').fetchone()[0], 0)
+        db.close()
+
+    def test_escritor_caido_se_reemplaza(self):
+        """Prueba que get_writer reemplaza un escritor cuyo hilo terminó"""
+        import backend
+        with self.app.app_context():
+            escritor = backend.get_writer()
+            escritor._fail_all([], RuntimeError('caido'))
+            self.assertIsNot(backend.get_writer(), escritor)
+        response = self.app.test_client().post('/productos', json={
+            'nombre': 'Auto', 'precio': 1.0, 'descripcion': 'x'})
+        self.assertEqual(response.status_code, 200)
+
+
+class TestListadoPaginado(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+        self.insertar([(f'Auto {i}', float(i * 1000), f'Modelo {i}') for i in range(1, 26)])
+
+    def test_paginacion_por_cursor(self):
+        """Prueba recorrer el listado completo siguiendo el cursor next"""
+        ids, after = [], None
+        while True:
+            url = '/productos?limit=10' + (f'&after={after}' if after else '')
+            data = json.loads(self.client.get(url).data)
+            ids.extend(p['id'] for p in data['productos'])
+            after = data['next']
+            if after is None:
+                break
+        self.assertEqual(ids, list(range(1, 26)))
+
+    def test_proyeccion_de_campos(self):
+        """Prueba que fields= devuelve solo las columnas pedidas"""
+        data = json.loads(self.client.get('/productos?limit=2&fields=nombre,precio').data)
+        self.assertEqual(data['productos'][0], {'nombre': 'Auto 1', 'precio': 1000.0})
+        self.assertEqual(data['next'], 2)
+
+    def test_filtros_nombre_y_precio(self):
+        """Prueba los filtros por prefijo de nombre y rango de precio"""
+        data = json.loads(self.client.get('/productos?nombre=auto 2&precio_max=22000').data)
+        self.assertEqual([p['nombre'] for p in data], ['Auto 2', 'Auto 20', 'Auto 21', 'Auto 22'])
+        data = json.loads(self.client.get('/productos?precio_min=24000').data)
+        self.assertEqual(len(data), 2)
+
+    def test_parametros_invalidos(self):
+        """Prueba que los parámetros inválidos devuelven 400"""
+        self.assertEqual(self.client.get('/productos?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/productos?after=abc').status_code, 400)
+        self.assertEqual(self.client.get('/productos?fields=precio,color').status_code, 400)
+
+
+class TestStreaming(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+        self.app.config['STREAM_CHUNK_SIZE'] = 3
+        self.insertar([(f'Auto {i}', float(i), 'x') for i in range(10)])
+
+    def test_stream_json_equivale_a_lista(self):
+        """Prueba que ?stream=1 devuelve el mismo JSON que el listado normal"""
+        normal = json.loads(self.client.get('/productos').data)
+        response = self.client.get('/productos?stream=1')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(json.loads(response.data), normal)
+
+    def test_stream_ndjson(self):
+        """Prueba el modo NDJSON con Accept: application/x-ndjson"""
+        response = self.client.get('/productos?fields=id',
+                                   headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lineas = response.data.decode().splitlines()
+        self.assertEqual([json.loads(l) for l in lineas], [{'id': i} for i in range(1, 11)])
+
+    def test_stream_vacio(self):
+        """Prueba el streaming sin filas"""
+        response = self.client.get('/productos?stream=1&precio_min=1000')
+        self.assertEqual(json.loads(response.data), [])
+
+
+class TestOperacionesMasivas(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+
+    def test_bulk_post_devuelve_ids(self):
+        """Prueba la inserción masiva con un elemento inválido en medio"""
+        items = [{'nombre': f'Auto {i}', 'precio': i, 'descripcion': 'x'} for i in range(500)]
+        items[10] = {'nombre': 'Sin precio', 'descripcion': 'x'}
+        response = self.client.post('/productos/bulk', json=items)
+        data = json.loads(response.data)
+        self.assertEqual(data['creados'], 499)
+        self.assertIn('precio', data['resultados'][10]['error'])
+        ids = [r['id'] for r in data['resultados'] if 'id' in r]
+        self.assertEqual(ids, list(range(1, 500)))
+        detalle = json.loads(self.client.get(f'/productos/{ids[-1]}').data)
+        self.assertEqual(detalle['nombre'], 'Auto 499')
+
+    def test_bulk_put_y_delete(self):
+        """Prueba actualización y eliminación masiva con ids inexistentes"""
+        self.insertar([('A', 1.0, 'x'), ('B', 2.0, 'x')])
+        response = self.client.put('/productos/bulk', json=[
+            {'id': 1, 'nombre': 'A2', 'precio': 3.0, 'descripcion': 'y'},
+            {'id': 99, 'nombre': 'Z', 'precio': 1.0, 'descripcion': 'y'}])
+        data = json.loads(response.data)
+        self.assertEqual(data['actualizados'], 1)
+        self.assertEqual(data['resultados'][1]['error'], 'Producto no encontrado')
+        self.assertEqual(json.loads(self.client.get('/productos/1').data)['nombre'], 'A2')
+
+        data = json.loads(self.client.delete('/productos/bulk', json=[1, 2, 99, 'x']).data)
+        self.assertEqual(data['eliminados'], 2)
+        self.assertEqual(data['resultados'][3]['error'], 'id invalido')
+        self.assertEqual(json.loads(self.client.get('/productos').data), [])
+
+    def test_bulk_tipos_invalidos(self):
+        """Prueba que nombre nulo o descripción no textual fallan solo su elemento"""
+        self.insertar([('A', 1.0, 'x')])
+        response = self.client.post('/productos/bulk', json=[
+            {'nombre': None, 'precio': 1.0, 'descripcion': 'x'},
+            {'nombre': 'Con objeto', 'precio': 1.0, 'descripcion': {'a': 1}},
+            {'nombre': ' ', 'precio': 1.0, 'descripcion': 'x'},
+            {'nombre': 'Valido', 'precio': 2.0, 'descripcion': None}])
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual([r.get('error') for r in data['resultados']],
+                         ['nombre invalido', 'descripcion invalida', 'nombre invalido', None])
+        self.assertEqual(data['creados'], 1)
+        response = self.client.put('/productos/bulk', json=[
+            {'id': 1, 'nombre': None, 'precio': 1.0, 'descripcion': 'x'},
+            {'id': 1, 'nombre': 'A', 'precio': 1.0, 'descripcion': ['y']}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['error'] for r in response.get_json()['resultados']],
+                         ['nombre invalido', 'descripcion invalida'])
+
+    def test_bulk_requiere_lista(self):
+        """Prueba que el cuerpo debe ser una lista"""
+        response = self.client.post('/productos/bulk', json={'nombre': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestCacheRespuestas(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['CACHE_ENABLED'] = True
+        self.cache = LRUCache()
+        self.app.config['CACHE_BACKEND'] = self.cache
+        self.client = self.app.test_client()
+        self.insertar([('A', 1.0, 'x'), ('B', 2.0, 'x')])
+
+    def test_hit_y_miss(self):
+        """Prueba que la segunda lectura se sirve desde el cache"""
+        self.assertEqual(self.client.get('/productos/1').headers['X-Cache'], 'MISS')
+        response = self.client.get('/productos/1')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(json.loads(response.data)['nombre'], 'A')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        response = self.client.get('/productos/1', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_invalidacion_precisa(self):
+        """Prueba que un PUT invalida solo el producto y los listados"""
+        self.client.get('/productos')
+        self.client.get('/productos/1')
+        self.client.get('/productos/2')
+        self.client.put('/productos/1', json={'nombre': 'A2', 'precio': 1.0, 'descripcion': 'x'})
+        self.assertEqual(self.client.get('/productos/2').headers['X-Cache'], 'HIT')
+        response = self.client.get('/productos/1')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(response.data)['nombre'], 'A2')
+        response = self.client.get('/productos')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(response.data)[0]['nombre'], 'A2')
+
+    def test_lru_ttl_y_limites(self):
+        """Prueba expulsión LRU, límite de bytes y expiración por TTL"""
+        cache = LRUCache(max_entries=2, max_bytes=10, ttl=60)
+        cache.set('a', CachedResponse(b'1234', 200, 'application/json'))
+        cache.set('b', CachedResponse(b'1234', 200, 'application/json'))
+        cache.get('a')
+        cache.set('c', CachedResponse(b'1234', 200, 'application/json'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache.set('d', CachedResponse(b'12345678901', 200, 'application/json'))
+        self.assertIsNone(cache.get('d'))
+        expira = LRUCache(ttl=0)
+        expira.set('a', CachedResponse(b'1', 200, 'application/json'))
+        self.assertIsNone(expira.get('a'))
+        self.assertEqual(expira.stats()['expirations'], 1)
+
+
+class TestGetCondicional(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+        self.insertar([('A', 1.0, 'x'), ('B', 2.0, 'x')])
+
+    def test_lista_304_con_if_none_match(self):
+        """Prueba que el listado responde 304 si el catálogo no cambió"""
+        response = self.client.get('/productos')
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        response = self.client.get('/productos', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_escritura_cambia_etag(self):
+        """Prueba que cualquier escritura sube la versión del catálogo"""
+        etag = self.client.get('/productos').headers['ETag']
+        self.client.delete('/productos/2')
+        response = self.client.get('/productos', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        # Tambien las escrituras hechas fuera de la API
+        etag = response.headers['ETag']
+        self.insertar([('C', 3.0, 'x')])
+        response = self.client.get('/productos', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_version_por_fila(self):
+        """Prueba el ETag por producto basado en su versión"""
+        etag = self.client.get('/productos/1').headers['ETag']
+        self.assertEqual(self.client.get('/productos/1', headers={'If-None-Match': etag}).status_code, 304)
+        self.client.put('/productos/2', json={'nombre': 'B2', 'precio': 2.0, 'descripcion': 'x'})
+        self.assertEqual(self.client.get('/productos/1', headers={'If-None-Match': etag}).status_code, 304)
+        self.client.put('/productos/1', json={'nombre': 'A2', 'precio': 1.0, 'descripcion': 'x'})
+        response = self.client.get('/productos/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+class TestMigraciones(BaseDatosTemporal):
+
+    def plan(self, args):
+        import backend
+        sql, params, _ = backend.sql_listado(backend.parse_listado(args))
+        db = sqlite3.connect(self.temp_db_name)
+        detalle = ' '.join(row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + sql, params))
+        db.close()
+        return detalle
+
+    def test_version_de_esquema(self):
+        """Prueba que init_db deja registradas todas las migraciones"""
+        db = sqlite3.connect(self.temp_db_name, isolation_level=None)
+        versiones = [row[0] for row in db.execute('SELECT version FROM schema_version ORDER BY version')]
+        self.assertEqual(versiones, [m[0] for m in MIGRACIONES])
+        self.assertEqual(aplicar_migraciones(db), [])
+        db.close()
+
+    def test_actualiza_base_antigua(self):
+        """Prueba migrar una base creada con el CREATE TABLE original"""
+        antigua = fixtures.nueva_base(migrada=False)
+        db = sqlite3.connect(antigua, isolation_level=None)
+        db.execute('''CREATE TABLE productos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            precio REAL NOT NULL,
+            descripcion TEXT)''')
+        db.execute("INSERT INTO productos (nombre, precio, descripcion) VALUES ('A', 1, 'x')")
+        self.assertEqual(aplicar_migraciones(db), [m[0] for m in MIGRACIONES])
+        self.assertEqual(db.execute('SELECT nombre, version FROM productos').fetchone(), ('A', 1))
+        db.close()
+        os.unlink(antigua)
+
+    def test_filtros_usan_indices(self):
+        """Prueba con EXPLAIN QUERY PLAN que los filtros no recorren la tabla"""
+        self.assertIn('idx_productos_nombre_nocase', self.plan({'nombre': 'chev'}))
+        self.assertIn('idx_productos_precio', self.plan({'precio_min': '100', 'precio_max': '200'}))
+        self.assertNotIn('SCAN', self.plan({'nombre': 'chev'}))
+        self.assertNotIn('SCAN', self.plan({'limit': '10', 'after': '50'}))
+
+
+class TestBusquedaTexto(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+        self.insertar([('Chevrolet Camaro ZL1', 45000.0, 'Deportivo 2023'),
+                       ('Ford Mustang', 40000.0, 'Rival del Camaro'),
+                       ('Chevrolet Spark', 12000.0, 'Económico')])
+
+    def buscar(self, q, **params):
+        return json.loads(self.client.get('/productos/search', query_string=dict(q=q, **params)).data)
+
+    def test_ranking_y_resaltado(self):
+        """Prueba que el nombre pesa más que la descripción y se resalta"""
+        data = self.buscar('camaro')
+        self.assertEqual([r['id'] for r in data['resultados']], [1, 2])
+        self.assertEqual(data['resultados'][0]['resaltado']['nombre'],
+                         'Chevrolet <mark>Camaro</mark> ZL1')
+        self.assertEqual([r['id'] for r in self.buscar('Camaro ZL1')['resultados']], [1])
+        self.assertEqual([r['id'] for r in self.buscar('economico')['resultados']], [3])
+
+    def test_paginacion(self):
+        """Prueba limit/offset con el cursor next"""
+        data = self.buscar('chevrolet', limit=1)
+        self.assertEqual(len(data['resultados']), 1)
+        self.assertEqual(data['next'], 1)
+        data = self.buscar('chevrolet', limit=1, offset=1)
+        self.assertIsNone(data['next'])
+
+    def test_indice_sigue_a_la_tabla(self):
+        """Prueba que los triggers mantienen el índice al editar y borrar"""
+        self.client.put('/productos/3', json={'nombre': 'Chevrolet Onix', 'precio': 1.0, 'descripcion': 'x'})
+        self.assertEqual(self.buscar('spark')['resultados'], [])
+        self.assertEqual([r['id'] for r in self.buscar('onix')['resultados']], [3])
+        self.client.delete('/productos/3')
+        self.assertEqual(self.buscar('onix')['resultados'], [])
+        self.assertEqual([r['id'] for r in self.buscar('Chev*')['resultados']], [1])
+
+    def test_consulta_vacia(self):
+        """Prueba que q es obligatorio y que las comillas no rompen la consulta"""
+        self.assertEqual(self.client.get('/productos/search?q=').status_code, 400)
+        self.assertEqual(len(self.buscar('"camaro')['resultados']), 2)
+
+    def test_mejor_coincidencia_vieja(self):
+        """Prueba que por defecto se ordenan todas las coincidencias y que la
+        ventana de SEARCH_RANK_WINDOW marca la respuesta como truncada"""
+        self.insertar([(f'Auto {i}', 1.0, 'Repuesto compatible con Camaro') for i in range(300)])
+        data = self.buscar('camaro', limit=2)
+        self.assertEqual([r['id'] for r in data['resultados']], [1, 2])
+        self.assertFalse(data['truncado'])
+        with patch.dict(self.app.config, {'SEARCH_RANK_WINDOW': 100}):
+            data = self.buscar('camaro', limit=2)
+            self.assertTrue(data['truncado'])
+            self.assertNotIn(1, [r['id'] for r in data['resultados']])
+            self.assertFalse(self.buscar('spark')['truncado'])
+
+
+class TestModoAsgi(BaseDatosTemporal):
+
+    def llamar(self, method, path, query=b'', body=b'', headers=()):
+        import asyncio
+        from asgi import AsgiAdapter
+        adapter = AsgiAdapter(self.app, max_workers=2)
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+                 'headers': [(k.encode(), v.encode()) for k, v in headers]}
+        mensajes = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        enviados = []
+
+        async def receive():
+            return mensajes.pop(0)
+
+        async def send(message):
+            enviados.append(message)
+
+        asyncio.run(adapter(scope, receive, send))
+        adapter.executor.shutdown()
+        cuerpo = b''.join(m.get('body', b'') for m in enviados[1:])
+        return enviados[0]['status'], dict(enviados[0]['headers']), cuerpo
+
+    def test_mismas_rutas_que_wsgi(self):
+        """Prueba POST y GET a través del adaptador ASGI"""
+        estado, _, _ = self.llamar('POST', '/productos', body=json.dumps(
+            {'nombre': 'Camaro', 'precio': 1.0, 'descripcion': 'x'}).encode(),
+            headers=[('content-type', 'application/json')])
+        self.assertEqual(estado, 200)
+        estado, headers, cuerpo = self.llamar('GET', '/productos/1')
+        self.assertEqual(estado, 200)
+        self.assertEqual(json.loads(cuerpo)['nombre'], 'Camaro')
+        self.assertIn(b'etag', headers)
+
+    def test_respuesta_en_streaming(self):
+        """Prueba que el streaming NDJSON llega completo por ASGI"""
+        self.insertar([(f'Auto {i}', float(i), 'x') for i in range(5)])
+        estado, _, cuerpo = self.llamar('GET', '/productos', query=b'fields=id',
+                                        headers=[('accept', 'application/x-ndjson')])
+        self.assertEqual(estado, 200)
+        self.assertEqual(len(cuerpo.splitlines()), 5)
+
+
+class TestLanzador(unittest.TestCase):
+
+    def test_opciones_desde_entorno(self):
+        """Prueba que el lanzador toma la configuracion del entorno"""
+        from serve import parse_args
+        entorno = {'CRUD_BIND': '0.0.0.0:8080', 'CRUD_WORKERS': '3', 'CRUD_THREADS': '2',
+                   'CRUD_DATABASE': '/tmp/x.db', 'CRUD_MAX_REQUESTS': '0'}
+        with patch.dict(os.environ, entorno):
+            args = parse_args([])
+        self.assertEqual((args.host, args.port), ('0.0.0.0', 8080))
+        self.assertEqual((args.workers, args.threads, args.max_requests), (3, 2, 0))
+        self.assertEqual(args.database, '/tmp/x.db')
+
+    def test_linea_de_comandos_tiene_prioridad(self):
+        """Prueba que las opciones de la linea de comandos ganan al entorno"""
+        from serve import parse_args
+        with patch.dict(os.environ, {'CRUD_WORKERS': '3'}):
+            args = parse_args(['--workers', '5', '--bind', ':9000'])
+        self.assertEqual(args.workers, 5)
+        self.assertEqual((args.host, args.port), ('127.0.0.1', 9000))
+
+
+class TestCorredorPruebas(unittest.TestCase):
+
+    def test_procesos_por_defecto(self):
+        """Prueba que el corredor no abre procesos que cuestan mas de lo que ahorran"""
+        from run_tests import procesos_por_defecto
+        self.assertEqual(procesos_por_defecto(129, nucleos=1), 1)
+        self.assertEqual(procesos_por_defecto(30, nucleos=8), 1)
+        self.assertEqual(procesos_por_defecto(129, nucleos=8), 2)
+        self.assertEqual(procesos_por_defecto(1000, nucleos=4), 4)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_siembra_y_carga_local(self):
+        """Prueba que la base sembrada queda migrada y la carga no da errores"""
+        import benchmark
+        path = fixtures.nueva_base(migrada=False)
+        os.unlink(path)
+        try:
+            benchmark.sembrar(path, 200)
+            db = sqlite3.connect(path)
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM productos').fetchone()[0], 200)
+            self.assertEqual(db.execute('SELECT MAX(version) FROM schema_version').fetchone()[0],
+                             MIGRACIONES[-1][0])
+            db.close()
+            aplicacion = fixtures.crear_app(path)
+            self.addCleanup(fixtures.cerrar_app, aplicacion)
+            carga = benchmark.Carga(benchmark.parse_mezcla(None), 200)
+            resultado = carga.correr(lambda: benchmark.ClienteLocal(aplicacion), 2, 0.3)
+            self.assertGreater(resultado['total']['peticiones'], 0)
+            self.assertEqual(resultado['total']['errores'], 0)
+            self.assertIn('p99_ms', resultado['detalle'])
+        finally:
+            fixtures.borrar_base(path)
+
+    def test_mezcla_invalida(self):
+        """Prueba que una operacion desconocida en --mix se rechaza"""
+        import argparse
+        import benchmark
+        self.assertEqual(benchmark.parse_mezcla('detalle=3,crear'), {'detalle': 3.0, 'crear': 1.0})
+        with self.assertRaises(argparse.ArgumentTypeError):
+            benchmark.parse_mezcla('borrar=1')
+
+
+class TestMetricas(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['METRICS_ENABLED'] = True
+        self.client = self.app.test_client()
+        self.insertar([('A', 1.0, 'x')])
+
+    def test_exporta_contadores_e_histogramas(self):
+        """Prueba que /metrics expone peticiones por ruta y tiempos por fase"""
+        self.client.get('/productos/1')
+        self.client.get('/productos/99')
+        texto = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('crud_http_requests_total{endpoint="producto_id",method="GET",status="404"}', texto)
+        self.assertIn('# TYPE crud_http_request_duration_seconds histogram', texto)
+        self.assertIn('crud_phase_duration_seconds_count{endpoint="producto_id",phase="db"}', texto)
+        self.assertIn('crud_phase_duration_seconds_count{endpoint="producto_id",phase="serializacion"}', texto)
+        self.assertIn('crud_pool_in_use ', texto)
+
+    def test_deshabilitadas_sin_instrumentar(self):
+        """Prueba que sin metricas el pool usa conexiones sqlite3 normales"""
+        import backend
+        self.app.config['METRICS_ENABLED'] = False
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with self.app.app_context():
+            self.assertIs(backend.get_pool().factory, sqlite3.Connection)
+
+    def test_log_de_consultas_lentas(self):
+        """Prueba que las consultas sobre el umbral quedan en el log"""
+        self.app.config['METRICS_SLOW_QUERY_MS'] = 0
+        with self.assertLogs('crud.consultas_lentas', level='WARNING') as logs:
+            self.client.get('/productos/1')
+        self.assertTrue(any('FROM productos WHERE id = ?' in linea for linea in logs.output))
+
+
+class TestPerfilado(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.directorio = tempfile.mkdtemp()
+        self.app.config.update(PROFILE_ENABLED=True, PROFILE_MODE='cprofile', PROFILE_DIR=None,
+                          PROFILE_TOKEN='secreto', PROFILE_SAMPLE_RATE=0.0)
+        self.client = self.app.test_client()
+        self.token = {'X-Profile-Token': 'secreto'}
+        self.insertar([(f'Auto {i}', float(i), 'x') for i in range(50)])
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directorio, ignore_errors=True)
+        super().tearDown()
+
+    def test_devuelve_perfil(self):
+        """Prueba que ?_profile=return devuelve el reporte de pstats"""
+        response = self.client.get('/productos?_profile=return', headers=self.token)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('function calls', response.get_data(as_text=True))
+        self.assertIn('X-Profile-Duration', response.headers)
+
+    def test_cliente_no_autorizado(self):
+        """Prueba que sin token ni siquiera localhost puede pedir un perfil por defecto"""
+        response = self.client.get('/productos', headers={'X-Profile': 'return'})
+        self.assertEqual(len(json.loads(response.data)), 50)
+        response = self.client.get('/productos', headers={'X-Profile': 'return', 'X-Profile-Token': 'otro'})
+        self.assertEqual(len(json.loads(response.data)), 50)
+        response = self.client.get('/productos', headers={'X-Profile': 'return', **self.token},
+                                   environ_base={'REMOTE_ADDR': '10.0.0.9'})
+        self.assertIn('function calls', response.get_data(as_text=True))
+        self.app.config.update(PROFILE_TOKEN=None, PROFILE_ALLOWED_IPS=('10.0.0.9',))
+        response = self.client.get('/productos', headers={'X-Profile': 'return'},
+                                   environ_base={'REMOTE_ADDR': '10.0.0.9'})
+        self.assertIn('function calls', response.get_data(as_text=True))
+
+    def test_guarda_perfil_pstats(self):
+        """Prueba que el perfil guardado se puede abrir con pstats"""
+        import pstats
+        self.app.config['PROFILE_DIR'] = self.directorio
+        response = self.client.get('/productos/1', headers={'X-Profile': '1', **self.token})
+        self.assertEqual(json.loads(response.data)['nombre'], 'Auto 0')
+        archivo = os.path.join(self.directorio, response.headers['X-Profile-File'])
+        self.assertGreater(pstats.Stats(archivo).total_calls, 0)
+
+    def test_muestreo_continuo_en_streaming(self):
+        """Prueba el muestreo por tasa con el perfilador de pilas"""
+        self.app.config.update(PROFILE_DIR=self.directorio, PROFILE_SAMPLE_RATE=1.0,
+                          PROFILE_MODE='sample', PROFILE_INTERVAL=0.0001)
+        response = self.client.get('/productos?stream=1')
+        self.assertEqual(len(json.loads(response.data)), 50)
+        self.assertTrue(response.headers['X-Profile-File'].endswith('.folded'))
+
+
+class TestCodificacionJson(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+        self.insertar([('Camaro "SS"', 1.5, 'ñandú'), ('Bronco', 2.0, None), ('Civic', 3.25, 'x')])
+
+    def respuestas(self, path, headers=None):
+        self.app.config['JSON_ROWS_SQL'] = False
+        en_python = self.client.get(path, headers=headers).get_data(as_text=True)
+        self.app.config['JSON_ROWS_SQL'] = True
+        en_sql = self.client.get(path, headers=headers).get_data(as_text=True)
+        return en_python, en_sql
+
+    def test_filas_en_sql_igual_que_en_python(self):
+        """Prueba que el listado armado en SQLite es el mismo JSON que con dicts"""
+        for path in ('/productos', '/productos?limit=2', '/productos?fields=nombre,precio&limit=1',
+                     '/productos?stream=1'):
+            en_python, en_sql = self.respuestas(path)
+            self.assertEqual(json.loads(en_python), json.loads(en_sql), path)
+        en_python, en_sql = self.respuestas('/productos', {'Accept': 'application/x-ndjson'})
+        self.assertEqual([json.loads(l) for l in en_python.splitlines()],
+                         [json.loads(l) for l in en_sql.splitlines()])
+
+    def test_listado_y_detalle_iguales_byte_a_byte(self):
+        """Prueba que con la configuracion por defecto el listado y el detalle escriben el precio igual"""
+        self.insertar([('Ka', 23.188399999999998, 'x'), ('Uno', 0.1 + 0.2, 'x')])
+        listado = self.client.get('/productos').get_data(as_text=True)
+        for id in (4, 5):
+            detalle = self.client.get(f'/productos/{id}').get_data(as_text=True).strip()
+            self.assertIn(detalle, listado)
+        self.assertIn('0.30000000000000004', listado)
+
+    def test_filas_en_sql_sin_perder_precision(self):
+        """Prueba que el precio armado en SQLite conserva el double exacto"""
+        self.insertar([('Ka', 23.188399999999998, 'x'), ('Uno', 0.1 + 0.2, 'x')])
+        for path in ('/productos', '/productos?stream=1'):
+            en_python, en_sql = self.respuestas(path)
+            self.assertEqual([p['precio'] for p in json.loads(en_sql)][-2:],
+                             [23.188399999999998, 0.1 + 0.2])
+            self.assertEqual(json.loads(en_python), json.loads(en_sql))
+
+    def test_codificadores_equivalentes(self):
+        """Prueba que json y orjson producen el mismo contenido"""
+        import backend
+        from encoding import CODIFICADORES
+        resultados = []
+        for nombre in CODIFICADORES:
+            self.app.config['JSON_ENCODER'] = nombre
+            self.app.json = backend.ProveedorJson(self.app)
+            self.app.config['JSON_ROWS_SQL'] = False
+            resultados.append((json.loads(self.client.get('/productos/1').data),
+                               json.loads(self.client.get('/productos').data)))
+        for resultado in resultados[1:]:
+            self.assertEqual(resultado, resultados[0])
+
+    def test_codificador_desconocido(self):
+        """Prueba que un codificador inexistente se rechaza al configurarlo"""
+        from encoding import elegir_codificador
+        with self.assertRaises(ValueError):
+            elegir_codificador('ujson-falso')
+        self.assertIn(elegir_codificador('auto').nombre, ('json', 'orjson'))
+
+
+class TestSnapshot(BaseDatosTemporal):
+
+    CONSULTAS = ('/productos', '/productos?limit=3', '/productos?limit=2&after=4',
+                 '/productos?precio_min=3&precio_max=6', '/productos?limit=2&precio_min=5',
+                 '/productos?fields=nombre&limit=4', '/productos/2', '/productos/99')
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+        self.insertar([(f'Auto {i}', float(i % 7), 'x') for i in range(1, 11)])
+
+    def comparar(self):
+        self.app.config['SNAPSHOT_ENABLED'] = False
+        esperado = [(r.status_code, r.get_json()) for r in map(self.client.get, self.CONSULTAS)]
+        self.app.config['SNAPSHOT_ENABLED'] = True
+        obtenido = [(r.status_code, r.get_json()) for r in map(self.client.get, self.CONSULTAS)]
+        self.assertEqual(obtenido, esperado)
+
+    def test_mismas_respuestas_que_sqlite(self):
+        """Prueba que el snapshot responde igual que SQLite tras escrituras"""
+        self.comparar()
+        self.client.post('/productos', json={'nombre': 'Nuevo', 'precio': 4.5, 'descripcion': 'y'})
+        self.client.put('/productos/2', json={'nombre': 'Editado', 'precio': 9.0, 'descripcion': 'z'})
+        self.client.delete('/productos/5')
+        self.comparar()
+
+    def test_cambios_de_otra_conexion(self):
+        """Prueba que el snapshot ve escrituras hechas fuera de la API"""
+        import backend
+        self.app.config['SNAPSHOT_ENABLED'] = True
+        self.client.get('/productos/3')
+        db = sqlite3.connect(self.temp_db_name)
+        db.execute("UPDATE productos SET nombre = 'Directo' WHERE id = 3")
+        db.commit()
+        db.close()
+        self.assertEqual(self.client.get('/productos/3').get_json()['nombre'], 'Directo')
+        self.assertEqual(backend.recursos(self.app).snapshot.stats()['cambios_aplicados'], 1)
+
+    def test_limite_de_memoria(self):
+        """Prueba que un snapshot que excede su limite se apaga y se sirve de SQLite"""
+        import backend
+        self.app.config['SNAPSHOT_ENABLED'] = True
+        self.app.config['SNAPSHOT_MAX_BYTES'] = 100
+        response = self.client.get('/productos')
+        self.assertEqual(len(response.get_json()), 10)
+        stats = backend.recursos(self.app).snapshot.stats()
+        self.assertEqual((stats['activo'], stats['filas']), (0, 0))
+
+
+class TestCambios(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+
+    def escribir(self):
+        self.client.post('/productos', json={'nombre': 'Uno', 'precio': 1.0, 'descripcion': 'a'})
+        self.client.put('/productos/1', json={'nombre': 'Dos', 'precio': 2.0, 'descripcion': 'b'})
+        self.client.post('/productos', json={'nombre': 'Tres', 'precio': 3.0, 'descripcion': 'c'})
+        self.client.delete('/productos/2')
+
+    def test_cambios_desde_seq(self):
+        """Prueba que el feed devuelve los cambios en orden con el estado actual"""
+        inicio = self.client.get('/productos/changes').get_json()
+        self.assertEqual(inicio['cambios'], [])
+        self.escribir()
+        data = self.client.get(f"/productos/changes?since={inicio['next']}").get_json()
+        self.assertEqual([(c['operacion'], c['id']) for c in data['cambios']],
+                         [('insert', 1), ('update', 1), ('insert', 2), ('delete', 2)])
+        self.assertEqual(data['cambios'][0]['producto']['nombre'], 'Dos')
+        self.assertIsNone(data['cambios'][3]['producto'])
+        self.assertEqual(data['next'], data['cambios'][-1]['seq'])
+        pagina = self.client.get(f"/productos/changes?since={inicio['next']}&limit=3").get_json()
+        self.assertEqual((len(pagina['cambios']), pagina['mas']), (3, True))
+        vacio = self.client.get(f"/productos/changes?since={data['next']}").get_json()
+        self.assertEqual((vacio['cambios'], vacio['next']), ([], data['next']))
+
+    def test_cambios_fuera_de_la_api(self):
+        """Prueba que las escrituras directas a SQLite tambien entran al feed"""
+        self.insertar([('Directo', 5.0, 'x')])
+        data = self.client.get('/productos/changes?since=0').get_json()
+        self.assertEqual(data['cambios'][0]['producto']['nombre'], 'Directo')
+
+    def test_cambios_perdidos_y_parametros(self):
+        """Prueba 410 cuando faltan cambios podados y 400 con since invalido"""
+        from changes import podar_cambios
+        self.escribir()
+        db = sqlite3.connect(self.temp_db_name, isolation_level=None)
+        self.assertEqual(podar_cambios(db, max_filas=2), 2)
+        self.assertEqual(podar_cambios(db, max_edad=3600), 0)
+        db.close()
+        response = self.client.get('/productos/changes?since=0')
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.get_json()['next'], 4)
+        self.assertEqual(self.client.get('/productos/changes?since=2').status_code, 200)
+        self.assertEqual(self.client.get('/productos/changes?since=99').status_code, 410)
+        self.assertEqual(self.client.get('/productos/changes?since=-1').status_code, 400)
+        self.assertEqual(self.client.get('/productos/changes?since=x').status_code, 400)
+
+    def test_escritura_entre_lecturas_no_pierde_cambios(self):
+        """Prueba que un cambio confirmado durante leer_cambios no da CambiosPerdidos"""
+        from changes import leer_cambios
+        self.escribir()
+        ruta = self.temp_db_name
+
+        class ConEscrituraIntercalada(sqlite3.Connection):
+            def execute(self, sql, *args):
+                cursor = super().execute(sql, *args)
+                if 'FROM cambios c' in sql:
+                    otra = sqlite3.connect(ruta)
+                    otra.execute("INSERT INTO productos (nombre, precio, descripcion) VALUES ('X', 1, 'x')")
+                    otra.commit()
+                    otra.close()
+                return cursor
+
+        db = sqlite3.connect(ruta, factory=ConEscrituraIntercalada)
+        self.assertEqual(leer_cambios(db, 4, 10), [])
+        self.assertFalse(db.in_transaction)
+        self.assertEqual([c['seq'] for c in leer_cambios(db, 4, 10)], [5])
+        db.close()
+
+    def test_difusor_sigue_tras_un_error(self):
+        """Prueba que un error al codificar se cuenta y el difusor sigue sondeando"""
+        import time
+        from changes import Difusor
+        fallas = [RuntimeError('falla')]
+
+        def codificar(evento):
+            if fallas:
+                raise fallas.pop()
+            return json.dumps(evento).encode()
+
+        difusor = Difusor(self.temp_db_name, codificar, intervalo=0.05)
+        self.addCleanup(difusor.cerrar)
+        self.assertTrue(difusor.reservar(False, 1))
+        self.insertar([('Uno', 1.0, 'a')])
+        difusor.avisar()
+        for _ in range(100):
+            if difusor.pendientes(0):
+                break
+            time.sleep(0.05)
+        self.assertEqual([seq for seq, _ in difusor.pendientes(0)], [1])
+        self.assertEqual(difusor.stats()['errores'], 1)
+
+    def test_stream_sse(self):
+        """Prueba que el stream envia el historial y luego los cambios nuevos"""
+        import threading
+        self.client.post('/productos', json={'nombre': 'Uno', 'precio': 1.0, 'descripcion': 'a'})
+        response = self.client.get('/productos/changes/stream?since=0', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = iter(response.response)
+        primero = next(chunks)
+        self.assertIn(b'id: 1\nevent: cambio\n', primero)
+
+        def borrar():
+            self.app.test_client().delete('/productos/1')
+
+        threading.Timer(0.2, borrar).start()
+        siguiente = next(chunks)
+        self.assertIn(b'id: 2\n', siguiente)
+        self.assertIn(b'"operacion":"delete"', siguiente)
+        response.close()
+
+    def test_stream_reanuda_con_last_event_id(self):
+        """Prueba que Last-Event-ID tiene prioridad y que un id perdido pide reset"""
+        self.escribir()
+        response = self.client.get('/productos/changes/stream', headers={'Last-Event-ID': '3'},
+                                   buffered=False)
+        primero = next(iter(response.response))
+        self.assertIn(b'id: 4\n', primero)
+        self.assertNotIn(b'id: 3\n', primero)
+        response.close()
+        response = self.client.get('/productos/changes/stream?since=50', buffered=False)
+        self.assertIn(b'event: reset', next(iter(response.response)))
+        response.close()
+
+    def test_limite_de_streams(self):
+        """Prueba que se rechazan streams por encima del limite y se liberan al cerrar"""
+        import backend
+        self.app.config['CHANGES_MAX_STREAMS'] = 1
+        abierto = self.client.get('/productos/changes/stream', buffered=False)
+        rechazado = self.client.get('/productos/changes/stream', buffered=False)
+        self.assertEqual((abierto.status_code, rechazado.status_code), (200, 503))
+        abierto.close()
+        rechazado.close()
+        self.assertEqual(backend.recursos(self.app).difusor.stats()['suscriptores'], 0)
+        otro = self.client.get('/productos/changes/stream', buffered=False)
+        self.assertEqual(otro.status_code, 200)
+        otro.close()
+
+    def test_stream_asincrono(self):
+        """Prueba que el stream recorrido en el event loop recibe los cambios"""
+        import asyncio
+        import threading
+        import backend
+        from changes import StreamCambios, leer_cambios
+
+        def leer(seq):
+            db = sqlite3.connect(self.temp_db_name)
+            try:
+                return leer_cambios(db, seq, 100)
+            finally:
+                db.close()
+
+        with self.app.app_context():
+            difusor = backend.get_difusor()
+        self.assertTrue(difusor.reservar(False, 1))
+        stream = StreamCambios(difusor, leer, 0, False)
+        self.assertEqual(stream.primero(), b'retry: 3000\n\n')
+
+        async def recibir():
+            threading.Timer(0.2, lambda: self.app.test_client().post(
+                '/productos', json={'nombre': 'Uno', 'precio': 1.0, 'descripcion': 'a'})).start()
+            iterador = stream.asincrono()
+            try:
+                return await asyncio.wait_for(iterador.__anext__(), 5)
+            finally:
+                await iterador.aclose()
+
+        self.assertIn(b'id: 1\n', asyncio.run(recibir()))
+        stream.close()
+        self.assertEqual(difusor.stats()['suscriptores'], 0)
+
+
+class TestCompresion(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+        self.insertar([(f'Auto {i}', float(i), 'Sedan de cuatro puertas') for i in range(200)])
+
+    def test_gzip_negociado(self):
+        """Prueba que un listado grande se comprime con gzip y se puede revalidar"""
+        import gzip
+        plano = self.client.get('/productos').data
+        response = self.client.get('/productos', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(int(response.headers['Content-Length']), len(response.data))
+        self.assertLess(len(response.data), len(plano))
+        self.assertEqual(gzip.decompress(response.data), plano)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        revalidada = self.client.get('/productos', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(revalidada.status_code, 304)
+
+    def test_streaming_comprimido(self):
+        """Prueba que las respuestas en streaming se comprimen chunk a chunk"""
+        import gzip
+        plano = self.client.get('/productos?stream=1').data
+        response = self.client.get('/productos?stream=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(gzip.decompress(response.data), plano)
+
+    def test_sin_comprimir(self):
+        """Prueba los casos en que la respuesta se envia sin comprimir"""
+        pequena = self.client.get('/productos/1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', pequena.headers)
+        self.assertEqual(pequena.headers['Vary'], 'Accept-Encoding')
+        for cabecera in ('', 'identity', 'gzip;q=0', 'compress'):
+            response = self.client.get('/productos', headers={'Accept-Encoding': cabecera})
+            self.assertNotIn('Content-Encoding', response.headers, cabecera)
+        self.app.config['COMPRESSION_ENABLED'] = False
+        response = self.client.get('/productos', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_negociar(self):
+        """Prueba que gana la mayor calidad y a igual calidad el orden del servidor"""
+        from compression import ALGORITMOS, negociar
+        with patch.dict(ALGORITMOS, {'br': object}):
+            self.assertEqual(negociar('gzip, br', ('br', 'gzip')), 'br')
+            self.assertEqual(negociar('gzip, br;q=0.5', ('br', 'gzip')), 'gzip')
+            self.assertEqual(negociar('*', ('br', 'gzip')), 'br')
+        self.assertEqual(negociar('zstd, gzip', ('zstd', 'gzip')), 'gzip' if 'zstd' not in ALGORITMOS else 'zstd')
+        self.assertIsNone(negociar(None, ('gzip',)))
+
+    def test_metricas_de_compresion(self):
+        """Prueba que /metrics reporta bytes, CPU y respuestas servidas desde la cache"""
+        self.app.config['METRICS_ENABLED'] = True
+        # Un cuerpo distinto al de las otras pruebas, para que la primera
+        # peticion no encuentre su version comprimida en la cache
+        self.insertar([('Metricas', 1.0, 'unico')])
+        for _ in range(2):
+            self.client.get('/productos', headers={'Accept-Encoding': 'gzip'})
+        texto = self.client.get('/metrics').data.decode()
+        for nombre in ('crud_compression_bytes_in_total{algorithm="gzip"}',
+                       'crud_compression_bytes_out_total{algorithm="gzip"}',
+                       'crud_compression_cpu_seconds_total{algorithm="gzip"}',
+                       'crud_compression_cache_hits_total{algorithm="gzip"}'):
+            self.assertIn(nombre, texto)
+
+
+class TestEstadisticas(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+        self.precios = [round(i * 7.3 % 997, 2) for i in range(500)]
+        self.insertar([(f'Ford {i}' if i % 3 == 0 else f'Auto {i}', precio, None)
+                       for i, precio in enumerate(self.precios)])
+
+    def esperado(self, precios, percentiles):
+        import math
+        ordenados = sorted(precios)
+        return {f'p{p:g}': ordenados[max(1, math.ceil(p / 100 * len(ordenados))) - 1] for p in percentiles}
+
+    def test_coincide_con_fuerza_bruta(self):
+        """Prueba que conteo, suma, extremos, percentiles e histograma coinciden con el calculo directo"""
+        data = self.client.get('/productos/stats?width=50&percentiles=0,25,50,99.5,100').get_json()
+        self.assertEqual(data['count'], 500)
+        self.assertAlmostEqual(data['sum'], sum(self.precios), places=6)
+        self.assertEqual((data['min'], data['max']), (min(self.precios), max(self.precios)))
+        self.assertEqual(data['percentiles'], self.esperado(self.precios, (0, 25, 50, 99.5, 100)))
+        buckets = data['histogram']['buckets']
+        self.assertEqual(data['histogram']['width'], 50)
+        self.assertEqual(sum(b['count'] for b in buckets), 500)
+        for bucket in buckets:
+            self.assertEqual(bucket['end'] - bucket['start'], 50)
+            self.assertEqual(bucket['count'], sum(1 for p in self.precios if bucket['start'] <= p < bucket['end']))
+
+    def test_filtro_por_nombre(self):
+        """Prueba que el prefijo por nombre reduce las estadisticas a esas filas"""
+        precios = [p for i, p in enumerate(self.precios) if i % 3 == 0]
+        data = self.client.get('/productos/stats?nombre=ford&percentiles=50,90').get_json()
+        self.assertEqual(data['count'], len(precios))
+        self.assertAlmostEqual(data['avg'], sum(precios) / len(precios), places=6)
+        self.assertEqual(data['percentiles'], self.esperado(precios, (50, 90)))
+        self.assertEqual(sum(b['count'] for b in data['histogram']['buckets']), len(precios))
+
+    def test_parametros_invalidos(self):
+        """Prueba que width y percentiles invalidos devuelven 400"""
+        for consulta in ('width=0', 'width=abc', 'width=-5', 'percentiles=101', 'percentiles=x', 'width=0.001'):
+            response = self.client.get(f'/productos/stats?{consulta}')
+            self.assertEqual(response.status_code, 400, consulta)
+            self.assertIn('error', response.get_json())
+
+    def test_width_extremos(self):
+        """Prueba que un width que no avanza sobre precios enormes o que desborda devuelve 400"""
+        self.client.post('/productos', json={'nombre': 'Enorme', 'precio': 1e300, 'descripcion': 'x'})
+        for consulta in ('width=1', 'width=1e-320', 'width=1e290'):
+            response = self.client.get(f'/productos/stats?{consulta}')
+            self.assertEqual(response.status_code, 400, consulta)
+            self.assertIn('error', response.get_json())
+        self.assertEqual(self.client.get('/productos/stats?width=1e299').status_code, 200)
+        self.assertEqual(self.client.get('/productos/stats').status_code, 200)
+
+    def test_cache_y_revalidacion(self):
+        """Prueba el 304 con el ETag y que una escritura cambia el resultado"""
+        response = self.client.get('/productos/stats')
+        etag = response.headers['ETag']
+        self.assertEqual(self.client.get('/productos/stats', headers={'If-None-Match': etag}).status_code, 304)
+        self.client.post('/productos', json={'nombre': 'Caro', 'precio': 5000.0, 'descripcion': 'x'})
+        nuevo = self.client.get('/productos/stats', headers={'If-None-Match': etag})
+        self.assertEqual(nuevo.status_code, 200)
+        self.assertEqual(nuevo.get_json()['count'], 501)
+        self.assertEqual(nuevo.get_json()['max'], 5000.0)
+
+    def test_sin_datos(self):
+        """Prueba la respuesta cuando ningun producto coincide"""
+        data = self.client.get('/productos/stats?nombre=zzz').get_json()
+        self.assertEqual(data['count'], 0)
+        self.assertIsNone(data['avg'])
+        self.assertEqual(data['histogram']['buckets'], [])
+        self.assertEqual(set(data['percentiles']), {'p50', 'p90', 'p95', 'p99'})
+
+
+class TestEscriturasIdempotentes(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+        self.producto = {'nombre': 'Civic', 'precio': 20000.0, 'descripcion': 'Sedan'}
+
+    def contar(self):
+        db = sqlite3.connect(self.temp_db_name)
+        total = db.execute('SELECT COUNT(*) FROM productos').fetchone()[0]
+        db.close()
+        return total
+
+    def test_reintento_repite_la_respuesta(self):
+        """Prueba que un POST reintentado con la misma clave no crea otro producto"""
+        cabeceras = {'Idempotency-Key': 'alta-1'}
+        primera = self.client.post('/productos', json=self.producto, headers=cabeceras)
+        segunda = self.client.post('/productos', json=self.producto, headers=cabeceras)
+        self.assertEqual(primera.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', primera.headers)
+        self.assertEqual(segunda.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(segunda.get_json(), primera.get_json())
+        self.assertEqual(segunda.headers['ETag'], primera.headers['ETag'])
+        self.assertEqual(self.contar(), 1)
+        self.client.post('/productos', json=self.producto, headers={'Idempotency-Key': 'alta-2'})
+        self.assertEqual(self.contar(), 2)
+
+    def test_clave_con_otra_peticion(self):
+        """Prueba que reusar una clave con otro cuerpo responde 422 sin escribir"""
+        self.client.post('/productos', json=self.producto, headers={'Idempotency-Key': 'k'})
+        otra = self.client.post('/productos', json=dict(self.producto, precio=1.0), headers={'Idempotency-Key': 'k'})
+        self.assertEqual(otra.status_code, 422)
+        self.assertEqual(self.contar(), 1)
+        larga = self.client.post('/productos', json=self.producto, headers={'Idempotency-Key': 'x' * 256})
+        self.assertEqual(larga.status_code, 400)
+
+    def test_clave_en_curso_y_reserva_abandonada(self):
+        """Prueba el 409 mientras la original no termina y que una reserva vieja se vuelve a tomar"""
+        import idempotency
+        import time
+        firma = idempotency.huella('POST', '/productos?', json.dumps(self.producto).encode())
+        db = sqlite3.connect(self.temp_db_name)
+        db.execute('INSERT INTO idempotencia (clave, huella, creado) VALUES (?, ?, ?)', ['k', firma, time.time()])
+        db.commit()
+        cabeceras = {'Idempotency-Key': 'k', 'Content-Type': 'application/json'}
+        response = self.client.post('/productos', data=json.dumps(self.producto), headers=cabeceras)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.contar(), 0)
+        db.execute('UPDATE idempotencia SET creado = creado - ?', [self.app.config['IDEMPOTENCY_LOCK_TIMEOUT'] + 1])
+        db.commit()
+        db.close()
+        response = self.client.post('/productos', data=json.dumps(self.producto), headers=cabeceras)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.contar(), 1)
+
+    def test_reserva_abandonada_tras_escribir_no_duplica(self):
+        """Prueba que si el alta se confirmo pero la respuesta no se guardo, el reintento la repite"""
+        cabeceras = {'Idempotency-Key': 'alta', 'Content-Type': 'application/json'}
+        cuerpo = json.dumps(self.producto)
+        with patch('idempotency.completar', side_effect=sqlite3.OperationalError('disk I/O error')):
+            with self.assertRaises(sqlite3.OperationalError):
+                self.client.post('/productos', data=cuerpo, headers=cabeceras)
+        self.assertEqual(self.contar(), 1)
+        db = sqlite3.connect(self.temp_db_name)
+        db.execute('UPDATE idempotencia SET creado = creado - ?', [self.app.config['IDEMPOTENCY_LOCK_TIMEOUT'] + 1])
+        db.commit()
+        db.close()
+        response = self.client.post('/productos', data=cuerpo, headers=cabeceras)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['id'], 1)
+        self.assertEqual(self.contar(), 1)
+        repetida = self.client.post('/productos', data=cuerpo, headers=cabeceras)
+        self.assertEqual(repetida.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.contar(), 1)
+
+    def test_error_libera_la_clave(self):
+        """Prueba que una respuesta de error no se guarda y el reintento se ejecuta"""
+        self.client.post('/productos', json=self.producto)
+        cabeceras = {'Idempotency-Key': 'borrar', 'If-Match': '"p1-7"'}
+        self.assertEqual(self.client.delete('/productos/1', headers=cabeceras).status_code, 412)
+        self.assertEqual(self.contar(), 1)
+        cabeceras['If-Match'] = '"p1-1"'
+        response = self.client.delete('/productos/1', headers=cabeceras)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(self.contar(), 0)
+
+    def test_if_match_en_put(self):
+        """Prueba que un PUT con un ETag viejo responde 412 y no pisa el cambio ajeno"""
+        self.client.post('/productos', json=self.producto)
+        etag = self.client.get('/productos/1').headers['ETag']
+        primera = self.client.put('/productos/1', json=dict(self.producto, precio=1.0), headers={'If-Match': etag})
+        self.assertEqual(primera.status_code, 200)
+        self.assertEqual(primera.headers['ETag'], '"p1-2"')
+        segunda = self.client.put('/productos/1', json=dict(self.producto, precio=2.0), headers={'If-Match': etag})
+        self.assertEqual(segunda.status_code, 412)
+        self.assertEqual(segunda.headers['ETag'], '"p1-2"')
+        self.assertEqual(self.client.get('/productos/1').get_json()['precio'], 1.0)
+        debil = self.client.put('/productos/1', json=self.producto, headers={'If-Match': 'W/"p1-2"'})
+        self.assertEqual(debil.status_code, 200)
+        ausente = self.client.put('/productos/99', json=self.producto, headers={'If-Match': '*'})
+        self.assertEqual(ausente.status_code, 412)
+
+    def test_if_match_obligatorio(self):
+        """Prueba que con WRITE_REQUIRE_IF_MATCH un PUT sin If-Match responde 428"""
+        self.client.post('/productos', json=self.producto)
+        self.app.config['WRITE_REQUIRE_IF_MATCH'] = True
+        self.assertEqual(self.client.put('/productos/1', json=self.producto).status_code, 428)
+        self.assertEqual(self.client.delete('/productos/1', headers={'If-Match': '*'}).status_code, 200)
+
+    def test_poda(self):
+        """Prueba que la poda borra las claves vencidas y deja a lo sumo el maximo"""
+        import idempotency
+        db = sqlite3.connect(self.temp_db_name)
+        db.executemany('INSERT INTO idempotencia (clave, huella, estado, creado) VALUES (?, ?, 200, ?)',
+                       [(f'k{i}', 'h', float(i)) for i in range(10)])
+        self.assertEqual(idempotency.podar(db, 12.0, 5.0, 3), 7)
+        self.assertEqual([row[0] for row in db.execute('SELECT clave FROM idempotencia ORDER BY creado')],
+                         ['k7', 'k8', 'k9'])
+        self.assertIsNone(idempotency.buscar(db, 'k7', 100.0, 5.0))
+        db.close()
+
+
+class ContratoRepositorio:
+    """Pruebas comunes a todas las implementaciones de Repositorio; cada
+    subclase define ``self.repositorio``."""
+
+    producto = {'nombre': 'Civic', 'precio': 20000.0, 'descripcion': 'Sedan'}
+
+    def consulta(self, **args):
+        import backend
+        return backend.parse_listado(args)
+
+    def test_crear_obtener_actualizar_eliminar(self):
+        """Prueba el ciclo de un producto con sus versiones"""
+        from repository import VersionDistinta
+        id = self.repositorio.crear(self.producto)
+        producto = self.repositorio.obtener(id)
+        self.assertEqual(tuple(producto), (id, 'Civic', 20000.0, 'Sedan', 1))
+        self.assertEqual(producto.version, 1)
+        self.assertEqual(producto.datos(), dict(self.producto, id=id))
+        self.assertEqual(self.repositorio.actualizar(id, dict(self.producto, precio=1.0), {1}), 2)
+        with self.assertRaises(VersionDistinta) as error:
+            self.repositorio.actualizar(id, self.producto, {1})
+        self.assertEqual(error.exception.version, 2)
+        self.assertEqual(self.repositorio.obtener(id)[2], 1.0)
+        self.assertTrue(self.repositorio.eliminar(id, '*'))
+        self.assertIsNone(self.repositorio.obtener(id))
+        self.assertIsNone(self.repositorio.actualizar(id, self.producto))
+        self.assertFalse(self.repositorio.eliminar(id))
+        with self.assertRaises(VersionDistinta) as error:
+            self.repositorio.eliminar(id, '*')
+        self.assertIsNone(error.exception.version)
+
+    def test_listar_con_filtros_y_cursor(self):
+        """Prueba filtros, proyeccion y paginacion por cursor"""
+        ids = self.repositorio.crear_lote([
+            {'nombre': nombre, 'precio': precio, 'descripcion': 'x'}
+            for nombre, precio in (('Ford Ka', 10.0), ('ford Fiesta', 20.0), ('Kia Rio', 30.0),
+                                   ('Ford Focus', 40.0), ('Fiat Uno', 50.0))])
+        productos, siguiente = self.repositorio.listar(self.consulta(limit='2'))
+        self.assertEqual([p['id'] for p in productos], ids[:2])
+        self.assertEqual(siguiente, ids[1])
+        productos, siguiente = self.repositorio.listar(self.consulta(limit='2', after=str(ids[3])))
+        self.assertEqual(([p['id'] for p in productos], siguiente), ([ids[4]], None))
+        productos, _ = self.repositorio.listar(self.consulta(nombre='FORD', precio_min='15', precio_max='40'))
+        self.assertEqual([p['nombre'] for p in productos], ['ford Fiesta', 'Ford Focus'])
+        productos, siguiente = self.repositorio.listar(self.consulta(fields='nombre', limit='1', nombre='Ki'))
+        self.assertEqual((productos, siguiente), ([{'nombre': 'Kia Rio'}], None))
+        productos, siguiente = self.repositorio.listar(self.consulta(fields='precio', limit='1'))
+        self.assertEqual((productos, siguiente), ([{'precio': 10.0}], ids[0]))
+
+    def test_lotes_y_version(self):
+        """Prueba las operaciones por lote y que la version del catalogo sube con cada escritura"""
+        inicial, _ = self.repositorio.version()
+        ids = self.repositorio.crear_lote([self.producto] * 3)
+        self.assertEqual(ids, list(range(ids[0], ids[0] + 3)))
+        despues, _ = self.repositorio.version()
+        self.assertGreater(despues, inicial)
+        existentes = self.repositorio.actualizar_lote([dict(self.producto, id=ids[0], precio=5.0),
+                                                       dict(self.producto, id=ids[-1] + 100)])
+        self.assertEqual(existentes, {ids[0]})
+        self.assertEqual(self.repositorio.obtener(ids[0])[2:], (5.0, 'Sedan', 2))
+        self.assertEqual(self.repositorio.eliminar_lote([ids[1], ids[-1] + 100]), {ids[1]})
+        productos, _ = self.repositorio.listar(self.consulta())
+        self.assertEqual([p['id'] for p in productos], [ids[0], ids[2]])
+        self.assertGreater(self.repositorio.version()[0], despues)
+        # Los ids no se reutilizan despues de borrar
+        self.assertGreater(self.repositorio.crear(self.producto), ids[2])
+
+
+class TestRepositorioSQLite(ContratoRepositorio, BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        import backend
+        contexto = self.app.app_context()
+        contexto.push()
+        self.addCleanup(contexto.pop)
+        self.repositorio = backend.get_repositorio()
+
+
+class TestRepositorioMemoria(ContratoRepositorio, unittest.TestCase):
+
+    def setUp(self):
+        from repository import RepositorioMemoria
+        self.repositorio = RepositorioMemoria()
+
+
+class TestCreateApp(unittest.TestCase):
+
+    def crear(self, **config):
+        import backend
+        nueva = backend.create_app(dict(config, TESTING=True))
+        self.addCleanup(backend.recursos(nueva).cerrar)
+        return nueva
+
+    def test_apps_aisladas(self):
+        """Prueba que dos apps del mismo proceso no comparten base, pool ni configuracion"""
+        import backend
+        bases = [fixtures.nueva_base(), fixtures.nueva_base()]
+        for path in bases:
+            self.addCleanup(fixtures.borrar_base, path)
+        una, otra = self.crear(DATABASE=bases[0]), self.crear(DATABASE=bases[1], PAGE_MAX_LIMIT=1)
+        una.test_client().post('/productos', json={'nombre': 'A', 'precio': 1.0, 'descripcion': 'a'})
+        self.assertEqual(len(una.test_client().get('/productos').get_json()), 1)
+        self.assertEqual(otra.test_client().get('/productos').get_json(), [])
+        self.assertEqual(una.config['PAGE_MAX_LIMIT'], 1000)
+        self.assertIsNot(backend.recursos(una).pool, backend.recursos(otra).pool)
+        self.assertNotEqual(backend.app.config['DATABASE'], bases[0])
+
+    def test_almacenamiento_en_memoria(self):
+        """Prueba la API completa sobre el repositorio en memoria"""
+        client = self.crear(STORAGE='memory').test_client()
+        creado = client.post('/productos', json={'nombre': 'Civic', 'precio': 1.0, 'descripcion': 'a'})
+        self.assertEqual((creado.get_json()['id'], creado.headers['ETag']), (1, '"p1-1"'))
+        self.assertEqual(client.get('/productos/1', headers={'If-None-Match': '"p1-1"'}).status_code, 304)
+        cambio = client.put('/productos/1', json={'nombre': 'Civic', 'precio': 2.0, 'descripcion': 'b'},
+                            headers={'If-Match': '"p1-1"'})
+        self.assertEqual(cambio.headers['ETag'], '"p1-2"')
+        vieja = client.put('/productos/1', json={'nombre': 'X', 'precio': 3.0, 'descripcion': 'c'},
+                           headers={'If-Match': '"p1-1"'})
+        self.assertEqual(vieja.status_code, 412)
+        lote = client.post('/productos/bulk', json=[{'nombre': 'Rio', 'precio': 5.0, 'descripcion': 'c'}, {}])
+        self.assertEqual([r.get('id') for r in lote.get_json()['resultados']], [2, None])
+        pagina = client.get('/productos?limit=1&fields=nombre').get_json()
+        self.assertEqual(pagina, {'productos': [{'nombre': 'Civic'}], 'next': 1})
+        lineas = client.get('/productos?nombre=ri', headers={'Accept': 'application/x-ndjson'}).get_data(as_text=True)
+        self.assertEqual([json.loads(linea)['id'] for linea in lineas.splitlines()], [2])
+        self.assertEqual(client.get('/productos/search?q=civic').status_code, 501)
+        self.assertEqual(client.get('/productos/stats').status_code, 501)
+        self.assertEqual(client.delete('/productos/1').status_code, 200)
+        self.assertEqual(client.get('/productos/1').status_code, 404)
+
+    def test_storage_desconocido(self):
+        """Prueba que un STORAGE invalido falla al crear la app"""
+        with self.assertRaises(ValueError):
+            self.crear(STORAGE='postgres')
+
+
+class TestMantenimiento(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        import backend
+        self.directorio = tempfile.mkdtemp(dir=fixtures.directorio())
+        self.app.config.update(MAINTENANCE_BACKUP_DIR=self.directorio, METRICS_ENABLED=True,
+                               MAINTENANCE_API_ENABLED=True, MAINTENANCE_TOKEN='secreto')
+        self.client = self.app.test_client()
+        self.client.environ_base['HTTP_X_MAINTENANCE_TOKEN'] = 'secreto'
+        self.insertar([(f'Producto {i}', float(i), 'x' * 200) for i in range(2000)])
+        self.backend = backend
+
+    def correr(self, tarea, opciones=None):
+        response = self.client.post('/admin/jobs', json={'tarea': tarea, 'opciones': opciones or {}})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.headers['Location'], f"/admin/jobs/{response.get_json()['id']}")
+        mantenimiento = self.backend.recursos(self.app).mantenimiento
+        self.assertTrue(mantenimiento.esperar(mantenimiento.trabajo(response.get_json()['id']), 30))
+        return self.client.get(response.headers['Location']).get_json()
+
+    def test_backup_mientras_se_escribe(self):
+        """Prueba que la copia en linea termina y es consistente con escrituras concurrentes"""
+        import threading
+        parar = threading.Event()
+
+        def escribir():
+            db = sqlite3.connect(self.temp_db_name, isolation_level=None)
+            while not parar.is_set():
+                db.execute("INSERT INTO productos (nombre, precio, descripcion) VALUES ('Nuevo', 1, 'y')")
+            db.close()
+
+        hilo = threading.Thread(target=escribir)
+        hilo.start()
+        try:
+            trabajo = self.correr('backup', {'destino': 'copia.db', 'paginas': 1})
+        finally:
+            parar.set()
+            hilo.join()
+        self.assertEqual(trabajo['estado'], 'terminado')
+        self.assertEqual(trabajo['progreso'], 1.0)
+        copia = sqlite3.connect(os.path.join(self.directorio, 'copia.db'))
+        self.assertEqual(copia.execute('PRAGMA integrity_check').fetchone()[0], 'ok')
+        self.assertEqual(copia.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+        self.assertGreaterEqual(copia.execute('SELECT COUNT(*) FROM productos').fetchone()[0], 2000)
+        copia.close()
+        self.assertEqual(os.listdir(self.directorio), ['copia.db'])
+
+    def test_vacuum_incremental_devuelve_paginas(self):
+        """Prueba que tras borrar, vacuum e incremental_vacuum achican la base"""
+        self.assertEqual(self.correr('incremental_vacuum')['estado'], 'fallido')
+        self.assertEqual(self.correr('vacuum', {'auto_vacuum': 'incremental'})['resultado']['auto_vacuum'],
+                         'incremental')
+        db = sqlite3.connect(self.temp_db_name)
+        db.execute('DELETE FROM productos WHERE id > 100')
+        db.commit()
+        libres = db.execute('PRAGMA freelist_count').fetchone()[0]
+        self.assertGreater(libres, 0)
+        resultado = self.correr('incremental_vacuum', {'paginas': 10})['resultado']
+        self.assertEqual((resultado['libres_antes'], resultado['libres_despues']), (libres, 0))
+        self.assertEqual(db.execute('PRAGMA freelist_count').fetchone()[0], 0)
+        self.assertLess(resultado['paginas_despues'], resultado['paginas_antes'])
+        db.close()
+
+    def test_api_y_metricas(self):
+        """Prueba validacion, autorizacion, listado de trabajos y metricas"""
+        trabajo = self.correr('analyze')
+        self.assertEqual((trabajo['estado'], trabajo['origen']), ('terminado', 'api'))
+        self.assertGreater(trabajo['resultado']['estadisticas'], 0)
+        self.assertIsNotNone(trabajo['duracion'])
+        self.assertEqual(self.client.get('/admin/jobs').get_json()['trabajos'][0]['id'], trabajo['id'])
+        self.assertEqual(self.client.get('/admin/jobs/999').status_code, 404)
+        for cuerpo in ({'tarea': 'reindex'}, {'tarea': 'backup', 'opciones': {'destino': '../fuera.db'}},
+                       {'tarea': 'vacuum', 'opciones': {'auto_vacuum': 'siempre'}}, [1]):
+            self.assertEqual(self.client.post('/admin/jobs', json=cuerpo).status_code, 400, cuerpo)
+        anonimo = self.app.test_client()
+        self.assertEqual(anonimo.get('/admin/jobs').status_code, 403)
+        self.assertEqual(anonimo.get('/admin/jobs', headers={'X-Maintenance-Token': 'otro'}).status_code, 403)
+        self.assertEqual(self.client.get('/admin/jobs', environ_base={'REMOTE_ADDR': '10.0.0.8'}).status_code, 200)
+        with patch.dict(self.app.config, {'MAINTENANCE_ALLOWED_IPS': ('127.0.0.1',)}):
+            self.assertEqual(anonimo.get('/admin/jobs').status_code, 200)
+        with patch.dict(self.app.config, {'MAINTENANCE_API_ENABLED': False}):
+            self.assertEqual(self.client.get('/admin/jobs').status_code, 404)
+        texto = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('crud_maintenance_jobs_total{job="analyze",result="terminado"} 1', texto)
+        self.assertIn('crud_maintenance_job_duration_seconds_count{job="analyze"} 1', texto)
+        self.assertIn('crud_maintenance_trabajos_total 1', texto)
+        self.assertIn('crud_maintenance_en_curso 0', texto)
+
+    def test_poda_de_cambios(self):
+        """Prueba que la poda acota la bitacora y que feed y snapshot lo notan"""
+        with patch.dict(self.app.config, {'SNAPSHOT_ENABLED': True}):
+            self.client.get('/productos/1')
+            snapshot = self.backend.recursos(self.app).snapshot
+            since = self.client.get('/productos/changes').get_json()['next']
+            for i in range(3):
+                self.client.put('/productos/1', json={'nombre': f'Editado {i}', 'precio': 1.0, 'descripcion': 'x'})
+            trabajo = self.correr('podar_cambios', {'max_filas': 1})
+            self.assertEqual(trabajo['resultado'], {'borrados': 2002, 'restantes': 1})
+            respuesta = self.client.get(f'/productos/changes?since={since}')
+            self.assertEqual((respuesta.status_code, respuesta.get_json()['next']), (410, since + 3))
+            self.assertEqual(self.client.get('/productos/1').get_json()['nombre'], 'Editado 2')
+            self.assertEqual(snapshot.stats()['cargas'], 2)
+        self.assertEqual(self.client.post('/admin/jobs', json={'tarea': 'podar_cambios',
+                                                               'opciones': {'max_edad': -1}}).status_code, 400)
+
+    def test_cola_acotada(self):
+        """Prueba que con MAINTENANCE_MAX_PENDING trabajos en cola el siguiente recibe 503"""
+        from maintenance import ColaLlena
+        with self.app.app_context(), patch.dict(self.app.config, {'MAINTENANCE_MAX_PENDING': 2}):
+            mantenimiento = self.backend.get_mantenimiento()
+        # Sin arrancar el hilo los trabajos quedan en cola
+        with patch.object(mantenimiento, 'iniciar'):
+            estados = [self.client.post('/admin/jobs', json={'tarea': 'analyze'}).status_code for _ in range(3)]
+        self.assertEqual(estados, [202, 202, 503])
+        self.assertRaises(ColaLlena, mantenimiento.encolar, 'analyze')
+        self.assertEqual(mantenimiento.stats()['rechazados'], 2)
+
+    def test_programa_lo_corre_un_solo_worker(self):
+        """Prueba que cada periodo de una tarea programada lo reclama un solo worker"""
+        import time
+        from maintenance import reclamar
+        una = sqlite3.connect(self.temp_db_name, isolation_level=None)
+        otra = sqlite3.connect(self.temp_db_name, isolation_level=None)
+        self.assertFalse(reclamar(una, 'analyze', 1000.0, 60))
+        self.assertFalse(reclamar(otra, 'analyze', 1030.0, 60))
+        self.assertTrue(reclamar(otra, 'analyze', 1060.0, 60))
+        self.assertFalse(reclamar(una, 'analyze', 1061.0, 60))
+        una.close()
+        otra.close()
+        with patch.dict(self.app.config, {'MAINTENANCE_SCHEDULE': {'analyze': 0.01}, 'MAINTENANCE_CHECK_INTERVAL': 0.01}):
+            with self.app.app_context():
+                self.backend.iniciar_mantenimiento()
+            mantenimiento = self.backend.recursos(self.app).mantenimiento
+            for _ in range(500):
+                if any(t.estado == 'terminado' for t in mantenimiento.trabajos()):
+                    break
+                time.sleep(0.01)
+        self.assertEqual(mantenimiento.trabajos()[-1].origen, 'programado')
+
+
+class TestAdmision(BaseDatosTemporal):
+
+    def setUp(self):
+        super().setUp()
+        self.app.config.update(RATELIMIT_ENABLED=True, METRICS_ENABLED=True)
+        self.client = self.app.test_client()
+        self.insertar([('A', 1.0, 'x'), ('B', 2.0, 'y')])
+
+    def politicas(self, politicas, **config):
+        patcher = patch.dict(self.app.config, dict(config, RATELIMIT_ENDPOINTS=politicas))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_limite_por_cliente(self):
+        """Prueba que agotada la rafaga de un cliente responde 429 sin afectar a otros"""
+        self.politicas({'GET producto_id': {'client_rate': 0.5, 'client_burst': 2}},
+                       RATELIMIT_CLIENT_HEADER='X-Forwarded-For')
+        estados = [self.client.get('/productos/1').status_code for _ in range(3)]
+        self.assertEqual(estados, [200, 200, 429])
+        rechazada = self.client.get('/productos/1')
+        self.assertEqual(rechazada.get_json()['motivo'], 'limite_cliente')
+        self.assertIn(rechazada.headers['Retry-After'], ('1', '2'))
+        self.assertEqual(self.client.get('/productos/1', headers={'X-Forwarded-For': '10.0.0.9, 10.0.0.1'}).status_code, 200)
+        self.assertEqual(self.client.put('/productos/1', json={'nombre': 'A', 'precio': 3.0, 'descripcion': 'x'}).status_code, 200)
+        texto = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('crud_admission_requests_total{endpoint="producto_id",result="limite_cliente"} 2', texto)
+        self.assertIn('crud_admission_rechazadas_total 2', texto)
+
+    def test_cliente_detras_de_proxy(self):
+        """Prueba que el cliente sale de la entrada que agrega el proxy y no de
+        las que manda el cliente en X-Forwarded-For"""
+        self.politicas({'GET producto_id': {'client_rate': 0.5, 'client_burst': 2}},
+                       RATELIMIT_CLIENT_HEADER='X-Forwarded-For')
+        estados = [self.client.get('/productos/1', headers={'X-Forwarded-For': f'1.1.1.{i}, 10.0.0.5'}).status_code
+                   for i in range(3)]
+        self.assertEqual(estados, [200, 200, 429])
+        self.assertEqual(self.client.get('/productos/1', headers={'X-Forwarded-For': '10.0.0.6'}).status_code, 200)
+        # Con dos proxies propios el cliente es la anteultima entrada
+        self.politicas({'GET producto_id': {'client_rate': 0.5, 'client_burst': 1}},
+                       RATELIMIT_CLIENT_HEADER='X-Forwarded-For', RATELIMIT_TRUSTED_PROXIES=2)
+        estados = [self.client.get('/productos/1', headers={'X-Forwarded-For': f'1.1.1.1, 10.0.0.7, 10.0.1.{i}'}).status_code
+                   for i in range(2)]
+        self.assertEqual(estados, [200, 429])
+
+    def test_cola_llena_con_stream_abierto(self):
+        """Prueba que un stream en curso ocupa su lugar hasta cerrarse y el resto recibe 503"""
+        self.politicas({'GET productos': {'concurrency': 1, 'queue': 0}})
+        stream = self.client.get('/productos?stream=1', buffered=False)
+        self.assertTrue(stream.is_streamed)
+        rechazada = self.client.get('/productos')
+        self.assertEqual((rechazada.status_code, rechazada.get_json()['motivo']), (503, 'cola_llena'))
+        self.assertEqual(rechazada.headers['Retry-After'], '1')
+        self.assertEqual(self.client.get('/productos/1').status_code, 200)
+        stream.get_data()
+        stream.close()
+        self.assertEqual(self.client.get('/productos').status_code, 200)
+
+    def test_espera_y_latencia(self):
+        """Prueba la cola con espera, el vencimiento de la espera y el rechazo por latencia"""
+        import threading
+        from ratelimit import ADMITIDA, Admision, ESPERA_AGOTADA, LATENCIA
+        admision = Admision('prueba', {'concurrency': 1, 'queue': 1, 'wait': 0.05, 'latency': 1.0})
+        self.assertEqual(admision.admitir('a'), (ADMITIDA, 0.0))
+        self.assertEqual(admision.admitir('b')[0], ESPERA_AGOTADA)
+        threading.Timer(0.01, admision.liberar, [0.001]).start()
+        admision.espera = 5.0
+        self.assertEqual(admision.admitir('b'), (ADMITIDA, 0.0))
+        for _ in range(20):
+            admision.liberar(3.0)
+            admision.admitir('c')
+        self.assertEqual(admision.admitir('d'), (LATENCIA, 3))
+        admision.liberar(3.0)
+        self.assertEqual(admision.admitir('d'), (ADMITIDA, 0.0))
+        self.assertEqual(admision.stats()['rechazadas'], 2)
+        with self.assertRaises(ValueError):
+            Admision('prueba', {'concurency': 1})
+
+
 def run_all_tests():
     """Función para ejecutar todas las pruebas"""
     # Crear suite de pruebas
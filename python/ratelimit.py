@@ -0,0 +1,174 @@
+"""Limite de tasa y control de admision por endpoint.
+
+Una rafaga de listados completos (GET /productos) ocupa los hilos del worker
+y las lecturas baratas (GET /productos/<id>) quedan esperando detras. Cada
+endpoint con politica (ver RATELIMIT_ENDPOINTS en backend.py) pasa por:
+
+  - una cubeta de tokens por cliente (``client_rate`` por segundo, hasta
+    ``client_burst`` acumulados) y otra para todo el endpoint (``rate`` y
+    ``burst``); sin token la respuesta es 429 con Retry-After;
+  - un limite de peticiones en curso (``concurrency``). Si esta lleno la
+    peticion espera su turno hasta ``wait`` segundos, con a lo sumo
+    ``queue`` esperando; si la cola esta llena, si se agota la espera o si
+    la latencia reciente del endpoint supera ``latency`` (no tiene sentido
+    encolar detras de peticiones lentas) la respuesta es 503 con
+    Retry-After.
+
+Una peticion que espera ocupa un hilo igual que una que corre: con
+``concurrency`` + ``queue`` por debajo de los hilos del worker quedan hilos
+libres para el resto de los endpoints. Los limites son por proceso, como el
+cache y las metricas: con N workers el total es N veces el de cada uno.
+"""
+import collections
+import math
+import threading
+import time
+
+ADMITIDA = 'admitida'
+LIMITE_CLIENTE = 'limite_cliente'
+LIMITE_ENDPOINT = 'limite_endpoint'
+COLA_LLENA = 'cola_llena'
+LATENCIA = 'latencia'
+ESPERA_AGOTADA = 'espera_agotada'
+
+# Rechazos por tasa (429); el resto de los rechazos son por carga (503)
+POR_TASA = (LIMITE_CLIENTE, LIMITE_ENDPOINT)
+
+CLAVES = {'client_rate', 'client_burst', 'rate', 'burst', 'concurrency', 'queue', 'wait', 'latency'}
+
+# Peso de la ultima peticion en el promedio movil de la latencia
+SUAVIZADO = 0.2
+
+
+class Cubetas:
+    """Cubetas de tokens por clave, las ``maximo`` usadas mas recientemente."""
+
+    def __init__(self, tasa, rafaga, maximo=10000):
+        self.tasa = float(tasa)
+        self.rafaga = float(rafaga or tasa)
+        self.maximo = maximo
+        # clave -> [tokens, momento]
+        self._cubetas = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def tomar(self, clave, ahora):
+        """0 si habia un token, o los segundos hasta que haya uno."""
+        with self._lock:
+            cubeta = self._cubetas.get(clave)
+            if cubeta is None:
+                cubeta = self._cubetas[clave] = [self.rafaga, ahora]
+                if len(self._cubetas) > self.maximo:
+                    # Olvidar un cliente le devuelve la rafaga completa
+                    self._cubetas.popitem(last=False)
+            else:
+                self._cubetas.move_to_end(clave)
+                cubeta[0] = min(self.rafaga, cubeta[0] + (ahora - cubeta[1]) * self.tasa)
+                cubeta[1] = ahora
+            if cubeta[0] >= 1:
+                cubeta[0] -= 1
+                return 0.0
+            return (1 - cubeta[0]) / self.tasa
+
+    def __len__(self):
+        return len(self._cubetas)
+
+
+class Admision:
+    """Politica de un endpoint: tasas, peticiones en curso y cola."""
+
+    def __init__(self, nombre, politica, max_clientes=10000):
+        desconocidas = set(politica) - CLAVES
+        if desconocidas:
+            raise ValueError(f"Opciones desconocidas en la politica de {nombre}: {', '.join(sorted(desconocidas))}")
+        self.nombre = nombre
+        self.clientes = (Cubetas(politica['client_rate'], politica.get('client_burst'), max_clientes)
+                         if politica.get('client_rate') else None)
+        self.total = Cubetas(politica['rate'], politica.get('burst'), 1) if politica.get('rate') else None
+        self.concurrencia = politica.get('concurrency')
+        self.cola = politica.get('queue', 0)
+        self.espera = politica.get('wait', 0.0)
+        self.latencia_maxima = politica.get('latency')
+        self.latencia = 0.0
+        self.en_curso = 0
+        self.esperando = 0
+        self._cond = threading.Condition()
+        self._stats = {'admitidas': 0, 'rechazadas': 0}
+
+    def admitir(self, cliente):
+        """(resultado, segundos para reintentar). Con ADMITIDA hay que llamar
+        a ``liberar`` al terminar la peticion."""
+        ahora = time.monotonic()
+        if self.clientes is not None:
+            espera = self.clientes.tomar(cliente, ahora)
+            if espera:
+                return self._rechazar(LIMITE_CLIENTE, espera)
+        if self.total is not None:
+            espera = self.total.tomar(None, ahora)
+            if espera:
+                return self._rechazar(LIMITE_ENDPOINT, espera)
+        if self.concurrencia is None:
+            with self._cond:
+                self.en_curso += 1
+                self._stats['admitidas'] += 1
+            return ADMITIDA, 0.0
+        with self._cond:
+            if self.en_curso >= self.concurrencia:
+                if self.latencia_maxima is not None and self.latencia > self.latencia_maxima:
+                    return self._rechazar(LATENCIA, self.latencia, con_lock=True)
+                if self.esperando >= self.cola:
+                    return self._rechazar(COLA_LLENA, self.latencia, con_lock=True)
+                self.esperando += 1
+                try:
+                    libre = self._cond.wait_for(lambda: self.en_curso < self.concurrencia, self.espera)
+                finally:
+                    self.esperando -= 1
+                if not libre:
+                    return self._rechazar(ESPERA_AGOTADA, self.latencia, con_lock=True)
+            self.en_curso += 1
+            self._stats['admitidas'] += 1
+        return ADMITIDA, 0.0
+
+    def liberar(self, duracion):
+        with self._cond:
+            self.en_curso -= 1
+            self.latencia += SUAVIZADO * (duracion - self.latencia)
+            self._cond.notify()
+
+    def _rechazar(self, resultado, espera, con_lock=False):
+        if con_lock:
+            self._stats['rechazadas'] += 1
+        else:
+            with self._cond:
+                self._stats['rechazadas'] += 1
+        # Retry-After va en segundos enteros
+        return resultado, max(1, math.ceil(espera))
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(en_curso=self.en_curso, esperando=self.esperando, latencia=self.latencia,
+                         clientes=len(self.clientes) if self.clientes is not None else 0)
+        return stats
+
+
+class ControlAdmision:
+    """Las politicas de una app, por 'METODO endpoint' o por endpoint."""
+
+    def __init__(self, politicas, max_clientes=10000):
+        self.politicas = politicas
+        self.admisiones = {clave: Admision(clave, politica, max_clientes)
+                           for clave, politica in politicas.items()}
+
+    def buscar(self, metodo, endpoint):
+        admision = self.admisiones.get(f'{metodo} {endpoint}')
+        if admision is None:
+            admision = self.admisiones.get(endpoint)
+        return admision
+
+    def stats(self):
+        total = {'admitidas': 0, 'rechazadas': 0, 'en_curso': 0, 'esperando': 0}
+        for admision in self.admisiones.values():
+            for clave, valor in admision.stats().items():
+                if clave in total:
+                    total[clave] += valor
+        return total
@@ -0,0 +1,406 @@
+"""Acceso a los productos detras de una interfaz comun.
+
+Las vistas de backend.py validan la peticion, arman la respuesta y piden los
+datos a un ``Repositorio``; no ven SQL. Hay dos implementaciones:
+
+  - ``RepositorioSQLite``: la de produccion. Lee con la conexion del pool de
+    la peticion y escribe dentro de la transaccion de la cola de escritura
+    (ver writer.py), asi que cada operacion es atomica.
+  - ``RepositorioMemoria``: un dict protegido por un lock, para pruebas y
+    para comparar contra SQLite con el mismo benchmark (``STORAGE='memory'``).
+    No es persistente ni se comparte entre procesos.
+
+Una consulta de listado es el dict que arma ``backend.parse_listado``:
+campos, filtros (nombre por prefijo, precio_min, precio_max), after, limit y
+paginado. Los listados van ordenados por id y, si la consulta es paginada,
+devuelven tambien el id desde el que sigue la proxima pagina (o None).
+
+Un producto leido es un ``Producto``: una tupla con nombres de campo (sin
+un dict por fila); ``datos()`` da el dict que se responde como JSON.
+
+La version de cada producto arranca en 1 y sube con cada actualizacion;
+``versiones`` en actualizar/eliminar es None (sin condicion), '*' (que
+exista) o un conjunto de versiones aceptadas, y si no se cumple se lanza
+``VersionDistinta``.
+"""
+import bisect
+import threading
+import time
+from typing import NamedTuple
+
+from encoding import objeto_sql, unir_filas
+
+COLUMNAS = ('id', 'nombre', 'precio', 'descripcion')
+COLUMNAS_REAL = ('precio',)
+
+# Las sentencias fijas son siempre el mismo texto: sqlite3 las compila una
+# vez por conexion y las reutiliza (ver DB_CACHED_STATEMENTS en backend.py)
+OBTENER = 'SELECT id, nombre, precio, descripcion, version FROM productos WHERE id = ?'
+VERSION = 'SELECT version FROM productos WHERE id = ?'
+INSERTAR = 'INSERT INTO productos (nombre, precio, descripcion) VALUES (?, ?, ?)'
+ACTUALIZAR = 'UPDATE productos SET nombre = ?, precio = ?, descripcion = ? WHERE id = ?'
+ELIMINAR = 'DELETE FROM productos WHERE id = ?'
+CATALOGO = 'SELECT version, actualizado FROM catalogo WHERE id = 1'
+
+
+class Producto(NamedTuple):
+    id: int
+    nombre: str
+    precio: float
+    descripcion: str
+    version: int
+
+    def datos(self):
+        # Desarmar la tupla es mas rapido que leer los campos por nombre
+        id, nombre, precio, descripcion, _ = self
+        return {'id': id, 'nombre': nombre, 'precio': precio, 'descripcion': descripcion}
+
+
+class VersionDistinta(Exception):
+    """La fila cambio (o no existe) desde el ETag que mando el cliente."""
+
+    def __init__(self, version):
+        super().__init__(version)
+        self.version = version
+
+
+class Repositorio:
+    """Interfaz del almacenamiento de productos."""
+
+    def version(self):
+        """(version, actualizado) del catalogo: la version sube con cada
+        escritura y ``actualizado`` es su timestamp."""
+        raise NotImplementedError
+
+    def listar(self, consulta):
+        """(productos, siguiente), con un dict por producto con los campos pedidos."""
+        raise NotImplementedError
+
+    def obtener(self, id):
+        """El ``Producto``, o None si no existe."""
+        raise NotImplementedError
+
+    def crear(self, producto):
+        """Guarda ``producto`` (nombre, precio, descripcion) y devuelve su id."""
+        raise NotImplementedError
+
+    def actualizar(self, id, producto, versiones=None):
+        """Devuelve la version nueva, o None si el producto no existe."""
+        raise NotImplementedError
+
+    def eliminar(self, id, versiones=None):
+        """Devuelve True si el producto existia."""
+        raise NotImplementedError
+
+    def crear_lote(self, productos):
+        """Guarda todos en una operacion y devuelve sus ids, en orden."""
+        raise NotImplementedError
+
+    def actualizar_lote(self, productos):
+        """Actualiza los que existen (cada uno con su id) y devuelve esos ids."""
+        raise NotImplementedError
+
+    def eliminar_lote(self, ids):
+        """Borra los que existen y devuelve esos ids."""
+        raise NotImplementedError
+
+
+def filtro_nombre(nombre):
+    # Busqueda por prefijo, sin distinguir mayusculas
+    if not nombre:
+        return [], []
+    prefijo = nombre.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return ["nombre LIKE ? ESCAPE '\\'"], [prefijo + '%']
+
+
+def sql_listado(consulta, como_json=False):
+    campos = consulta['campos']
+    filtros = consulta['filtros']
+    # El id se pide siempre para poder calcular el cursor
+    if como_json:
+        columnas = ('id', objeto_sql(campos, COLUMNAS_REAL))
+    else:
+        columnas = campos if 'id' in campos else ('id',) + campos
+    condiciones, params = filtro_nombre(filtros.get('nombre'))
+    if filtros.get('precio_min') is not None:
+        condiciones.append('precio >= ?')
+        params.append(filtros['precio_min'])
+    if filtros.get('precio_max') is not None:
+        condiciones.append('precio <= ?')
+        params.append(filtros['precio_max'])
+    if consulta['after'] is not None:
+        condiciones.append('id > ?')
+        params.append(consulta['after'])
+    sql = f"SELECT {', '.join(columnas)} FROM productos"
+    if condiciones:
+        sql += ' WHERE ' + ' AND '.join(condiciones)
+    sql += ' ORDER BY id'
+    if consulta['paginado']:
+        sql += ' LIMIT ?'
+        params.append(consulta['limit'] + 1)
+    return sql, params, columnas
+
+
+def version_catalogo(db):
+    return db.execute(CATALOGO).fetchone()
+
+
+def ids_existentes(db, ids, tamano=500):
+    existentes = set()
+    ids = list(ids)
+    for i in range(0, len(ids), tamano):
+        lote = ids[i:i + tamano]
+        marcas = ', '.join('?' * len(lote))
+        existentes.update(row[0] for row in
+                          db.execute(f'SELECT id FROM productos WHERE id IN ({marcas})', lote))
+    return existentes
+
+
+def verificar_version(db, id, versiones):
+    # Se compara dentro de la transaccion de escritura: entre la lectura y el
+    # UPDATE no puede colarse otra escritura
+    if versiones is None:
+        return
+    row = db.execute(VERSION, (id,)).fetchone()
+    if row is None or (versiones != '*' and row[0] not in versiones):
+        raise VersionDistinta(row and row[0])
+
+
+def a_dicts(rows, campos, columnas):
+    # Las columnas son los campos pedidos, en orden, con el id delante si no
+    # se pidio: dict(zip()) arma cada fila sin indexar campo por campo
+    if len(columnas) == len(campos):
+        return [dict(zip(campos, row)) for row in rows]
+    return [dict(zip(campos, row[1:])) for row in rows]
+
+
+def cortar_pagina(rows, consulta, indice_id):
+    siguiente = None
+    if consulta['paginado'] and len(rows) > consulta['limit']:
+        rows = rows[:consulta['limit']]
+        siguiente = rows[-1][indice_id]
+    return rows, siguiente
+
+
+class RepositorioSQLite(Repositorio):
+    """``leer()`` devuelve la conexion de la peticion y ``escribir(fn)`` corre
+    ``fn(db)`` en una transaccion; backend.py pasa get_db y write."""
+
+    def __init__(self, leer, escribir, metricas=None):
+        self.leer = leer
+        self.escribir = escribir
+        self.metricas = metricas
+
+    def _acumular(self, fase, inicio):
+        if self.metricas is not None:
+            self.metricas.acumular(fase, time.perf_counter() - inicio)
+
+    def version(self):
+        return version_catalogo(self.leer())
+
+    def listar(self, consulta):
+        campos = consulta['campos']
+        sql, params, columnas = sql_listado(consulta)
+        rows, siguiente = cortar_pagina(self.leer().execute(sql, params).fetchall(),
+                                        consulta, columnas.index('id'))
+        inicio = time.perf_counter()
+        productos = a_dicts(rows, campos, columnas)
+        self._acumular('conversion', inicio)
+        return productos, siguiente
+
+    def listar_json(self, consulta):
+        """Igual que listar pero devuelve el arreglo ya codificado en JSON,
+        armado por SQLite (ver encoding.py)."""
+        sql, params, _ = sql_listado(consulta, como_json=True)
+        rows, siguiente = cortar_pagina(self.leer().execute(sql, params).fetchall(), consulta, 0)
+        inicio = time.perf_counter()
+        cuerpo = unir_filas(rows)
+        self._acumular('serializacion', inicio)
+        return cuerpo, siguiente
+
+    def obtener(self, id):
+        row = self.leer().execute(OBTENER, (id,)).fetchone()
+        return None if row is None else Producto._make(row)
+
+    def crear(self, producto):
+        params = [producto['nombre'], producto['precio'], producto['descripcion']]
+        return self.escribir(lambda db: db.execute(INSERTAR, params).lastrowid)
+
+    def actualizar(self, id, producto, versiones=None):
+        params = [producto['nombre'], producto['precio'], producto['descripcion'], id]
+
+        def actualizar(db):
+            verificar_version(db, id, versiones)
+            db.execute(ACTUALIZAR, params)
+            row = db.execute(VERSION, (id,)).fetchone()
+            return row and row[0]
+
+        return self.escribir(actualizar)
+
+    def eliminar(self, id, versiones=None):
+        def eliminar(db):
+            verificar_version(db, id, versiones)
+            return db.execute(ELIMINAR, (id,)).rowcount > 0
+
+        return self.escribir(eliminar)
+
+    def crear_lote(self, productos):
+        params = [(producto['nombre'], producto['precio'], producto['descripcion']) for producto in productos]
+
+        def insertar(db):
+            if not params:
+                return 0
+            db.executemany(INSERTAR, params)
+            # Con AUTOINCREMENT y el bloqueo de escritura tomado, los ids
+            # del lote son consecutivos y terminan en el valor de sqlite_sequence
+            return db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'productos'").fetchone()[0]
+
+        ultimo = self.escribir(insertar)
+        return list(range(ultimo - len(params) + 1, ultimo + 1))
+
+    def actualizar_lote(self, productos):
+        def actualizar(db):
+            existentes = ids_existentes(db, (producto['id'] for producto in productos))
+            db.executemany(ACTUALIZAR,
+                           [(producto['nombre'], producto['precio'], producto['descripcion'], producto['id'])
+                            for producto in productos if producto['id'] in existentes])
+            return existentes
+
+        return self.escribir(actualizar)
+
+    def eliminar_lote(self, ids):
+        def eliminar(db):
+            existentes = ids_existentes(db, ids)
+            db.executemany(ELIMINAR, [(id,) for id in existentes])
+            return existentes
+
+        return self.escribir(eliminar)
+
+
+class RepositorioMemoria(Repositorio):
+    """Los productos en un dict id -> [nombre, precio, descripcion, version]
+    mas la lista ordenada de ids para los cursores. Igual que SQLite con
+    AUTOINCREMENT, los ids no se reutilizan."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filas = {}
+        self._ids = []
+        self._ultimo = 0
+        self._version = 0
+        self._actualizado = time.time()
+
+    def _cambio(self):
+        self._version += 1
+        self._actualizado = time.time()
+
+    def _verificar(self, id, versiones):
+        if versiones is None:
+            return
+        fila = self._filas.get(id)
+        if fila is None or (versiones != '*' and fila[3] not in versiones):
+            raise VersionDistinta(fila and fila[3])
+
+    def _insertar(self, producto):
+        self._ultimo += 1
+        self._filas[self._ultimo] = [producto['nombre'], producto['precio'], producto['descripcion'], 1]
+        # Los ids crecen siempre: agregar al final deja la lista ordenada
+        self._ids.append(self._ultimo)
+        return self._ultimo
+
+    def _borrar(self, id):
+        del self._filas[id]
+        del self._ids[bisect.bisect_left(self._ids, id)]
+
+    def version(self):
+        with self._lock:
+            return self._version, self._actualizado
+
+    def listar(self, consulta):
+        campos = consulta['campos']
+        filtros = consulta['filtros']
+        # Mismo criterio que LIKE en SQLite: prefijo sin distinguir mayusculas
+        prefijo = (filtros.get('nombre') or '').lower()
+        minimo, maximo = filtros.get('precio_min'), filtros.get('precio_max')
+        tope = consulta['limit'] + 1 if consulta['paginado'] else None
+        ids, productos = [], []
+        with self._lock:
+            desde = 0 if consulta['after'] is None else bisect.bisect_right(self._ids, consulta['after'])
+            for id in self._ids[desde:]:
+                nombre, precio, descripcion, _ = self._filas[id]
+                if prefijo and not (isinstance(nombre, str) and nombre.lower().startswith(prefijo)):
+                    continue
+                if minimo is not None and not (isinstance(precio, (int, float)) and precio >= minimo):
+                    continue
+                if maximo is not None and not (isinstance(precio, (int, float)) and precio <= maximo):
+                    continue
+                valores = {'id': id, 'nombre': nombre, 'precio': precio, 'descripcion': descripcion}
+                ids.append(id)
+                productos.append({campo: valores[campo] for campo in campos})
+                if len(ids) == tope:
+                    break
+        siguiente = None
+        if len(ids) == tope:
+            productos.pop()
+            siguiente = ids[-2]
+        return productos, siguiente
+
+    def obtener(self, id):
+        with self._lock:
+            fila = self._filas.get(id)
+            return None if fila is None else Producto(id, *fila)
+
+    def crear(self, producto):
+        with self._lock:
+            id = self._insertar(producto)
+            self._cambio()
+            return id
+
+    def actualizar(self, id, producto, versiones=None):
+        with self._lock:
+            self._verificar(id, versiones)
+            fila = self._filas.get(id)
+            if fila is None:
+                return None
+            fila[:] = [producto['nombre'], producto['precio'], producto['descripcion'], fila[3] + 1]
+            self._cambio()
+            return fila[3]
+
+    def eliminar(self, id, versiones=None):
+        with self._lock:
+            self._verificar(id, versiones)
+            if id not in self._filas:
+                return False
+            self._borrar(id)
+            self._cambio()
+            return True
+
+    def crear_lote(self, productos):
+        with self._lock:
+            ids = [self._insertar(producto) for producto in productos]
+            if ids:
+                self._cambio()
+            return ids
+
+    def actualizar_lote(self, productos):
+        existentes = set()
+        with self._lock:
+            for producto in productos:
+                fila = self._filas.get(producto['id'])
+                if fila is not None:
+                    fila[:] = [producto['nombre'], producto['precio'], producto['descripcion'], fila[3] + 1]
+                    existentes.add(producto['id'])
+            if existentes:
+                self._cambio()
+        return existentes
+
+    def eliminar_lote(self, ids):
+        existentes = set()
+        with self._lock:
+            for id in ids:
+                if id in self._filas:
+                    self._borrar(id)
+                    existentes.add(id)
+            if existentes:
+                self._cambio()
+        return existentes
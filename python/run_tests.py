@@ -0,0 +1,115 @@
+"""Corre las pruebas unittest en varios procesos.
+
+Uso: python run_tests.py [-j N] [modulo ...]
+
+Por defecto corre caja_blanca y pru_unitaria. Las clases de prueba se
+reparten de a una entre los procesos a medida que se liberan, las de mas
+pruebas primero. Cada proceso tiene su propio directorio de bases (ver
+fixtures.py), asi que no comparten archivos. Con -j 1 corre todo en este
+mismo proceso.
+
+Sin -j se usa a lo sumo un proceso por nucleo y uno cada PRUEBAS_POR_PROCESO
+pruebas: cada proceso nuevo (spawn) tarda ~0.2 s en arrancar e importar la
+app, y con pocas pruebas por proceso eso cuesta mas de lo que ahorra. Con
+un solo nucleo, o con menos de 2 * PRUEBAS_POR_PROCESO pruebas, corre en
+serie.
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+MODULOS = ('caja_blanca', 'pru_unitaria')
+# Con ~17 ms por prueba, 60 pruebas (~1 s) pagan los ~0.2 s de arrancar un proceso
+PRUEBAS_POR_PROCESO = 60
+
+
+def clases(modulos):
+    """Pares ('modulo.Clase', cantidad de pruebas), de mayor a menor cantidad."""
+    cargador = unittest.TestLoader()
+    encontradas = []
+    for modulo in modulos:
+        for grupo in cargador.loadTestsFromName(modulo):
+            pruebas = list(grupo)
+            if pruebas:
+                clase = type(pruebas[0])
+                encontradas.append((f'{clase.__module__}.{clase.__qualname__}', len(pruebas)))
+    encontradas.sort(key=lambda par: par[1], reverse=True)
+    return encontradas
+
+
+def procesos_por_defecto(pruebas, nucleos=None):
+    nucleos = nucleos or os.cpu_count() or 1
+    return max(1, min(nucleos, pruebas // PRUEBAS_POR_PROCESO))
+
+
+def correr_clase(nombre):
+    salida = io.StringIO()
+    inicio = time.perf_counter()
+    suite = unittest.TestLoader().loadTestsFromName(nombre)
+    resultado = unittest.TextTestRunner(stream=salida, verbosity=0).run(suite)
+    return {
+        'clase': nombre,
+        'pruebas': resultado.testsRun,
+        'fallos': [(str(prueba), texto) for prueba, texto in resultado.failures],
+        'errores': [(str(prueba), texto) for prueba, texto in resultado.errors],
+        'omitidas': len(resultado.skipped),
+        'segundos': time.perf_counter() - inicio,
+        'pid': os.getpid(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='procesos (por defecto segun nucleos y cantidad de pruebas)')
+    parser.add_argument('modulos', nargs='*', default=MODULOS)
+    args = parser.parse_args(argv)
+
+    inicio = time.perf_counter()
+    encontradas = clases(args.modulos)
+    nombres = [nombre for nombre, _ in encontradas]
+    if args.jobs is None:
+        args.jobs = procesos_por_defecto(sum(cantidad for _, cantidad in encontradas))
+    if args.jobs <= 1:
+        resultados = [correr_clase(nombre) for nombre in nombres]
+    else:
+        # Los procesos del pool terminan sin correr atexit: sus directorios
+        # (ver fixtures.py) van dentro de uno comun que se borra aqui
+        padre = os.environ.get('CRUD_TEST_DIR') or ('/dev/shm' if os.path.isdir('/dev/shm') else None)
+        comun = tempfile.mkdtemp(prefix='crud-pruebas-', dir=padre)
+        os.environ['CRUD_TEST_DIR'] = comun
+        try:
+            # spawn: cada proceso importa backend de cero, sin heredar hilos
+            # ni conexiones del padre
+            contexto = multiprocessing.get_context('spawn')
+            with contexto.Pool(min(args.jobs, len(nombres))) as pool:
+                resultados = list(pool.imap_unordered(correr_clase, nombres))
+        finally:
+            shutil.rmtree(comun, ignore_errors=True)
+    total = time.perf_counter() - inicio
+
+    pruebas = sum(r['pruebas'] for r in resultados)
+    fallos = [f for r in resultados for f in r['fallos']]
+    errores = [e for r in resultados for e in r['errores']]
+    for titulo, lista in (('ERROR', errores), ('FALLO', fallos)):
+        for prueba, texto in lista:
+            print('=' * 70)
+            print(f'{titulo}: {prueba}')
+            print('-' * 70)
+            print(texto)
+    procesos = len({r['pid'] for r in resultados})
+    suma = sum(r['segundos'] for r in resultados)
+    print(f'{pruebas} pruebas en {total:.2f}s con {procesos} proceso(s) '
+          f'({suma:.2f}s sumando las clases); {len(fallos)} fallos, {len(errores)} errores, '
+          f"{sum(r['omitidas'] for r in resultados)} omitidas")
+    return 0 if not fallos and not errores else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,310 @@
+"""Lanzador de produccion: un proceso maestro con N workers preforkeados.
+
+Uso: python serve.py [--bind 127.0.0.1:5000] [--workers N] [--threads 8]
+                     [--database productos.db] [--max-requests 10000]
+
+Cada opcion tambien se puede dar por entorno (CRUD_BIND, CRUD_WORKERS,
+CRUD_THREADS, CRUD_DATABASE, CRUD_MAX_REQUESTS, ...); la linea de comandos
+tiene prioridad. El resto de la configuracion de la app se pasa con
+variables CRUD_<CLAVE> (ver backend.py).
+
+Señales del maestro:
+  HUP        recarga sin cortes: arranca workers nuevos (con el codigo
+             actual) y luego detiene los viejos cuando terminan lo que tienen
+  TERM, INT  parada ordenada de todos los workers
+
+Solo funciona en sistemas POSIX (usa fork).
+"""
+import argparse
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_args(argv=None):
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description='Servidor de produccion del inventario')
+    parser.add_argument('--bind', default=env('CRUD_BIND', '127.0.0.1:5000'),
+                        help='host:puerto donde escuchar')
+    parser.add_argument('--workers', type=int, default=int(env('CRUD_WORKERS', os.cpu_count() or 1)),
+                        help='procesos worker (por defecto, uno por nucleo)')
+    parser.add_argument('--threads', type=int, default=int(env('CRUD_THREADS', 8)),
+                        help='hilos por worker')
+    parser.add_argument('--database', default=env('CRUD_DATABASE'),
+                        help='ruta de la base SQLite')
+    parser.add_argument('--max-requests', type=int, default=int(env('CRUD_MAX_REQUESTS', 10000)),
+                        help='reciclar el worker tras N peticiones (0 = nunca)')
+    parser.add_argument('--max-requests-jitter', type=int, default=int(env('CRUD_MAX_REQUESTS_JITTER', 1000)),
+                        help='variacion aleatoria para que no se reciclen todos a la vez')
+    parser.add_argument('--graceful-timeout', type=float, default=float(env('CRUD_GRACEFUL_TIMEOUT', 30)),
+                        help='segundos para terminar peticiones en curso al detener un worker')
+    parser.add_argument('--keepalive', type=float, default=float(env('CRUD_KEEPALIVE', 5)),
+                        help='segundos que se mantiene abierta una conexion inactiva')
+    args = parser.parse_args(argv)
+    host, _, port = args.bind.rpartition(':')
+    args.host, args.port = host or '127.0.0.1', int(port)
+    return args
+
+
+def crear_socket(host, port, backlog=2048):
+    familia = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(familia, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class Worker:
+    """Un worker: servidor HTTP con un pool fijo de hilos sobre el socket heredado."""
+
+    def __init__(self, sock, args):
+        self.sock = sock
+        self.args = args
+        self.atendidas = 0
+        self.limite = 0
+        if args.max_requests > 0:
+            self.limite = args.max_requests + random.randint(0, max(args.max_requests_jitter, 0))
+        self.server = None
+        self.backend = None
+        self._parando = threading.Event()
+
+    def run(self):
+        # La app se importa despues del fork: asi un HUP carga el codigo nuevo
+        import backend
+        from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+        self.backend = backend
+
+        worker = self
+
+        class Handler(WSGIRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            timeout = self.args.keepalive
+
+            def log_request(self, *args, **kwargs):
+                pass
+
+        class PoolServer(BaseWSGIServer):
+            multithread = True
+
+            def __init__(self, *a, threads, **kw):
+                super().__init__(*a, **kw)
+                self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+                self.libres = threading.Semaphore(threads)
+
+            def get_request(self):
+                # Solo se acepta con un hilo libre: las demas conexiones
+                # esperan en el backlog del kernel, donde las puede tomar
+                # otro worker, y no en la cola de este
+                while not self.libres.acquire(timeout=0.5):
+                    if worker._parando.is_set():
+                        raise OSError('worker detenido')
+                try:
+                    return super().get_request()
+                except BaseException:
+                    self.libres.release()
+                    raise
+
+            def process_request(self, request, client_address):
+                try:
+                    self.executor.submit(self._atender, request, client_address)
+                except BaseException:
+                    self.libres.release()
+                    raise
+
+            def _atender(self, request, client_address):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+                    self.libres.release()
+
+        def contar(environ, start_response):
+            worker.contar()
+            return backend.app(environ, start_response)
+
+        if backend.app.config['SNAPSHOT_ENABLED']:
+            # Cada worker carga su snapshot antes de aceptar peticiones
+            with backend.app.app_context():
+                backend.snapshot_sincronizado()
+        # Las tareas programadas las reclama un solo worker por periodo
+        backend.iniciar_mantenimiento()
+
+        self.server = PoolServer(self.args.host, self.args.port, contar, handler=Handler,
+                                 fd=self.sock.fileno(), threads=self.args.threads)
+        signal.signal(signal.SIGTERM, lambda *_: self.parar())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.server.serve_forever(poll_interval=0.5)
+        # Deja terminar las peticiones en curso antes de salir
+        self.server.executor.shutdown(wait=True)
+
+    def contar(self):
+        self.atendidas += 1
+        if self.limite and self.atendidas >= self.limite:
+            self.parar()
+
+    def parar(self):
+        if not self._parando.is_set():
+            self._parando.set()
+            threading.Thread(target=self._detener, daemon=True).start()
+            # Al reciclarse nadie mas lo vigila: si lo que tiene en curso no
+            # termina en el graceful timeout se mata, igual que en una recarga
+            forzar = threading.Timer(self.args.graceful_timeout, os.kill, (os.getpid(), signal.SIGKILL))
+            forzar.daemon = True
+            forzar.start()
+
+    def _detener(self):
+        # Los streams SSE no terminan solos: se cierran para que el worker
+        # pueda salir dentro del graceful timeout
+        if self.backend is not None:
+            difusor = self.backend.recursos(self.backend.app).difusor
+            if difusor is not None:
+                difusor.cerrar()
+        self.server.shutdown()
+
+
+class Arbiter:
+    """Proceso maestro: crea, vigila, recicla y recarga los workers."""
+
+    def __init__(self, args):
+        self.args = args
+        self.sock = None
+        self.workers = {}
+        # pid -> momento en que un worker al que se pidio salir recibe SIGKILL
+        self.plazos = {}
+        self.generacion = 0
+        self.recargar = False
+        self.detener = False
+
+    def run(self):
+        if self.args.database:
+            os.environ['CRUD_DATABASE'] = os.path.abspath(self.args.database)
+        # El pool de conexiones de cada worker debe alcanzar para sus hilos
+        os.environ.setdefault('CRUD_DB_POOL_SIZE', str(self.args.threads))
+        # Cada stream SSE ocupa un hilo mientras esta abierto: como maximo
+        # una cuarta parte, para que el resto siga atendiendo peticiones
+        os.environ.setdefault('CRUD_CHANGES_MAX_STREAMS', str(max(1, self.args.threads // 4)))
+        self.inicializar_db()
+        self.sock = crear_socket(self.args.host, self.args.port)
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, 'recargar', True))
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, 'detener', True))
+        signal.signal(signal.SIGINT, lambda *_: setattr(self, 'detener', True))
+        print(f'Escuchando en {self.args.host}:{self.args.port} con {self.args.workers} workers '
+              f'x {self.args.threads} hilos (maestro {os.getpid()})', flush=True)
+        self.completar()
+        while not self.detener:
+            self.recoger()
+            self.forzar_vencidos()
+            if self.recargar:
+                self.recargar = False
+                self.recarga()
+            self.completar()
+            time.sleep(0.2)
+        self.parar_todos()
+
+    def inicializar_db(self):
+        # init_db() corre una sola vez, en un hijo, para que el maestro no
+        # importe la app y los workers siempre la carguen fresca
+        pid = os.fork()
+        if pid == 0:
+            try:
+                import backend
+                backend.init_db()
+                os._exit(0)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                os._exit(1)
+        _, estado = os.waitpid(pid, 0)
+        if os.waitstatus_to_exitcode(estado) != 0:
+            sys.exit('No se pudo inicializar la base de datos')
+
+    def lanzar(self):
+        pid = os.fork()
+        if pid == 0:
+            codigo = 0
+            try:
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                Worker(self.sock, self.args).run()
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                codigo = 1
+            finally:
+                os._exit(codigo)
+        self.workers[pid] = self.generacion
+
+    def completar(self):
+        actuales = sum(1 for gen in self.workers.values() if gen == self.generacion)
+        for _ in range(self.args.workers - actuales):
+            self.lanzar()
+
+    def recoger(self):
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.workers.pop(pid, None)
+            self.plazos.pop(pid, None)
+
+    def recarga(self):
+        viejos = list(self.workers)
+        self.generacion += 1
+        self.completar()
+        # Los nuevos ya aceptan conexiones del mismo socket; los viejos
+        # terminan lo que tienen en curso y salen
+        for pid in viejos:
+            self.terminar(pid)
+
+    def terminar(self, pid):
+        self.señal(pid, signal.SIGTERM)
+        self.plazos.setdefault(pid, time.monotonic() + self.args.graceful_timeout)
+
+    def forzar_vencidos(self):
+        # Un worker que no salio dentro del graceful timeout (una peticion
+        # colgada) se mata para que no quede ocupando memoria y conexiones
+        ahora = time.monotonic()
+        for pid, limite in list(self.plazos.items()):
+            if ahora >= limite:
+                self.señal(pid, signal.SIGKILL)
+                del self.plazos[pid]
+
+    def parar_todos(self):
+        for pid in list(self.workers):
+            self.terminar(pid)
+        limite = time.monotonic() + self.args.graceful_timeout
+        while self.workers and time.monotonic() < limite:
+            self.recoger()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self.señal(pid, signal.SIGKILL)
+        self.recoger()
+        self.sock.close()
+
+    @staticmethod
+    def señal(pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+def main(argv=None):
+    if not hasattr(os, 'fork'):
+        sys.exit('serve.py necesita fork (Linux/macOS); en Windows use: python asgi.py')
+    Arbiter(parse_args(argv)).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""Replica de solo lectura del catalogo en memoria, por worker.
+
+Guarda ``productos`` por columnas: ids, precios y versiones en ``array``
+(8 bytes por valor) y los textos en listas. Un segundo par de arreglos
+ordenado por precio responde los filtros por rango. Se carga una vez y se
+pone al dia aplicando la tabla ``cambios`` (ver migrations.py) desde el
+ultimo ``seq`` visto.
+"""
+import heapq
+import logging
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+from repository import Producto
+
+log = logging.getLogger('crud.snapshot')
+
+COLUMNAS = ('id', 'nombre', 'precio', 'descripcion')
+
+
+class SnapshotExcedido(Exception):
+    pass
+
+
+class Snapshot:
+    __slots__ = ('database', 'max_bytes', 'ids', 'nombres', 'precios', 'descripciones',
+                 'versiones', 'por_precio', 'ids_por_precio', 'seq', 'version', 'actualizado',
+                 'verificado', 'pendiente', 'activo', '_bytes_texto', '_lock', '_stats')
+
+    def __init__(self, database, max_bytes=256 * 1024 * 1024):
+        self.database = database
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._stats = {'cargas': 0, 'sincronizaciones': 0, 'cambios_aplicados': 0}
+        self.activo = True
+        self.pendiente = True
+        self.verificado = 0.0
+        self._vaciar()
+
+    def _vaciar(self):
+        self.ids = array('q')
+        self.precios = array('d')
+        self.versiones = array('q')
+        self.nombres = []
+        self.descripciones = []
+        self.por_precio = array('d')
+        self.ids_por_precio = array('q')
+        self.seq = 0
+        self.version = None
+        self.actualizado = None
+        self._bytes_texto = 0
+
+    # -- carga y sincronizacion -------------------------------------------
+
+    def cargar(self, db):
+        with self._lock:
+            self._cargar(db)
+
+    def _cargar(self, db):
+        self._vaciar()
+        # Version y seq se leen antes que las filas: un cambio que se cuele
+        # en medio se vuelve a aplicar despues, y aplicarlo es idempotente
+        self.version, self.actualizado = db.execute(
+            'SELECT version, actualizado FROM catalogo WHERE id = 1').fetchone()
+        self.seq = db.execute('SELECT COALESCE(MAX(seq), 0) FROM cambios').fetchone()[0]
+        cursor = db.execute('SELECT id, nombre, precio, descripcion, version FROM productos ORDER BY id')
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            ids, nombres, precios, descripciones, versiones = zip(*rows)
+            self.ids.extend(ids)
+            self.nombres.extend(nombres)
+            self.precios.extend(precios)
+            self.descripciones.extend(descripciones)
+            self.versiones.extend(versiones)
+            self._bytes_texto += (sum(map(sys.getsizeof, nombres))
+                                  + sum(map(sys.getsizeof, filter(None, descripciones))))
+            self._verificar_limite()
+        # sorted es estable: a igual precio las posiciones (y los ids) quedan
+        # en orden ascendente
+        orden = sorted(range(len(self.ids)), key=self.precios.__getitem__)
+        self.por_precio = array('d', map(self.precios.__getitem__, orden))
+        self.ids_por_precio = array('q', map(self.ids.__getitem__, orden))
+        self._stats['cargas'] += 1
+
+    def sincronizar(self, db):
+        """Aplica los cambios pendientes; devuelve False si el snapshot quedo
+        deshabilitado por exceder su limite de memoria."""
+        with self._lock:
+            if not self.activo:
+                return False
+            self.pendiente = False
+            try:
+                if self.version is None:
+                    self._cargar(db)
+                else:
+                    self._aplicar_cambios(db)
+            except (SnapshotExcedido, TypeError) as error:
+                # TypeError: un precio no numerico (SQLite no lo impide) no
+                # entra en array('d'); en ambos casos se vuelve a leer de SQLite
+                self.activo = False
+                self._vaciar()
+                motivo = f'supera {self.max_bytes} bytes' if isinstance(error, SnapshotExcedido) else error
+                log.warning('Snapshot del catalogo deshabilitado: %s', motivo)
+                return False
+            self.verificado = time.monotonic()
+            self._stats['sincronizaciones'] += 1
+            return True
+
+    def _aplicar_cambios(self, db):
+        version, actualizado = db.execute('SELECT version, actualizado FROM catalogo WHERE id = 1').fetchone()
+        if version == self.version:
+            return
+        minimo, maximo, total = db.execute(
+            'SELECT MIN(seq), MAX(seq), COUNT(*) FROM cambios WHERE seq > ?', [self.seq]).fetchone()
+        if total:
+            # seq no tiene huecos salvo por poda: si falta el siguiente al
+            # ultimo visto, o hay tantos cambios que es mas barato releer
+            # todo, se recarga completo
+            if minimo > self.seq + 1 or total > max(len(self.ids) // 4, 1000):
+                self._cargar(db)
+                return
+            ids = sorted({row[0] for row in db.execute(
+                'SELECT producto_id FROM cambios WHERE seq > ? AND seq <= ?', [self.seq, maximo])})
+            actuales = {}
+            for i in range(0, len(ids), 500):
+                lote = ids[i:i + 500]
+                marcas = ', '.join('?' * len(lote))
+                for row in db.execute(f'''SELECT id, nombre, precio, descripcion, version
+                        FROM productos WHERE id IN ({marcas})''', lote):
+                    actuales[row[0]] = row
+            for id in ids:
+                fila = actuales.get(id)
+                if fila is None:
+                    self._eliminar(id)
+                else:
+                    self._guardar(fila)
+            self._verificar_limite()
+            self.seq = maximo
+            self._stats['cambios_aplicados'] += total
+        self.version, self.actualizado = version, actualizado
+
+    def _posicion(self, id):
+        i = bisect_left(self.ids, id)
+        return i if i < len(self.ids) and self.ids[i] == id else None
+
+    def _guardar(self, fila):
+        id, nombre, precio, descripcion, version = fila
+        i = self._posicion(id)
+        if i is None:
+            # Los ids nuevos casi siempre son los mayores: el insert es un append
+            i = bisect_left(self.ids, id)
+            self.ids.insert(i, id)
+            self.nombres.insert(i, nombre)
+            self.precios.insert(i, precio)
+            self.descripciones.insert(i, descripcion)
+            self.versiones.insert(i, version)
+        else:
+            self._bytes_texto -= tamano_texto(self.nombres[i]) + tamano_texto(self.descripciones[i])
+            self._quitar_de_precio(self.precios[i], id)
+            self.nombres[i] = nombre
+            self.precios[i] = precio
+            self.descripciones[i] = descripcion
+            self.versiones[i] = version
+        self._bytes_texto += tamano_texto(nombre) + tamano_texto(descripcion)
+        j = bisect_right(self.por_precio, precio)
+        self.por_precio.insert(j, precio)
+        self.ids_por_precio.insert(j, id)
+
+    def _eliminar(self, id):
+        i = self._posicion(id)
+        if i is None:
+            return
+        self._bytes_texto -= tamano_texto(self.nombres[i]) + tamano_texto(self.descripciones[i])
+        self._quitar_de_precio(self.precios[i], id)
+        del self.ids[i], self.nombres[i], self.precios[i], self.descripciones[i], self.versiones[i]
+
+    def _quitar_de_precio(self, precio, id):
+        j = bisect_left(self.por_precio, precio)
+        fin = bisect_right(self.por_precio, precio, j)
+        j = self.ids_por_precio.index(id, j, fin)
+        del self.por_precio[j], self.ids_por_precio[j]
+
+    def _verificar_limite(self):
+        if self.bytes() > self.max_bytes:
+            raise SnapshotExcedido()
+
+    # -- lecturas ---------------------------------------------------------
+
+    @staticmethod
+    def puede_listar(consulta):
+        # El prefijo por nombre queda para SQLite (usa su indice NOCASE)
+        return consulta['filtros'].get('nombre') is None
+
+    def obtener(self, id):
+        with self._lock:
+            i = self._posicion(id)
+            if i is None:
+                return None
+            return Producto(id, self.nombres[i], self.precios[i], self.descripciones[i], self.versiones[i])
+
+    def listar(self, consulta):
+        """Misma semantica que listar_productos: orden por id, cursor
+        ``after`` y ``limit`` + 1 para saber si hay siguiente pagina."""
+        filtros = consulta['filtros']
+        minimo, maximo = filtros.get('precio_min'), filtros.get('precio_max')
+        after = consulta['after']
+        tope = consulta['limit'] + 1 if consulta['paginado'] else None
+        with self._lock:
+            inicio = 0 if after is None else bisect_right(self.ids, after)
+            if minimo is None and maximo is None:
+                fin = len(self.ids) if tope is None else min(inicio + tope, len(self.ids))
+                posiciones = range(inicio, fin)
+            else:
+                posiciones = self._por_rango(inicio, after, minimo, maximo, tope)
+            siguiente = None
+            if tope is not None and len(posiciones) > consulta['limit']:
+                posiciones = posiciones[:consulta['limit']]
+                siguiente = self.ids[posiciones[-1]]
+            filas = [self._fila(i, consulta['campos']) for i in posiciones]
+        return filas, siguiente
+
+    def _por_rango(self, inicio, after, minimo, maximo, tope):
+        lo = 0 if minimo is None else bisect_left(self.por_precio, minimo)
+        hi = len(self.por_precio) if maximo is None else bisect_right(self.por_precio, maximo)
+        if hi <= lo:
+            return []
+        precios = self.precios
+        # Tomar los ids del rango cuesta ~n (n = filas en el rango); recorrer
+        # por id hasta llenar la pagina cuesta ~tope * total / n. Se elige
+        # el menor
+        n = hi - lo
+        if tope is None or n * n <= tope * len(self.ids):
+            candidatos = (id for id in self.ids_por_precio[lo:hi] if after is None or id > after)
+            elegidos = sorted(candidatos) if tope is None else heapq.nsmallest(tope, candidatos)
+            return [self._posicion(id) for id in elegidos]
+        minimo = float('-inf') if minimo is None else minimo
+        maximo = float('inf') if maximo is None else maximo
+        posiciones = []
+        for i in range(inicio, len(self.ids)):
+            if minimo <= precios[i] <= maximo:
+                posiciones.append(i)
+                if len(posiciones) == tope:
+                    break
+        return posiciones
+
+    def _fila(self, i, campos):
+        valores = {'id': self.ids[i], 'nombre': self.nombres[i], 'precio': self.precios[i],
+                   'descripcion': self.descripciones[i]}
+        if len(campos) == len(COLUMNAS):
+            return valores
+        return {campo: valores[campo] for campo in campos}
+
+    # -- memoria ----------------------------------------------------------
+
+    def bytes(self):
+        arreglos = (self.ids, self.precios, self.versiones, self.por_precio, self.ids_por_precio)
+        listas = (self.nombres, self.descripciones)
+        return (sum(sys.getsizeof(a) for a in arreglos) + sum(sys.getsizeof(l) for l in listas)
+                + self._bytes_texto)
+
+    def stats(self):
+        with self._lock:
+            filas = len(self.ids)
+            total = self.bytes()
+            stats = dict(self._stats)
+        stats.update(filas=filas, bytes=total, bytes_por_fila=round(total / filas, 1) if filas else 0,
+                     max_bytes=self.max_bytes, activo=int(self.activo), seq=self.seq)
+        return stats
+
+
+def tamano_texto(valor):
+    return 0 if valor is None else sys.getsizeof(valor)
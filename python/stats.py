@@ -0,0 +1,153 @@
+"""Estadisticas de precios para ``GET /productos/stats``.
+
+Sin filtro todo sale del indice por precio, sin ordenar ni agrupar en
+tablas temporales:
+  - minimo y maximo son una busqueda en el indice cada uno;
+  - cada bucket del histograma es un conteo por rango (COUNT + SUM);
+  - cada percentil se ubica con los conteos acumulados y se lee con un
+    OFFSET dentro de su bucket.
+Con filtro por nombre se leen los precios que coinciden ya ordenados y se
+reduce en Python; el costo crece con las filas que coinciden, no con el
+catalogo.
+
+``precio < ''`` deja solo precios numericos: en SQLite todo numero es menor
+que cualquier texto y NULL no cumple la comparacion. Asi las filas con un
+precio no numerico no rompen la aritmetica y el indice se sigue usando.
+"""
+import math
+from bisect import bisect_left
+
+NUMERICO = "precio < ''"
+
+
+def ancho_automatico(minimo, maximo, buckets):
+    """Ancho "redondo" (1, 2, 2.5 o 5 por una potencia de 10) para que el
+    rango quede en unos ``buckets`` intervalos."""
+    bruto = (maximo - minimo) / buckets
+    if bruto <= 0:
+        return 1.0
+    # En float: un entero exacto como 10 ** 299 no entra en un parametro de SQLite
+    magnitud = 10.0 ** math.floor(math.log10(bruto))
+    for factor in (1, 2, 2.5, 5, 10):
+        if factor * magnitud >= bruto:
+            return factor * magnitud
+    return 10 * magnitud
+
+
+def bordes(minimo, maximo, ancho, max_buckets):
+    """Bordes de los buckets de ``ancho`` que cubren [minimo, maximo].
+
+    La cantidad se calcula una vez y se valida antes de armar la lista: con
+    precios enormes o un ancho muy chico ``origen + i * ancho`` deja de
+    crecer y no se puede contar sumando. ``math.floor`` lanza OverflowError
+    si ``minimo / ancho`` no es finito."""
+    origen = math.floor(minimo / ancho) * ancho
+    if origen > minimo:
+        origen -= ancho
+    cociente = (maximo - origen) / ancho
+    if not math.isfinite(origen) or not math.isfinite(cociente) or origen + ancho == origen:
+        raise ValueError('width demasiado chico para el rango de precios')
+    # El ultimo bucket tiene que terminar despues de maximo
+    total = math.floor(cociente) + 1
+    if total <= max_buckets and origen + total * ancho <= maximo:
+        total += 1
+    if total > max_buckets:
+        raise ValueError(f'El histograma tendria {total} buckets (maximo {max_buckets}); use un width mayor')
+    limites = [origen + i * ancho for i in range(total + 1)]
+    if any(fin <= inicio for inicio, fin in zip(limites, limites[1:])):
+        raise ValueError('width demasiado chico para el rango de precios')
+    return limites
+
+
+def rango_percentil(percentil, total):
+    # Rango mas cercano: el k-esimo menor con k = ceil(p/100 * n), minimo 1
+    return max(1, math.ceil(percentil / 100 * total))
+
+
+def clave_percentil(percentil):
+    return f'p{percentil:g}'
+
+
+def calcular(db, ancho=None, percentiles=(), condiciones=(), params=(), buckets=20, max_buckets=1000):
+    """Devuelve count, sum, avg, min, max, percentiles e histograma de los
+    precios que cumplen ``condiciones`` (SQL sobre productos)."""
+    if condiciones:
+        precios = [row[0] for row in db.execute(
+            f"SELECT precio FROM productos WHERE {' AND '.join((NUMERICO, *condiciones))} ORDER BY precio",
+            params)]
+        minimo, maximo = (precios[0], precios[-1]) if precios else (None, None)
+    else:
+        precios = None
+        minimo = db.execute(f'SELECT MIN(precio) FROM productos WHERE {NUMERICO}').fetchone()[0]
+        maximo = db.execute(f'SELECT MAX(precio) FROM productos WHERE {NUMERICO}').fetchone()[0]
+    if minimo is None:
+        return {'count': 0, 'sum': 0, 'avg': None, 'min': None, 'max': None,
+                'percentiles': {clave_percentil(p): None for p in percentiles},
+                'histogram': {'width': ancho, 'buckets': []}}
+    ancho = ancho or ancho_automatico(minimo, maximo, buckets)
+    limites = bordes(minimo, maximo, ancho, max_buckets)
+    if precios is None:
+        conteos, suma = por_rangos(db, limites)
+    else:
+        # El primer y el ultimo bucket quedan abiertos, igual que en por_rangos
+        cortes = [0] + [bisect_left(precios, borde) for borde in limites[1:-1]] + [len(precios)]
+        conteos = [fin - inicio for inicio, fin in zip(cortes, cortes[1:])]
+        suma = math.fsum(precios)
+    total = sum(conteos)
+    valores = {}
+    for percentil in percentiles:
+        k = rango_percentil(percentil, total)
+        if precios is not None:
+            valores[clave_percentil(percentil)] = precios[k - 1]
+        else:
+            valores[clave_percentil(percentil)] = percentil_por_rangos(db, limites, conteos, k)
+    return {
+        'count': total,
+        'sum': suma,
+        'avg': suma / total,
+        'min': minimo,
+        'max': maximo,
+        'percentiles': valores,
+        'histogram': {
+            'width': ancho,
+            'buckets': [{'start': inicio, 'end': fin, 'count': conteo}
+                        for inicio, fin, conteo in zip(limites, limites[1:], conteos)],
+        },
+    }
+
+
+def condicion_bucket(limites, i):
+    # Una cota superior numerica ya excluye textos y NULL; NUMERICO va solo
+    # en el ultimo bucket. Con las dos cotas SQLite usaria ``< ''`` como
+    # limite del rango y recorreria el indice hasta el final
+    condiciones, params = [], []
+    if i > 0:
+        condiciones.append('precio >= ?')
+        params.append(limites[i])
+    if i < len(limites) - 2:
+        condiciones.append('precio < ?')
+        params.append(limites[i + 1])
+    else:
+        condiciones.append(NUMERICO)
+    return ' AND '.join(condiciones), params
+
+
+def por_rangos(db, limites):
+    conteos, sumas = [], []
+    for i in range(len(limites) - 1):
+        where, params = condicion_bucket(limites, i)
+        conteo, suma = db.execute(f'SELECT COUNT(*), SUM(precio) FROM productos WHERE {where}', params).fetchone()
+        conteos.append(conteo)
+        sumas.append(suma or 0)
+    return conteos, math.fsum(sumas)
+
+
+def percentil_por_rangos(db, limites, conteos, k):
+    antes = 0
+    for i, conteo in enumerate(conteos):
+        if antes + conteo >= k:
+            where, params = condicion_bucket(limites, i)
+            return db.execute(f'SELECT precio FROM productos WHERE {where} ORDER BY precio LIMIT 1 OFFSET ?',
+                              params + [k - antes - 1]).fetchone()[0]
+        antes += conteo
+    return None
@@ -1,60 +1,18 @@
-import requests
-import threading
-import time
-import random
+"""Prueba de estabilidad: carga sostenida de operaciones CRUD contra un
+servidor levantado (por defecto http://127.0.0.1:5000).
 
-BASE_URL = 'http://127.0.0.1:5000/productos'
+Es un preajuste de benchmark.py con una mezcla rica en escrituras; admite
+las mismas opciones, p. ej.:
+  python test-estabilidad.py --duration 600 --concurrency 32 --output estabilidad.json
+"""
+import sys
 
-def crear_producto(i):
-    data = {
-        "nombre": f"Producto Test {i}",
-        "precio": round(random.uniform(1, 100), 2),
-        "descripcion": "Descripción de prueba"
-    }
-    response = requests.post(BASE_URL, json=data)
-    print(f"Crear {i}: {response.status_code} - {response.json()}")
+import benchmark
 
-def editar_producto(id):
-    data = {
-        "nombre": f"Producto Editado {id}",
-        "precio": round(random.uniform(1, 100), 2),
-        "descripcion": "Descripción editada"
-    }
-    response = requests.put(f"{BASE_URL}/{id}", json=data)
-    print(f"Editar {id}: {response.status_code} - {response.json()}")
-
-def eliminar_producto(id):
-    response = requests.delete(f"{BASE_URL}/{id}")
-    print(f"Eliminar {id}: {response.status_code} - {response.json()}")
-
-def listar_productos():
-    response = requests.get(BASE_URL)
-    productos = response.json()
-    print(f"Listar: {len(productos)} productos")
-    return productos
-
-def prueba_estabilidad(num_iteraciones=20):
-    # Crear productos
-    for i in range(num_iteraciones):
-        crear_producto(i)
-        time.sleep(0.1)  # pequeña pausa
-
-    # Listar productos para obtener ids
-    productos = listar_productos()
-    ids = [p['id'] for p in productos]
-
-    # Editar los primeros 5 productos
-    for id in ids[:5]:
-        editar_producto(id)
-        time.sleep(0.1)
-
-    # Eliminar los últimos 5 productos
-    for id in ids[-5:]:
-        eliminar_producto(id)
-        time.sleep(0.1)
-
-    # Listar final
-    listar_productos()
+PREDETERMINADOS = ['--url', 'http://127.0.0.1:5000',
+                   '--mix', 'crear=30,editar=20,eliminar=10,listado=20,detalle=20',
+                   '--duration', '60', '--concurrency', '16']
 
 if __name__ == "__main__":
-    prueba_estabilidad()
+    # Las opciones de la linea de comandos reemplazan a los predeterminados
+    benchmark.main(PREDETERMINADOS + sys.argv[1:])
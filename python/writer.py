@@ -0,0 +1,163 @@
+import logging
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+log = logging.getLogger('crud.writer')
+
+
+class WriterClosed(Exception):
+    """El hilo del escritor terminó (cerrado o por un error): no acepta más trabajos."""
+
+
+class WriteTimeout(Exception):
+    """El trabajo no terminó dentro del plazo de ``execute``."""
+
+
+class WriteQueue:
+    """Escritor único: agrupa las escrituras concurrentes en una sola transacción."""
+
+    def __init__(self, database, pragmas=None, max_batch=64, cached_statements=128):
+        self.database = database
+        self.pragmas = dict(pragmas or {})
+        self.max_batch = max_batch
+        self.cached_statements = cached_statements
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {'jobs': 0, 'batches': 0, 'errors': 0, 'max_batch': 0}
+        # Excepción con la que terminó el hilo; después de ella submit rechaza
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self):
+        return self._error is None and self._thread.is_alive()
+
+    def submit(self, fn):
+        future = Future()
+        with self._lock:
+            # Con el lock: si el hilo muere después, el trabajo ya está en la
+            # cola y se falla al vaciarla
+            if self._error is not None:
+                raise WriterClosed('El escritor no está disponible') from self._error
+            self._jobs.put((fn, future))
+        return future
+
+    def execute(self, fn, timeout=None):
+        """Corre ``fn(db)`` en el escritor y devuelve su resultado. Si no
+        termina en ``timeout`` segundos lanza WriteTimeout; un trabajo que
+        todavía no empezó se cancela, uno en curso puede confirmarse igual."""
+        future = self.submit(fn)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise WriteTimeout(f'La escritura no terminó en {timeout} s') from None
+
+    def close(self):
+        self._jobs.put(None)
+        self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pending'] = self._jobs.qsize()
+        return stats
+
+    def _connect(self):
+        # Sin transacciones implicitas: BEGIN/COMMIT se controlan a mano
+        db = sqlite3.connect(self.database, isolation_level=None, check_same_thread=False,
+                             cached_statements=self.cached_statements)
+        for name, value in self.pragmas.items():
+            db.execute(f'PRAGMA {name} = {value}')
+        return db
+
+    def _run(self):
+        batch = []
+        db = None
+        try:
+            db = self._connect()
+            running = True
+            while running:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                batch = [job]
+                while len(batch) < self.max_batch:
+                    try:
+                        job = self._jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        running = False
+                        break
+                    batch.append(job)
+                self._execute(db, batch)
+                batch = []
+        except BaseException as error:
+            # Sin conexión (o con una que ya no se puede deshacer) el hilo no
+            # sigue: los trabajos tomados y los encolados fallan con el error
+            # en lugar de esperar para siempre
+            log.error('El escritor de %s terminó: %s', self.database, error)
+            self._fail_all(batch, error)
+        finally:
+            if db is not None:
+                db.close()
+
+    def _fail_all(self, batch, error):
+        with self._lock:
+            self._error = error
+            pending = list(batch)
+            while True:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is not None:
+                    pending.append(job)
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(WriterClosed(f'El escritor terminó: {error}'))
+
+    def _execute(self, db, batch):
+        results = []
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            for fn, future in batch:
+                # Un trabajo cancelado por timeout antes de empezar no corre
+                if not future.set_running_or_notify_cancel():
+                    continue
+                # Cada trabajo va en su propio SAVEPOINT para que un error
+                # no deshaga el resto del lote
+                db.execute('SAVEPOINT trabajo')
+                try:
+                    results.append((future, fn(db), None))
+                    db.execute('RELEASE trabajo')
+                except Exception as error:
+                    db.execute('ROLLBACK TO trabajo')
+                    db.execute('RELEASE trabajo')
+                    results.append((future, None, error))
+            db.execute('COMMIT')
+        except Exception as error:
+            if db.in_transaction:
+                # Si el ROLLBACK también falla la excepción termina el hilo
+                # (ver _run), que falla este lote y los pendientes
+                db.execute('ROLLBACK')
+            # Los que no llegaron a empezar se reclaman para no competir con cancel()
+            results = [(future, None, error) for _, future in batch
+                       if future.running() or future.set_running_or_notify_cancel()]
+
+        errors = 0
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                errors += 1
+                future.set_exception(error)
+        with self._lock:
+            self._stats['jobs'] += len(batch)
+            self._stats['batches'] += 1
+            self._stats['errors'] += errors
+            self._stats['max_batch'] = max(self._stats['max_batch'], len(batch))